@@ -1,8 +1,15 @@
+import os
 from datetime import datetime
 
 import gradio as gr
 
-from src.app.functions import generate_csv_files, generate_images
+from src.app.functions import (
+    cancel_job,
+    generate_csv_files_job,
+    generate_images_job,
+    preview_images,
+)
+from src.metrics import start_prometheus_server
 
 # Create the Gradio app
 with gr.Blocks(theme=gr.themes.Default(), title="Generation App") as app:
@@ -159,10 +166,13 @@ with gr.Blocks(theme=gr.themes.Default(), title="Generation App") as app:
                 info="Choose between 0 and 10",
             )
 
+        job_id_2 = gr.Textbox(label="Job ID", interactive=False)
         status_msg = gr.Textbox(label="Status")
-        start_button_2 = gr.Button("Generate CSVs", variant="primary")
+        with gr.Row():
+            start_button_2 = gr.Button("Generate CSVs", variant="primary")
+            cancel_button_2 = gr.Button("Cancel", variant="stop")
         start_button_2.click(
-            fn=generate_csv_files,
+            fn=generate_csv_files_job,
             inputs=[
                 data_dir,
                 save_dir,
@@ -181,8 +191,10 @@ with gr.Blocks(theme=gr.themes.Default(), title="Generation App") as app:
                 pins_per_day_sticker_mockups,
                 pins_per_day_wallpaper_mockups,
             ],
-            outputs=status_msg,
+            outputs=[job_id_2, status_msg],
+            concurrency_limit=None,
         )
+        cancel_button_2.click(fn=cancel_job, inputs=job_id_2, outputs=status_msg)
 
     with gr.Tab("Image Generation"):
         # Tab 2 - Row 1
@@ -216,16 +228,46 @@ with gr.Blocks(theme=gr.themes.Default(), title="Generation App") as app:
                 info="Choose between 0.5 and 5",
             )
 
+        # Tab 2 - Row 3
+        preview_gallery = gr.Gallery(
+            label="Preview",
+            columns=4,
+            height="auto",
+            object_fit="contain",
+        )
+
+        job_id_1 = gr.Textbox(label="Job ID", interactive=False)
         status_msg = gr.Textbox(label="Status")
-        start_button_1 = gr.Button("Generate Images", variant="primary")
+        with gr.Row():
+            preview_button_1 = gr.Button("Preview")
+            start_button_1 = gr.Button("Generate Images", variant="primary")
+            cancel_button_1 = gr.Button("Cancel", variant="stop")
         start_button_1.click(
-            fn=generate_images,
+            fn=generate_images_job,
             inputs=[sample_dir, save_dir, num_images_per_bg, scaling_factor],
-            outputs=status_msg,
+            outputs=[job_id_1, status_msg],
+            concurrency_limit=None,
+        )
+        cancel_button_1.click(fn=cancel_job, inputs=job_id_1, outputs=status_msg)
+
+        # Refresh the preview when the scaling changes
+        preview_button_1.click(
+            fn=preview_images,
+            inputs=[sample_dir, num_images_per_bg, scaling_factor],
+            outputs=preview_gallery,
+        )
+        scaling_factor.release(
+            fn=preview_images,
+            inputs=[sample_dir, num_images_per_bg, scaling_factor],
+            outputs=preview_gallery,
         )
 
 
 if __name__ == "__main__":
+    # Metrics of finished jobs in the Prometheus text format at http://127.0.0.1:<port>/metrics
+    if os.environ.get("METRICS_PORT"):
+        start_prometheus_server(port=int(os.environ["METRICS_PORT"]))
+
     app.launch(
         share=False,
         server_name="0.0.0.0",
@@ -1,25 +1,53 @@
-import datetime
+import inspect
 import os
-from glob import glob
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Tuple
 
-import gradio as gr
-import pandas as pd
-from tqdm import tqdm
-
-from src.generate_csv_files import (
-    create_df_per_day,
-    filter_paths_by_category,
-    load_credentials,
-    save_csv_files,
-    verify_pin_availability,
-)
-from src.image_data.image_generator import ImageGenerator
-from src.image_data.image_matcher import ImageMatcher
-from src.text_data.publish_date_generator import PublishDateGenerator
-from src.text_data.sample_processor import SampleProcessor
-from src.text_data.ssh_file_transfer import SSHFileTransfer
-from src.utils import CSV_COLUMNS
+from src.app.job_manager import JobCancelledError, JobReporter, get_job_manager
+
+# Heavy dependencies are imported inside the functions, which mostly run in job worker processes,
+# so that the app starts without loading cv2, pandas, paramiko or hydra
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+
+def _get_layout_background_pairs(
+    sample_dir: str,
+) -> "pd.DataFrame":
+    from src.image_data.image_matcher import ImageMatcher
+
+    matcher = ImageMatcher()
+    layout_dir = os.path.join(sample_dir, "layouts")
+    bg_dir = os.path.join(sample_dir, "backgrounds")
+    layout_paths = matcher.get_file_list(layout_dir, "layout*.[jpPJ][nNpP][gG]")
+    bg_paths = matcher.get_file_list(bg_dir, "background*.[jpPJ][nNpP][gG]")
+    return matcher.create_dataframe(layout_paths, bg_paths)
+
+
+def preview_images(
+    sample_dir: str,
+    num_images_per_bg: int,
+    scaling_factor: float,
+    seed: int = 11,
+    num_previews: int = 4,
+    preview_scale: float = 0.25,
+) -> List["np.ndarray"]:
+    from src.image_data.image_generator import ImageGenerator
+
+    # Runs in the app process, a low-resolution preview is faster than submitting a job
+    generator = ImageGenerator(
+        num_images_per_bg=num_images_per_bg,
+        scaling_factor=scaling_factor,
+        seed=seed,
+    )
+    df = _get_layout_background_pairs(sample_dir)
+    return generator.generate_previews(
+        df=df,
+        sample_dir=sample_dir,
+        num_previews=num_previews,
+        preview_scale=preview_scale,
+    )
 
 
 def generate_images(
@@ -28,32 +56,34 @@ def generate_images(
     num_images_per_bg: int,
     scaling_factor: float,
     seed: int = 11,
+    reporter: Optional[JobReporter] = None,
 ) -> str:
+    from src.pipeline.stages import build_pipeline, load_config
+
+    reporter = reporter or JobReporter()
     try:
-        # Initialize ImageMatcher and ImageGenerator instances
-        matcher = ImageMatcher()
-        generator = ImageGenerator(
+        # Run the image branch of the pipeline for a single sample
+        cfg = load_config(
+            "generate_images",
+            data_dir=str(Path(sample_dir).parent),
+            save_dir=save_dir,
             num_images_per_bg=num_images_per_bg,
             scaling_factor=scaling_factor,
+            include_samples=[Path(sample_dir).name],
+            exclude_samples=[],
             seed=seed,
         )
-
-        # Get metadata with layout and background pairs
-        layout_dir = os.path.join(sample_dir, "layouts")
-        bg_dir = os.path.join(sample_dir, "backgrounds")
-        layout_paths = matcher.get_file_list(layout_dir, "layout*.[jpPJ][nNpP][gG]")
-        bg_paths = matcher.get_file_list(bg_dir, "background*.[jpPJ][nNpP][gG]")
-        df = matcher.create_dataframe(layout_paths, bg_paths)
-
-        # Process sample
-        generator.process_sample(
-            df=df,
-            sample_dir=sample_dir,
-            save_dir=save_dir,
+        pipeline = build_pipeline(
+            images_cfg=cfg,
+            cache_dir=cfg.pipeline_cache_dir,
+            progress=reporter.update,
         )
+        pipeline.run(on_stage_start=reporter.stage)
         sample_name = Path(sample_dir).name
         sample_save_dir = os.path.join(save_dir, sample_name)
         msg = f"Images generated successfully!\n\nDirectory: {sample_save_dir}"
+    except JobCancelledError as e:
+        msg = str(e)
     except Exception as e:
         msg = f"Something went wrong!\n\nError: {e}"
 
@@ -78,7 +108,13 @@ def generate_csv_files(
     pins_per_day_sticker_mockups: int,
     pins_per_day_wallpaper_mockups: int,
     seed: int = 11,
+    reporter: Optional[JobReporter] = None,
 ) -> str:
+    import pandas as pd
+
+    from src.pipeline.stages import build_pipeline, load_config
+
+    reporter = reporter or JobReporter()
     try:
         pins_per_day = {
             "canva-instagram-templates": pins_per_day_canva_instagram_templates,
@@ -93,96 +129,28 @@ def generate_csv_files(
             "wallpaper-mockups": pins_per_day_wallpaper_mockups,
         }
 
-        # Load credentials
-        HOSTNAME, USERNAME, PASSWORD, PORT, REMOTE_ROOT_DIR, URL = load_credentials()
-
-        # Get list of sample paths to process
-        sample_dirs_ = glob(os.path.join(data_dir, "*/*"))
-        sample_dirs = filter_paths_by_category(sample_dirs_, pins_per_day)
-
-        # Process samples by their paths
-        sample_processor = SampleProcessor(
-            url=URL,
-            remote_root_dir=REMOTE_ROOT_DIR,
-            column_names=CSV_COLUMNS,
-        )
-        df_list = []
-        for sample_dir in tqdm(sample_dirs, desc="Processing samples", unit="samples"):
-            df_ = sample_processor.process_sample(sample_dir)
-            df_list.append(df_)
-        df_all = pd.concat(df_list, ignore_index=True)
-        df = df_all.drop_duplicates(subset=["Title"], keep="first")
-
-        # Check if there is enough samples for each category
-        verify_pin_availability(df, pins_per_day, num_days=num_days)
-
-        # Create df_day_list with DataFrames representing pins for each day
-        df_day_list = []
-        df_remaining = df.copy()
-        for _ in range(num_days):
-            df_day, df_remaining = create_df_per_day(
-                df=df_remaining,
-                pins_per_day=pins_per_day,
-                seed=seed,
-            )
-            df_day_list.append(df_day)
-
-        # Add publish dates to the dataframe
-        current_date = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        for day_idx, df_day in enumerate(df_day_list):
-            publish_date_generator = PublishDateGenerator(date=current_date)
-            publish_date_list = publish_date_generator.generate_times(num_pins_per_day=len(df_day))
-            df_day["Publish date"] = publish_date_list
-            df_day_list[day_idx] = df_day
-            current_date += datetime.timedelta(days=1)
-
-        # Upload images to the remote server
-        df_out = pd.concat(df_day_list, ignore_index=True)
-        if copy_files_to_server:
-            ssh_file_transfer = SSHFileTransfer(
-                username=USERNAME,
-                hostname=HOSTNAME,
-                port=PORT,
-                password=PASSWORD,
-                url=URL,
-            )
-            ssh_file_transfer.connect()
-            ssh_file_transfer.remove_remote_dir(os.path.join(REMOTE_ROOT_DIR, "*"))
-            total_pins = len(df_out)
-            progress = gr.Progress(track_tqdm=True)
-            progress(0, desc="Starting")
-            for idx, row in enumerate(
-                tqdm(
-                    df_out.itertuples(),
-                    desc="Uploading images",
-                    unit="images",
-                    total=total_pins,
-                ),
-            ):
-                remote_dir = str(Path(row.dst_path).parent)
-                ssh_file_transfer.create_remote_dir(remote_dir)
-                ssh_file_transfer.upload_file(
-                    local_path=row.src_path,
-                    remote_path=row.dst_path,
-                )
-                # Update progress
-                progress((idx + 1) / total_pins)
-            ssh_file_transfer.disconnect()
-
-        # Remove local files
-        if remove_local_files:
-            for row in df_out.itertuples():
-                os.remove(row.src_path)
-
-        # Save final CSVs
-        df_out = df_out[CSV_COLUMNS]
-        save_csv_files(
-            df=df_out,
+        # Run the CSV branch of the pipeline with the CLI defaults for everything else
+        cfg = load_config(
+            "generate_csv_files",
+            data_dir=data_dir,
             save_dir=save_dir,
+            num_days=num_days,
+            start_date=start_date,
+            copy_files_to_server=copy_files_to_server,
+            remove_local_files=remove_local_files,
+            pins_per_day=pins_per_day,
+            seed=seed,
         )
+        pipeline = build_pipeline(
+            csv_cfg=cfg,
+            cache_dir=cfg.pipeline_cache_dir,
+            progress=reporter.update,
+        )
+        artifacts = pipeline.run(on_stage_start=reporter.stage)
+        df_out = pd.concat(artifacts["upload"], ignore_index=True)
 
         # Log summary
-        total_pins = len(df_all)
+        total_pins = len(artifacts["text_metadata"])
         num_saved_pins = len(df_out)
         num_products = len(df_out["Link"].unique())
         msg = (
@@ -192,7 +160,36 @@ def generate_csv_files(
             f"Saved pins: {num_saved_pins}\n\n"
             f"Products advertised: {num_products}\n\n"
         )
+    except JobCancelledError as e:
+        msg = str(e)
     except Exception as e:
         msg = f"Something went wrong!\n\nError: {e}"
 
     return msg
+
+
+def submit_job(
+    fn: Callable[..., str],
+    name: str,
+    *args,
+) -> Iterator[Tuple[str, str]]:
+    # Run the function in the job pool and stream its status as (job_id, message) pairs
+    job_manager = get_job_manager()
+    kwargs = inspect.signature(fn).bind(*args).arguments
+    job_id = job_manager.submit(fn, name=name, **kwargs)
+    for msg in job_manager.stream(job_id):
+        yield job_id, msg
+
+
+def generate_images_job(*args) -> Iterator[Tuple[str, str]]:
+    yield from submit_job(generate_images, "Image generation", *args)
+
+
+def generate_csv_files_job(*args) -> Iterator[Tuple[str, str]]:
+    yield from submit_job(generate_csv_files, "CSV generation", *args)
+
+
+def cancel_job(job_id: str) -> str:
+    if get_job_manager().cancel(job_id):
+        return f"Cancellation requested for job {job_id}"
+    return f"Job {job_id} is not running"
@@ -0,0 +1,243 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.metrics import collect_metrics, run_with_metrics
+
+
+class JobCancelledError(Exception):
+    """Raised inside a job when its cancellation was requested."""
+
+
+class JobReporter:
+    """A class for reporting the progress of a job from its worker process.
+
+    Without a queue and an event, e.g. when a job function is called directly, reporting and
+    cancellation checks are no-ops.
+    """
+
+    def __init__(
+        self,
+        progress_queue: Optional[Any] = None,
+        cancel_event: Optional[Any] = None,
+    ) -> None:
+        self.progress_queue = progress_queue
+        self.cancel_event = cancel_event
+        self.stage_name = ""
+        self.stage_start = time.perf_counter()
+        self.total: Optional[int] = None
+
+    def check_cancelled(self) -> None:
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise JobCancelledError("Job cancelled")
+
+    def stage(
+        self,
+        name: str,
+        total: Optional[int] = None,
+    ) -> None:
+        self.check_cancelled()
+        self.stage_name = name
+        self.stage_start = time.perf_counter()
+        self.total = total
+        self.update(0)
+
+    def update(
+        self,
+        done: int,
+        total: Optional[int] = None,
+    ) -> None:
+        self.check_cancelled()
+        if total is not None:
+            self.total = total
+        if self.progress_queue is None:
+            return
+        elapsed_time = time.perf_counter() - self.stage_start
+        self.progress_queue.put(
+            {
+                "stage": self.stage_name,
+                "done": done,
+                "total": self.total,
+                "rate": done / elapsed_time if elapsed_time > 0 else 0.0,
+            },
+        )
+
+
+def _run_job(
+    fn: Callable[..., str],
+    kwargs: Dict[str, Any],
+    progress_queue: Any,
+    cancel_event: Any,
+    parent_pid: int,
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    # The metrics recorded by the job are returned with its result and merged in the app process
+    reporter = JobReporter(progress_queue=progress_queue, cancel_event=cancel_event)
+    return run_with_metrics(fn, parent_pid, **kwargs, reporter=reporter)
+
+
+class Job:
+    """A generation job submitted to the JobManager."""
+
+    def __init__(
+        self,
+        job_id: str,
+        name: str,
+        future: Future,
+        progress_queue: Any,
+        cancel_event: Any,
+    ) -> None:
+        self.job_id = job_id
+        self.name = name
+        self.future = future
+        self.progress_queue = progress_queue
+        self.cancel_event = cancel_event
+        self.progress: Dict[str, Any] = {}
+        self.created_at = time.time()
+        self.result: Optional[str] = None
+
+    @property
+    def state(self) -> str:
+        if self.future.cancelled() or (self.future.done() and self.cancel_event.is_set()):
+            return "cancelled"
+        if self.future.done():
+            return "failed" if self.future.exception() is not None else "finished"
+        return "running" if self.future.running() else "queued"
+
+
+class JobManager:
+    """A class for running generation jobs in a process pool.
+
+    Each job gets an ID, reports per-stage progress through a shared queue and can be cancelled.
+    At most max_concurrent_jobs jobs run at once, the others wait in the pool queue.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_jobs: int = 2,
+    ) -> None:
+        self.executor = ProcessPoolExecutor(max_workers=max_concurrent_jobs)
+        self.manager = multiprocessing.Manager()
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+
+    def submit(
+        self,
+        fn: Callable[..., str],
+        name: str = "",
+        **kwargs,
+    ) -> str:
+        job_id = uuid.uuid4().hex[:8]
+        progress_queue = self.manager.Queue()
+        cancel_event = self.manager.Event()
+        future = self.executor.submit(
+            _run_job,
+            fn,
+            kwargs,
+            progress_queue,
+            cancel_event,
+            os.getpid(),
+        )
+        with self.lock:
+            self.jobs[job_id] = Job(
+                job_id=job_id,
+                name=name or fn.__name__,
+                future=future,
+                progress_queue=progress_queue,
+                cancel_event=cancel_event,
+            )
+        return job_id
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.future.done():
+            return False
+        # Queued jobs are dropped, running jobs stop at their next progress report, which long
+        # loops such as sample processing make before every item
+        job.cancel_event.set()
+        job.future.cancel()
+        return True
+
+    def poll(self, job_id: str) -> Dict[str, Any]:
+        job = self.jobs[job_id]
+        while True:
+            try:
+                job.progress = job.progress_queue.get_nowait()
+            except queue.Empty:
+                break
+        return {"job_id": job_id, "name": job.name, "state": job.state, **job.progress}
+
+    @staticmethod
+    def format_status(status: Dict[str, Any]) -> str:
+        msg = f"Job {status['job_id']} ({status['name']}): {status['state']}"
+        if status["state"] == "running" and status.get("stage"):
+            total = f"/{status['total']}" if status.get("total") is not None else ""
+            msg += (
+                f"\n\nStage: {status['stage']} - {status['done']}{total} "
+                f"({status['rate']:.1f} items/s)"
+            )
+        return msg
+
+    def stream(
+        self,
+        job_id: str,
+        interval: float = 0.5,
+    ) -> Iterator[str]:
+        job = self.jobs[job_id]
+        while not job.future.done():
+            yield self.format_status(self.poll(job_id))
+            time.sleep(interval)
+
+        if job.state == "cancelled":
+            msg = f"Job {job_id} ({job.name}): cancelled"
+        elif job.state == "failed":
+            msg = f"Something went wrong!\n\nError: {job.future.exception()}"
+        else:
+            msg = self.get_result(job_id)
+
+        # The result is delivered, so the job and its manager proxies are no longer needed
+        self.remove(job_id)
+        yield msg
+
+    def get_result(self, job_id: str) -> str:
+        job = self.jobs[job_id]
+        with self.lock:
+            if job.result is None:
+                job.result = collect_metrics(job.future.result())
+        return job.result
+
+    def remove(self, job_id: str) -> None:
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        statuses = []
+        for job_id in list(self.jobs):
+            try:
+                statuses.append(self.poll(job_id))
+            except KeyError:
+                # Removed after its result was delivered
+                continue
+        return statuses
+
+    def shutdown(self) -> None:
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.manager.shutdown()
+
+
+_job_manager: Optional[JobManager] = None
+
+
+def get_job_manager() -> JobManager:
+    # Created lazily so that worker processes importing the app do not start their own pools
+    global _job_manager
+    if _job_manager is None:
+        max_concurrent_jobs = int(os.environ.get("MAX_CONCURRENT_JOBS", 2))
+        _job_manager = JobManager(max_concurrent_jobs=max_concurrent_jobs)
+    return _job_manager
@@ -0,0 +1,126 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+from glob import glob
+from typing import Callable, Dict, List, Tuple
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+
+from src import PROJECT_DIR
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def get_tree_rss(pid: int) -> int:
+    # Linux only: the resident memory of a process and all of its descendants. Pages shared
+    # between forked workers are counted once per process, so this is an upper bound.
+    children: Dict[int, List[int]] = defaultdict(list)
+    for stat_path in glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat_path) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(stat_path.split("/")[2]))
+
+    total_rss = 0
+    pending = [pid]
+    while pending:
+        proc_id = pending.pop()
+        try:
+            with open(f"/proc/{proc_id}/statm") as f:
+                total_rss += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            continue
+        pending.extend(children[proc_id])
+    return total_rss
+
+
+def measure_run(
+    fn: Callable[[], None],
+    interval: float = 0.05,
+) -> Tuple[float, int]:
+    # Returns the elapsed time and the peak memory of the process tree sampled while fn runs
+    peak_rss = get_tree_rss(os.getpid())
+    stop_event = threading.Event()
+
+    def _sample() -> None:
+        nonlocal peak_rss
+        while not stop_event.wait(interval):
+            peak_rss = max(peak_rss, get_tree_rss(os.getpid()))
+
+    sampler = threading.Thread(target=_sample, daemon=True)
+    sampler.start()
+    start_time = time.perf_counter()
+    try:
+        fn()
+    finally:
+        elapsed_time = time.perf_counter() - start_time
+        stop_event.set()
+        sampler.join()
+    return elapsed_time, peak_rss
+
+
+@hydra.main(
+    config_path=os.path.join(PROJECT_DIR, "configs"),
+    config_name="benchmark_backends",
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f"Config:\n\n{OmegaConf.to_yaml(cfg)}")
+
+    from joblib.externals.loky import get_reusable_executor
+
+    from src.image_data.image_generator import ImageGenerator
+    from src.image_data.image_matcher import ImageMatcher
+    from src.utils import get_dir_list
+
+    sample_dirs = get_dir_list(
+        data_dir=str(os.path.join(PROJECT_DIR, cfg.data_dir)),
+        include_dirs=[cfg.sample] if cfg.sample else [],
+    )
+    if not sample_dirs:
+        raise ValueError(f"No sample found in {cfg.data_dir}")
+    sample_dir = sample_dirs[0]
+    matcher = ImageMatcher()
+    df = matcher.create_dataframe(
+        matcher.get_file_list(os.path.join(sample_dir, "layouts"), "layout*.[jpPJ][nNpP][gG]"),
+        matcher.get_file_list(
+            os.path.join(sample_dir, "backgrounds"),
+            "background*.[jpPJ][nNpP][gG]",
+        ),
+    )
+    log.info(f"Sample: {sample_dir} - Pairs: {len(df)} - Cores: {os.cpu_count()}")
+
+    save_dir = str(os.path.join(PROJECT_DIR, cfg.save_dir))
+    for backend in cfg.backends:
+        generator = ImageGenerator(
+            num_images_per_bg=cfg.num_images_per_bg,
+            scaling_factor=cfg.scaling_factor,
+            seed=cfg.seed,
+            backend=backend,
+            num_workers=cfg.num_workers,
+            threads_per_worker=cfg.threads_per_worker,
+        )
+        shutil.rmtree(save_dir, ignore_errors=True)
+        elapsed_time, peak_rss = measure_run(
+            lambda: generator.process_sample(df=df, sample_dir=sample_dir, save_dir=save_dir),
+        )
+        log.info(
+            f"{backend:<10} {elapsed_time:8.2f} s {len(df) / elapsed_time:8.2f} pairs/s "
+            f"{peak_rss / 2**20:10.1f} MB peak RSS",
+        )
+        # Idle pool workers would otherwise count towards the memory of the next backend
+        get_reusable_executor().shutdown(wait=True)
+
+    shutil.rmtree(save_dir, ignore_errors=True)
+    log.info("Complete")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import logging
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+
+from src import PROJECT_DIR
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def run_importtime(module: str) -> List[Tuple[str, int, int]]:
+    # Each run uses a fresh interpreter, so nothing is imported beforehand
+    env = {**os.environ, "PYTHONPATH": PROJECT_DIR}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PROJECT_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative_time, name = line[len("import time:") :].split("|")
+        entries.append((name.strip(), int(self_time), int(cumulative_time)))
+    return entries
+
+
+def summarize_imports(entries: List[Tuple[str, int, int]]) -> Dict[str, int]:
+    # Self times summed per top-level package add up to the total import time
+    package_times: Dict[str, int] = defaultdict(int)
+    for name, self_time, _ in entries:
+        package_times[name.split(".")[0]] += self_time
+    return dict(package_times)
+
+
+def benchmark_module(
+    module: str,
+    num_runs: int,
+    top_n: int,
+    deferred_packages: List[str],
+) -> float:
+    runs = [run_importtime(module) for _ in range(num_runs)]
+    total_times = [entries[-1][2] for entries in runs]
+    median_run = runs[total_times.index(sorted(total_times)[len(total_times) // 2])]
+    total_time = statistics.median(total_times) / 1000
+
+    log.info("")
+    log.info(f"{module}: {total_time:.0f} ms (median of {num_runs} runs)")
+    package_times = summarize_imports(median_run)
+    top_packages = sorted(package_times.items(), key=lambda item: item[1], reverse=True)
+    for package, package_time in top_packages[:top_n]:
+        log.info(f"  {package:<24} {package_time / 1000:8.1f} ms")
+
+    imported_deferred = [package for package in deferred_packages if package in package_times]
+    if imported_deferred:
+        log.warning(f"  Deferred packages imported at startup: {', '.join(imported_deferred)}")
+    return total_time
+
+
+@hydra.main(
+    config_path=os.path.join(PROJECT_DIR, "configs"),
+    config_name="benchmark_imports",
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f"Config:\n\n{OmegaConf.to_yaml(cfg)}")
+
+    for module in cfg.modules:
+        benchmark_module(
+            module=module,
+            num_runs=cfg.num_runs,
+            top_n=cfg.top_n,
+            deferred_packages=list(cfg.deferred_packages),
+        )
+
+    log.info("Complete")
+
+
+if __name__ == "__main__":
+    main()
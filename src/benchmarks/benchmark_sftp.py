@@ -0,0 +1,150 @@
+import logging
+import os
+import posixpath
+import shutil
+import time
+from typing import Callable, Dict, List, Tuple
+
+import hydra
+import numpy as np
+from omegaconf import DictConfig, OmegaConf
+
+from src import PROJECT_DIR
+from src.benchmarks.sftp_server import LocalSFTPServer
+from src.text_data.ssh_file_transfer import SSHFileTransfer
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def create_test_files(
+    save_dir: str,
+    num_files: int,
+    file_size_mb: float,
+    seed: int = 11,
+) -> List[str]:
+    # Random bytes are incompressible, similar to PNG mockups
+    os.makedirs(save_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    file_paths = []
+    for file_idx in range(num_files):
+        file_path = os.path.join(save_dir, f"file_{file_idx:03d}.bin")
+        rng.integers(0, 256, int(file_size_mb * 2**20), dtype=np.uint8).tofile(file_path)
+        file_paths.append(file_path)
+    return file_paths
+
+
+def measure_throughput(
+    name: str,
+    fn: Callable[[], None],
+    total_bytes: int,
+) -> Dict[str, float]:
+    start_time = time.perf_counter()
+    fn()
+    elapsed_time = time.perf_counter() - start_time
+    throughput = total_bytes / 2**20 / elapsed_time
+    log.info(f"{name:<28} {elapsed_time:8.2f} s {throughput:10.2f} MB/s")
+    return {"elapsed_time": elapsed_time, "throughput": throughput}
+
+
+def run_benchmark(
+    cfg: DictConfig,
+    credentials: Tuple[str, str, int, str],
+    remote_dir: str,
+    local_paths: List[str],
+) -> None:
+    hostname, username, port, password = credentials
+    total_bytes = sum(os.path.getsize(local_path) for local_path in local_paths)
+    jobs = [
+        (local_path, posixpath.join(remote_dir, os.path.basename(local_path)))
+        for local_path in local_paths
+    ]
+    download_dir = os.path.join(os.path.dirname(local_paths[0]), "downloads")
+    os.makedirs(download_dir, exist_ok=True)
+
+    # Default paramiko settings with serial put/get calls
+    baseline = SSHFileTransfer(username, hostname, port, password, url="")
+    baseline.connect()
+    baseline.create_remote_dirs([remote_dir])
+    measure_throughput(
+        "Upload (default, serial)",
+        lambda: [baseline.sftp.put(local_path, remote_path) for local_path, remote_path in jobs],
+        total_bytes,
+    )
+    measure_throughput(
+        "Download (no prefetch)",
+        lambda: [
+            baseline.sftp.get(remote_path, os.path.join(download_dir, f"{idx}.bin"), prefetch=False)
+            for idx, (_, remote_path) in enumerate(jobs)
+        ],
+        total_bytes,
+    )
+    baseline.disconnect()
+
+    # Large windows, pipelined writes, prefetched reads and a pool of channels
+    tuned = SSHFileTransfer(
+        username,
+        hostname,
+        port,
+        password,
+        url="",
+        window_size=cfg.window_size,
+        max_packet_size=cfg.max_packet_size,
+        chunk_size=cfg.chunk_size,
+        compress=cfg.compress,
+    )
+    tuned.connect()
+    measure_throughput(
+        "Upload (pipelined, serial)",
+        lambda: [tuned.upload_file(local_path, remote_path) for local_path, remote_path in jobs],
+        total_bytes,
+    )
+    measure_throughput(
+        f"Upload (pipelined, {cfg.num_workers} workers)",
+        lambda: tuned.upload_files(jobs, num_workers=cfg.num_workers),
+        total_bytes,
+    )
+    measure_throughput(
+        "Download (prefetch)",
+        lambda: [
+            tuned.download_file(remote_path, os.path.join(download_dir, f"{idx}.bin"))
+            for idx, (_, remote_path) in enumerate(jobs)
+        ],
+        total_bytes,
+    )
+    tuned.remove_remote_dir(remote_dir)
+    tuned.disconnect()
+
+
+@hydra.main(
+    config_path=os.path.join(PROJECT_DIR, "configs"),
+    config_name="benchmark_sftp",
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f"Config:\n\n{OmegaConf.to_yaml(cfg)}")
+
+    save_dir = str(os.path.join(PROJECT_DIR, cfg.save_dir))
+    local_paths = create_test_files(
+        save_dir=os.path.join(save_dir, "local"),
+        num_files=cfg.num_files,
+        file_size_mb=cfg.file_size_mb,
+    )
+
+    if cfg.use_local_server:
+        with LocalSFTPServer() as server:
+            credentials = ("127.0.0.1", server.username, server.port, server.password)
+            run_benchmark(cfg, credentials, os.path.join(save_dir, "remote"), local_paths)
+    else:
+        from src.generate_csv_files import load_credentials
+
+        HOSTNAME, USERNAME, PASSWORD, PORT, REMOTE_ROOT_DIR, _ = load_credentials()
+        credentials = (HOSTNAME, USERNAME, PORT, PASSWORD)
+        run_benchmark(cfg, credentials, posixpath.join(REMOTE_ROOT_DIR, "benchmark"), local_paths)
+
+    shutil.rmtree(save_dir, ignore_errors=True)
+    log.info("Complete")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import functools
+import logging
+import os
+import socket
+import subprocess
+import threading
+from typing import Callable, List, Optional
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+from paramiko.sftp import SFTP_OK
+
+log = logging.getLogger(__name__)
+
+
+class _LocalSFTPHandle(SFTPHandle):
+    def stat(self) -> SFTPAttributes:
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr: SFTPAttributes) -> int:
+        return SFTP_OK
+
+
+def _convert_os_errors(method: Callable) -> Callable:
+    # Report filesystem errors as SFTP status codes, like a real server does
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    return wrapper
+
+
+class _LocalSFTPInterface(SFTPServerInterface):
+    """SFTP operations served directly from the local filesystem."""
+
+    @_convert_os_errors
+    def list_folder(self, path: str) -> List[SFTPAttributes]:
+        entries = []
+        for filename in os.listdir(path):
+            attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, filename)))
+            attr.filename = filename
+            entries.append(attr)
+        return entries
+
+    @_convert_os_errors
+    def stat(self, path: str) -> SFTPAttributes:
+        return SFTPAttributes.from_stat(os.stat(path))
+
+    @_convert_os_errors
+    def lstat(self, path: str) -> SFTPAttributes:
+        return SFTPAttributes.from_stat(os.lstat(path))
+
+    @_convert_os_errors
+    def open(self, path: str, flags: int, attr: SFTPAttributes) -> _LocalSFTPHandle:
+        fd = os.open(path, flags, 0o644)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    @_convert_os_errors
+    def remove(self, path: str) -> int:
+        os.remove(path)
+        return SFTP_OK
+
+    @_convert_os_errors
+    def rename(self, oldpath: str, newpath: str) -> int:
+        os.rename(oldpath, newpath)
+        return SFTP_OK
+
+    @_convert_os_errors
+    def posix_rename(self, oldpath: str, newpath: str) -> int:
+        os.replace(oldpath, newpath)
+        return SFTP_OK
+
+    @_convert_os_errors
+    def mkdir(self, path: str, attr: SFTPAttributes) -> int:
+        os.mkdir(path)
+        return SFTP_OK
+
+    @_convert_os_errors
+    def rmdir(self, path: str) -> int:
+        os.rmdir(path)
+        return SFTP_OK
+
+    @_convert_os_errors
+    def chattr(self, path: str, attr: SFTPAttributes) -> int:
+        if attr.st_mtime is not None:
+            os.utime(path, (attr.st_atime, attr.st_mtime))
+        return SFTP_OK
+
+    def canonicalize(self, path: str) -> str:
+        return os.path.abspath(path)
+
+
+class _LocalSSHInterface(paramiko.ServerInterface):
+    def __init__(self, username: str, password: str) -> None:
+        self.username = username
+        self.password = password
+
+    def get_allowed_auths(self, username: str) -> str:
+        return "password"
+
+    def check_auth_password(self, username: str, password: str) -> int:
+        if username == self.username and password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind: str, chanid: int) -> int:
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel: paramiko.Channel, command: bytes) -> bool:
+        def _run() -> None:
+            result = subprocess.run(command.decode("utf-8"), shell=True, capture_output=True)
+            channel.sendall(result.stdout)
+            channel.sendall_stderr(result.stderr)
+            channel.send_exit_status(result.returncode)
+            channel.close()
+
+        threading.Thread(target=_run, daemon=True).start()
+        return True
+
+
+class LocalSFTPServer:
+    """A paramiko stand-in for the remote host used to benchmark transfers offline.
+
+    The server listens on localhost only, serves SFTP from the local filesystem and runs exec
+    requests in a local shell, which covers everything SSHFileTransfer needs from a server.
+    """
+
+    def __init__(
+        self,
+        username: str = "atriel",
+        password: str = "atriel",
+        port: int = 0,
+    ) -> None:
+        self.username = username
+        self.password = password
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.port = self.sock.getsockname()[1]
+        self.transports: List[paramiko.Transport] = []
+        self.thread: Optional[threading.Thread] = None
+
+    def _serve(self) -> None:
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, _LocalSFTPInterface)
+            transport.start_server(server=_LocalSSHInterface(self.username, self.password))
+            self.transports.append(transport)
+
+    def start(self) -> "LocalSFTPServer":
+        self.sock.listen(16)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+        log.info(f"Local SFTP server listening on 127.0.0.1:{self.port}")
+        return self
+
+    def stop(self) -> None:
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+    def __enter__(self) -> "LocalSFTPServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
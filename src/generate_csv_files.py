@@ -1,22 +1,43 @@
 import datetime
 import logging
 import os
-from glob import glob
-from pathlib import Path
-from typing import Dict, List, Tuple
+import posixpath
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import hydra
 import pandas as pd
 from dotenv import load_dotenv
+from hydra.core.hydra_config import HydraConfig
 from omegaconf import DictConfig, OmegaConf
-from tqdm import tqdm
 
 from src import PROJECT_DIR
+from src.metrics import get_metrics, get_report_path
+from src.text_data.pin_index import PinIndex
 from src.text_data.publish_date_generator import PublishDateGenerator
-from src.text_data.sample_processor import SampleProcessor
-from src.text_data.ssh_file_transfer import SSHFileTransfer
 from src.utils import CSV_COLUMNS
 
+# paramiko and cv2 are only imported when uploading or creating derivatives
+if TYPE_CHECKING:
+    import paramiko
+
+    from src.text_data.ssh_file_transfer import SSHFileTransfer
+    from src.text_data.upload_journal import UploadJournal
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
@@ -111,7 +132,14 @@ def verify_pin_availability(
     pins_available_per_category = {}
     for category in pins_per_day:
         pins_available_per_category[category] = df[df["category"] == category].shape[0]
+    verify_pin_counts(pins_available_per_category, pins_per_day, num_days)
+
 
+def verify_pin_counts(
+    pins_available_per_category: Dict[str, int],
+    pins_per_day: Dict[str, int],
+    num_days: int,
+) -> None:
     pins_needed_per_category = {}
     for category, num_pins in pins_per_day.items():
         pins_needed_per_category[category] = num_pins * num_days
@@ -134,36 +162,270 @@ def verify_pin_availability(
     log.info("All pins for each category are available.")
 
 
+def _write_file_atomic(
+    write_fn: Callable[[str], None],
+    file_path: str,
+) -> None:
+    # Write to a temporary file first so that a partially written file is never picked up
+    tmp_path = f"{file_path}.tmp"
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_archive(
+    csv_paths: List[str],
+    archive_path: str,
+) -> None:
+    with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for csv_path in csv_paths:
+            archive.write(csv_path, arcname=os.path.basename(csv_path))
+
+
+def get_csv_path(
+    date: datetime.date,
+    save_dir: str,
+) -> str:
+    # Filename based on the formatted date, e.g. pins-may-25.csv
+    formatted_date = date.strftime("%b-%d").lower()
+    return os.path.join(save_dir, f"pins-{formatted_date}.csv")
+
+
+def _save_csv_chunk(
+    df_chunk: pd.DataFrame,
+    csv_filepath: str,
+) -> str:
+    _write_file_atomic(
+        lambda path: df_chunk.to_csv(path, index=False, encoding="utf-8"),
+        csv_filepath,
+    )
+    get_metrics().inc("csv.files_written")
+    get_metrics().inc("bytes.written", os.path.getsize(csv_filepath))
+    return csv_filepath
+
+
 def save_csv_files(
     df: pd.DataFrame,
     save_dir: str,
-) -> None:
+    num_workers: int = 1,
+    archive_path: Optional[str] = None,
+) -> List[str]:
     os.makedirs(save_dir, exist_ok=True)
 
-    # Create a new column 'Auxiliary date' by converting 'Publish date' column to datetime
-    df["Auxiliary date"] = pd.to_datetime(df["Publish date"])
+    # Group rows by publish date in a single pass, keeping the order in which days appear
+    publish_dates = pd.to_datetime(df["Publish date"]).dt.date
+    csv_jobs = []
+    for date, df_chunk in df.groupby(publish_dates, sort=False):
+        csv_jobs.append((df_chunk, get_csv_path(date, save_dir)))
+
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        csv_paths = list(executor.map(lambda job: _save_csv_chunk(*job), csv_jobs))
+
+    # Optionally bundle all day files into a single compressed archive
+    if archive_path:
+        _write_file_atomic(lambda path: _write_archive(csv_paths, path), archive_path)
+
+    return csv_paths
+
+
+def _set_publish_dates(
+    df_day: pd.DataFrame,
+    date: datetime.datetime,
+    seed: int,
+    overflow_step: int = 0,
+    jitter: int = 0,
+) -> pd.DataFrame:
+    publish_date_generator = PublishDateGenerator(date=date)
+    df_day["Publish date"] = publish_date_generator.generate_schedule(
+        pins_per_day=[len(df_day)],
+        overflow_step=overflow_step,
+        jitter=jitter,
+        seed=seed,
+    )
+    return df_day
 
-    # Split DataFrame into chunks and save each chunk to a separate CSV file
-    unique_dates = df["Auxiliary date"].dt.date.unique()
-    for date in unique_dates:
-        df_chunk = df[df["Auxiliary date"].dt.date == date]
 
-        # Get the formatted date for the CSV filename
-        formatted_date = date.strftime("%b-%d").lower()
+def schedule_days(
+    df: pd.DataFrame,
+    pins_per_day: Dict[str, int],
+    num_days: int,
+    start_date: datetime.datetime,
+    seed: int = 11,
+    overflow_step: int = 0,
+    jitter: int = 0,
+) -> Iterator[pd.DataFrame]:
+    # Yield each day as soon as its pins and publish dates are planned
+    df_remaining = df.copy()
+    for day_idx in range(num_days):
+        df_day, df_remaining = create_df_per_day(
+            df=df_remaining,
+            pins_per_day=pins_per_day,
+            seed=seed,
+        )
+        yield _set_publish_dates(
+            df_day=df_day,
+            date=start_date + datetime.timedelta(days=day_idx),
+            seed=seed + day_idx,
+            overflow_step=overflow_step,
+            jitter=jitter,
+        )
 
-        # Drop the 'Auxiliary date' column
-        df_chunk = df_chunk.drop(columns=["Auxiliary date"])
 
-        # Save chunk to CSV with filename based on the formatted date
-        csv_filename = f"pins-{formatted_date}.csv"
-        csv_filepath = os.path.join(save_dir, csv_filename)
-        df_chunk.to_csv(
-            csv_filepath,
-            index=False,
-            encoding="utf-8",
+def schedule_days_from_index(
+    pin_index: PinIndex,
+    pins_per_day: Dict[str, int],
+    num_days: int,
+    start_date: datetime.datetime,
+    seed: int = 11,
+    overflow_step: int = 0,
+    jitter: int = 0,
+) -> Iterator[pd.DataFrame]:
+    """Plan days from the pins of the index that were not published before start_date.
+
+    Each category is read once in index order across all days, every day continues where the
+    previous one stopped, so a day costs a few rows per category instead of a pass over the whole
+    catalog. Links stay unique within a day, as in create_df_per_day, and pins skipped for a
+    repeated link are kept for the following days.
+    """
+    before_date = start_date.strftime("%Y-%m-%d")
+    pin_iters = {
+        category: pin_index.iter_unpublished(category, before_date=before_date)
+        for category in pins_per_day
+    }
+    # Pins skipped for a repeated link precede the unread ones in index order
+    deferred_rows: Dict[str, Deque[pd.Series]] = {category: deque() for category in pins_per_day}
+    for day_idx in range(num_days):
+        unique_links: Set[str] = set()
+        day_rows = []
+        for category, num_pins in pins_per_day.items():
+            pending = deferred_rows[category]
+            skipped_rows = []
+            num_added = 0
+            while num_added < num_pins:
+                row = pending.popleft() if pending else next(pin_iters[category], None)
+                if row is None:
+                    break
+                if row["Link"] in unique_links:
+                    skipped_rows.append(row)
+                    continue
+                day_rows.append(row)
+                unique_links.add(row["Link"])
+                num_added += 1
+            pending.extendleft(reversed(skipped_rows))
+
+        df_day = pd.DataFrame(day_rows).sample(frac=1, random_state=seed + day_idx)
+        yield _set_publish_dates(
+            df_day=df_day.reset_index(drop=True),
+            date=start_date + datetime.timedelta(days=day_idx),
+            seed=seed + day_idx,
+            overflow_step=overflow_step,
+            jitter=jitter,
         )
 
 
+def get_upload_jobs(df: pd.DataFrame) -> List[Tuple[str, str]]:
+    # With derivatives, the web-optimized media and thumbnails are uploaded instead of the sources
+    if "media_path" not in df.columns:
+        return list(zip(df.src_path, df.dst_path))
+    return list(zip(df.media_path, df.dst_path)) + list(
+        zip(df.thumbnail_path, df.thumbnail_dst_path),
+    )
+
+
+def stream_days_to_server(
+    days: Iterable[pd.DataFrame],
+    ssh_file_transfer: "SSHFileTransfer",
+    save_dir: str,
+    remote_files: Optional[Dict[str, "paramiko.SFTPAttributes"]] = None,
+    journal: Optional["UploadJournal"] = None,
+    callback: Optional[Callable[[str, str, bool], None]] = None,
+    **upload_kwargs,
+) -> Tuple[List[pd.DataFrame], List[str]]:
+    """Upload images of each day while later days are still being planned.
+
+    A day's CSV file is saved as soon as all of its uploads are confirmed.
+
+    Args:
+        days: DataFrames with the pins of each day, typically produced lazily by schedule_days.
+        ssh_file_transfer: Connected SSHFileTransfer instance.
+        save_dir: Directory where the CSV files are saved.
+        remote_files: Listing of the remote tree. If given, up-to-date images are not uploaded.
+        journal: Journal of completed uploads. If given, journaled images are not uploaded
+            again and new uploads are recorded in it.
+        callback: Function called with (local_path, remote_path, success) after each upload.
+        **upload_kwargs: Keyword arguments passed to SSHFileTransfer.upload_files.
+
+    Returns:
+        DataFrames of the days whose images were all uploaded and their CSV paths. Days with
+        failed uploads get no CSV file, so a partial run never references missing images.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    lock = threading.Lock()
+    day_frames: Dict[int, pd.DataFrame] = {}
+    pending_uploads: Dict[int, int] = {}
+    remote_path_to_day: Dict[str, int] = {}
+    failed_days: Set[int] = set()
+    saved_days: Dict[int, str] = {}
+
+    def _finish_day(day_idx: int) -> None:
+        df_day = day_frames[day_idx]
+        if day_idx in failed_days:
+            log.warning(f"Skipping CSV for {df_day['Publish date'].iloc[0][:10]}: failed uploads")
+            return
+        date = pd.to_datetime(df_day["Publish date"].iloc[0]).date()
+        csv_path = _save_csv_chunk(df_day[CSV_COLUMNS], get_csv_path(date, save_dir))
+        with lock:
+            saved_days[day_idx] = csv_path
+
+    def _on_upload(local_path: str, remote_path: str, success: bool) -> None:
+        with lock:
+            day_idx = remote_path_to_day[remote_path]
+            if not success:
+                failed_days.add(day_idx)
+            pending_uploads[day_idx] -= 1
+            is_day_complete = pending_uploads[day_idx] == 0
+        if is_day_complete:
+            _finish_day(day_idx)
+        if callback is not None:
+            callback(local_path, remote_path, success)
+
+    def _is_uploaded(src_path: str, dst_path: str) -> bool:
+        if journal is not None and journal.is_completed(src_path, dst_path):
+            return True
+        if remote_files is not None:
+            return ssh_file_transfer.is_up_to_date(src_path, dst_path, remote_files)
+        return False
+
+    def _iter_jobs() -> Iterator[Tuple[str, str]]:
+        for day_idx, df_day in enumerate(days):
+            jobs = [
+                (src_path, dst_path)
+                for src_path, dst_path in get_upload_jobs(df_day)
+                if not _is_uploaded(src_path, dst_path)
+            ]
+            ssh_file_transfer.create_remote_dirs(posixpath.dirname(path) for _, path in jobs)
+            with lock:
+                day_frames[day_idx] = df_day
+                pending_uploads[day_idx] = len(jobs)
+                remote_path_to_day.update((dst_path, day_idx) for _, dst_path in jobs)
+            if not jobs:
+                _finish_day(day_idx)
+            yield from jobs
+
+    ssh_file_transfer.upload_files(
+        _iter_jobs(),
+        callback=_on_upload,
+        journal=journal,
+        **upload_kwargs,
+    )
+
+    day_indices = sorted(saved_days)
+    return [day_frames[idx] for idx in day_indices], [saved_days[idx] for idx in day_indices]
+
+
 @hydra.main(
     config_path=os.path.join(PROJECT_DIR, "configs"),
     config_name="generate_csv_files",
@@ -172,88 +434,19 @@ def save_csv_files(
 def main(cfg: DictConfig) -> None:
     log.info(f"Config:\n\n{OmegaConf.to_yaml(cfg)}")
 
-    # Define absolute paths
-    data_dir = str(os.path.join(PROJECT_DIR, cfg.data_dir))
-    save_dir = str(os.path.join(PROJECT_DIR, cfg.save_dir))
-
-    # Load credentials
-    HOSTNAME, USERNAME, PASSWORD, PORT, REMOTE_ROOT_DIR, URL = load_credentials()
+    # Stages are imported here since they depend on this module
+    from src.pipeline.stages import build_pipeline
 
-    # Get list of sample paths to process
-    sample_dirs_ = glob(os.path.join(data_dir, "*/*"))
-    sample_dirs = filter_paths_by_category(sample_dirs_, cfg.pins_per_day)
-
-    # Process samples by their paths
-    sample_processor = SampleProcessor(
-        url=URL,
-        remote_root_dir=REMOTE_ROOT_DIR,
-        column_names=CSV_COLUMNS,
-    )
-    df_list = []
-    for sample_dir in tqdm(sample_dirs, desc="Processing samples", unit="samples"):
-        df_ = sample_processor.process_sample(sample_dir)
-        df_list.append(df_)
-    df_all = pd.concat(df_list, ignore_index=True)
-    df = df_all.drop_duplicates(subset=["Title"], keep="first")
-
-    # Check if there is enough samples for each category
-    verify_pin_availability(df, cfg.pins_per_day, num_days=cfg.num_days)
-
-    # Create df_day_list with DataFrames representing pins for each day
-    df_day_list = []
-    df_remaining = df.copy()
-    for _ in range(cfg.num_days):
-        df_day, df_remaining = create_df_per_day(
-            df=df_remaining,
-            pins_per_day=cfg.pins_per_day,
-            seed=cfg.seed,
-        )
-        df_day_list.append(df_day)
-
-    # Add publish dates to the dataframe
-    current_date = datetime.datetime.strptime(cfg.start_date, "%Y-%m-%d")
-    for day_idx, df_day in enumerate(df_day_list):
-        publish_date_generator = PublishDateGenerator(date=current_date)
-        publish_date_list = publish_date_generator.generate_times(num_pins_per_day=len(df_day))
-        df_day["Publish date"] = publish_date_list
-        df_day_list[day_idx] = df_day
-        current_date += datetime.timedelta(days=1)
-
-    # Upload images to the remote server
-    df_out = pd.concat(df_day_list, ignore_index=True)
-    if cfg.copy_files_to_server:
-        ssh_file_transfer = SSHFileTransfer(
-            username=USERNAME,
-            hostname=HOSTNAME,
-            port=PORT,
-            password=PASSWORD,
-            url=URL,
-        )
-        ssh_file_transfer.connect()
-        ssh_file_transfer.remove_remote_dir(os.path.join(REMOTE_ROOT_DIR, "*"))
-        for row in tqdm(df_out.itertuples(), desc="Uploading images", unit="images"):
-            remote_dir = str(Path(row.dst_path).parent)
-            ssh_file_transfer.create_remote_dir(remote_dir)
-            ssh_file_transfer.upload_file(
-                local_path=row.src_path,
-                remote_path=row.dst_path,
-            )
-        ssh_file_transfer.disconnect()
-
-    # Remove local files
-    if cfg.remove_local_files:
-        for row in df_out.itertuples():
-            os.remove(row.src_path)
-
-    # Save final CSVs
-    df_out = df_out[CSV_COLUMNS]
-    save_csv_files(
-        df=df_out,
-        save_dir=save_dir,
+    # Run the CSV branch of the pipeline, unchanged stages are read from the cache
+    pipeline = build_pipeline(
+        csv_cfg=cfg,
+        cache_dir=cfg.pipeline_cache_dir,
     )
+    artifacts = pipeline.run()
+    df_out = pd.concat(artifacts["upload"], ignore_index=True)
 
     # Log summary
-    total_pins = len(df_all)
+    total_pins = len(artifacts["text_metadata"])
     num_saved_pins = len(df_out)
     num_products = len(df_out["Link"].unique())
     log.info("")
@@ -261,6 +454,10 @@ def main(cfg: DictConfig) -> None:
     log.info(f"Saved pins: {num_saved_pins}")
     log.info(f"Products advertised: {num_products}")
 
+    # Save the run report next to the Hydra log
+    report_path = get_metrics().save_report(get_report_path(HydraConfig.get().runtime.output_dir))
+    log.info(f"Run report: {report_path}")
+
     log.info("Complete")
 
 
@@ -2,13 +2,11 @@ import logging
 import os
 
 import hydra
+from hydra.core.hydra_config import HydraConfig
 from omegaconf import DictConfig, OmegaConf
-from tqdm import tqdm
 
 from src import PROJECT_DIR
-from src.image_data.image_generator import ImageGenerator
-from src.image_data.image_matcher import ImageMatcher
-from src.utils import get_dir_list
+from src.metrics import get_metrics, get_report_path
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -22,37 +20,21 @@ log.setLevel(logging.INFO)
 def main(cfg: DictConfig) -> None:
     log.info(f"Config:\n\n{OmegaConf.to_yaml(cfg)}")
 
-    # Define absolute paths
-    data_dir = str(os.path.join(PROJECT_DIR, cfg.data_dir))
-    save_dir = str(os.path.join(PROJECT_DIR, cfg.save_dir))
+    # Imported here so that config errors and --help do not wait for cv2 and pandas
+    from src.pipeline.stages import build_pipeline
 
-    # Get list of sample_dirs to process
-    sample_dirs = get_dir_list(
-        data_dir=data_dir,
-        include_dirs=cfg.include_samples,
-        exclude_dirs=cfg.exclude_samples,
+    # Run the image branch of the pipeline, samples whose inputs did not change are skipped
+    pipeline = build_pipeline(
+        images_cfg=cfg,
+        cache_dir=cfg.pipeline_cache_dir,
     )
+    pipeline.run(targets=["layout_report"] if cfg.preflight_only else None)
 
-    # Initialize ImageMatcher and ImageGenerator instances
-    matcher = ImageMatcher()
-    generator = ImageGenerator(
-        num_images_per_bg=cfg.num_images_per_bg,
-        scaling_factor=cfg.scaling_factor,
-        seed=cfg.seed,
-    )
+    # Save the run report next to the Hydra log
+    report_path = get_metrics().save_report(get_report_path(HydraConfig.get().runtime.output_dir))
+    log.info(f"Run report: {report_path}")
 
-    # Process samples sequentially
-    for sample_dir in tqdm(sample_dirs, desc="Creating images", unit="samples"):
-        layout_dir = os.path.join(sample_dir, "layouts")
-        bg_dir = os.path.join(sample_dir, "backgrounds")
-        layout_paths = matcher.get_file_list(layout_dir, "layout*.[jpPJ][nNpP][gG]")
-        bg_paths = matcher.get_file_list(bg_dir, "background*.[jpPJ][nNpP][gG]")
-        df = matcher.create_dataframe(layout_paths, bg_paths)
-        generator.process_sample(
-            df=df,
-            sample_dir=sample_dir,
-            save_dir=save_dir,
-        )
+    log.info("Complete")
 
 
 if __name__ == "__main__":
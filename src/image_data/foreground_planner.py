@@ -0,0 +1,140 @@
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class ForegroundPlanner:
+    """A class for assigning foreground images to the slots of all composites of a sample.
+
+    Foregrounds are dealt from a deck made of consecutive random permutations of the pool, so
+    after any number of composites the usage counts of all images differ by at most one. When the
+    pool has at least as many images as a layout has slots, no composite repeats an image: the
+    images left over for a composite that straddles two permutations are moved to the end of
+    the next one. Smaller pools are reused as evenly as possible.
+
+    Within each composite the images are then ordered to balance the (slot, image) pairings of
+    its layout, so every image is spread over the slot positions instead of landing in the same
+    slot again and again.
+    """
+
+    def __init__(
+        self,
+        num_foregrounds: int,
+        seed: int,
+    ) -> None:
+        if num_foregrounds < 1:
+            raise ValueError("No foreground images to assign")
+        self.num_foregrounds = num_foregrounds
+        self.rng = np.random.default_rng(seed)
+
+    def _deal(
+        self,
+        num_slots: np.ndarray,
+    ) -> np.ndarray:
+        row_ends = np.cumsum(num_slots)
+        total = int(row_ends[-1]) if len(row_ends) else 0
+
+        cycles = []
+        tail = np.empty(0, dtype=np.int64)
+        num_dealt = 0
+        while num_dealt < total:
+            if len(tail):
+                head = self.rng.permutation(np.setdiff1d(np.arange(self.num_foregrounds), tail))
+                cycle = np.concatenate([head, self.rng.permutation(tail)])
+            else:
+                cycle = self.rng.permutation(self.num_foregrounds)
+            cycles.append(cycle)
+            num_dealt += len(cycle)
+
+            # The images of a composite cut by the end of this cycle must not start the next one,
+            # unless the composite has more slots than the pool and repeats images anyway
+            row_idx = np.searchsorted(row_ends, num_dealt, side="right")
+            num_straddling = 0
+            if row_idx < len(row_ends) and num_slots[row_idx] <= self.num_foregrounds:
+                row_start = row_ends[row_idx - 1] if row_idx > 0 else 0
+                num_straddling = num_dealt - row_start
+            tail = cycle[len(cycle) - num_straddling :]
+
+        return np.concatenate(cycles)[:total] if cycles else np.empty(0, dtype=np.int64)
+
+    def _arrange(
+        self,
+        rows: np.ndarray,
+        pair_counts: np.ndarray,
+    ) -> np.ndarray:
+        # Greedy assignment run on all rows at once: each step places, in every row, the image
+        # and free slot whose (slot, image) pairing has been used the least so far
+        num_rows, size = rows.shape
+        costs = pair_counts[rows] + self.rng.random((num_rows, size, size)) * 0.5
+        arranged = np.empty_like(rows)
+        row_ids = np.arange(num_rows)
+        for _ in range(size):
+            flat_idx = np.argmin(costs.reshape(num_rows, -1), axis=1)
+            element_idx, slot_idx = np.divmod(flat_idx, size)
+            arranged[row_ids, slot_idx] = rows[row_ids, element_idx]
+            costs[row_ids, element_idx, :] = np.inf
+            costs[row_ids, :, slot_idx] = np.inf
+        np.add.at(pair_counts, (arranged, np.arange(size)), 1)
+        return arranged
+
+    def plan(
+        self,
+        num_slots: List[int],
+        layout_ids: Optional[List[str]] = None,
+    ) -> List[np.ndarray]:
+        """Plan the foregrounds of a sequence of composites.
+
+        Args:
+            num_slots: The number of layout slots of every composite.
+            layout_ids: The layout of every composite, (slot, image) pairings are balanced per
+                layout. By default, composites with the same number of slots share a layout.
+
+        Returns:
+            For every composite, the indices of the foreground images in slot order.
+        """
+        num_slots_array = np.asarray(num_slots, dtype=np.int64)
+        deck = self._deal(num_slots_array)
+        row_starts = np.concatenate([[0], np.cumsum(num_slots_array)[:-1]]).astype(np.int64)
+        if layout_ids is None:
+            layout_ids = [str(size) for size in num_slots]
+
+        # Composites of a wave are arranged at once, waves are about one permutation long so
+        # their images rarely overlap
+        wave_size = max(1, self.num_foregrounds // max(int(num_slots_array.max(initial=1)), 1))
+        plans: List[np.ndarray] = [np.empty(0, dtype=np.int64)] * len(num_slots_array)
+        layout_rows: Dict[str, List[int]] = defaultdict(list)
+        for row_id, layout_id in enumerate(layout_ids):
+            layout_rows[layout_id].append(row_id)
+        for row_ids in layout_rows.values():
+            size = int(num_slots_array[row_ids[0]])
+            if size == 0:
+                continue
+            pair_counts = np.zeros((self.num_foregrounds, size), dtype=np.float64)
+            for wave_start in range(0, len(row_ids), wave_size):
+                wave_ids = np.asarray(row_ids[wave_start : wave_start + wave_size])
+                rows = deck[row_starts[wave_ids, None] + np.arange(size)]
+                for row_id, row in zip(wave_ids, self._arrange(rows, pair_counts)):
+                    plans[row_id] = row
+        return plans
+
+
+if __name__ == "__main__":
+    # Test ForegroundPlanner class
+    planner = ForegroundPlanner(num_foregrounds=10, seed=11)
+    plans = planner.plan([4] * 6 + [9] * 3)
+    for plan in plans:
+        print(plan)
+    print("Usage counts:", np.bincount(np.concatenate(plans), minlength=10))
+
+    # Composites that fit the pool never repeat an image, whatever the other layouts of the sample
+    rng = np.random.default_rng(0)
+    for seed in range(200):
+        num_foregrounds = int(rng.integers(1, 15))
+        num_slots = rng.integers(1, 20, size=int(rng.integers(1, 30))).tolist()
+        plans = ForegroundPlanner(num_foregrounds, seed=seed).plan(num_slots)
+        usage = np.bincount(np.concatenate(plans), minlength=num_foregrounds)
+        assert usage.max() - usage.min() <= 1, "Unbalanced usage"
+        for size, plan in zip(num_slots, plans):
+            assert size > num_foregrounds or len(set(plan.tolist())) == size, "Repeated image"
+    print("Mixed layouts: no repeats within composites that fit the pool")
@@ -1,8 +1,9 @@
 import fnmatch
+import functools
 import os
-import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import cv2
 import numpy as np
@@ -10,19 +11,46 @@ import pandas as pd
 from joblib import Parallel, delayed
 from tqdm.auto import tqdm
 
+from src.image_data.foreground_planner import ForegroundPlanner
+from src.image_data.variant_cache import VariantCache
+from src.metrics import collect_metrics, get_metrics, run_with_metrics
+
+BoundingBox = Tuple[int, int, int, int]  # x, y, width, height
+
 
 class ImageGenerator:
-    """Class for generating images."""
+    """Class for generating images.
+
+    Layout-background pairs are processed in parallel with one of three backends:
+    threads share the process memory and its caches, relying on OpenCV releasing the GIL in
+    decoding, resizing and encoding; processes pickle the generator and the rows for every
+    worker; hybrid runs several processes with a few threads each. The OpenCV thread pool
+    of every worker is sized so that the workers together do not oversubscribe the cores.
+    """
+
+    BACKENDS = ["threads", "processes", "hybrid"]
 
     def __init__(
         self,
         num_images_per_bg: int,
         scaling_factor: float,
         seed: int,
+        variant_cache_dir: Optional[str] = None,
+        backend: str = "processes",
+        num_workers: int = -1,
+        threads_per_worker: int = 2,
+        min_slot_area_ratio: float = 0.0005,
     ):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unsupported backend: {backend}")
         self.num_images_per_bg = num_images_per_bg
         self.scaling_factor = scaling_factor
         self.seed = seed
+        self.variant_cache = VariantCache(variant_cache_dir) if variant_cache_dir else None
+        self.backend = backend
+        self.num_workers = num_workers if num_workers > 0 else os.cpu_count() or 1
+        self.threads_per_worker = max(threads_per_worker, 1)
+        self.min_slot_area_ratio = min_slot_area_ratio
 
     @staticmethod
     def get_file_list(
@@ -38,37 +66,114 @@ class ImageGenerator:
         return file_list
 
     @staticmethod
-    def _randomly_select_elements(
-        lst: List[str],
-        num_elements: int,
-    ) -> List[str]:
-        if num_elements > len(lst):
-            raise ValueError("N is greater than the length of the list")
-        selected_elements = random.sample(lst, num_elements)
-        random.shuffle(selected_elements)
-        return selected_elements
+    def find_slots(
+        mask_layout: np.ndarray,
+        min_slot_area_ratio: float = 0.0,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the slots of a layout mask.
+
+        Args:
+            mask_layout: Binary layout mask.
+            min_slot_area_ratio: Components smaller than this fraction of the layout are noise.
+
+        Returns:
+            Stats and centroids as returned by connectedComponentsWithStats, with the
+            background in row 0 followed by the slots.
+        """
+        _, _, stats, centroids = cv2.connectedComponentsWithStats(mask_layout, connectivity=8)
+        min_area = min_slot_area_ratio * mask_layout.shape[0] * mask_layout.shape[1]
+        is_kept = stats[:, cv2.CC_STAT_AREA] >= min_area
+        is_kept[0] = True
+        return stats[is_kept], centroids[is_kept]
+
+    def _count_slots(self, layout_path: str) -> int:
+        stats, _ = self.find_slots(self._load_layout(layout_path), self.min_slot_area_ratio)
+        return len(stats) - 1
+
+    def plan_foregrounds(
+        self,
+        img_paths: List[str],
+        layout_paths: List[str],
+        num_slots: List[int],
+    ) -> List[List[str]]:
+        # The composites of all layout-background pairs are planned together, so the foregrounds
+        # are used evenly across the whole sample
+        planner = ForegroundPlanner(num_foregrounds=len(img_paths), seed=self.seed)
+        plans = planner.plan(num_slots=num_slots, layout_ids=layout_paths)
+        return [[img_paths[idx] for idx in plan] for plan in plans]
+
+    @staticmethod
+    def compute_alpha_bbox(
+        img: np.ndarray,
+    ) -> Optional[BoundingBox]:
+        # Row and column reductions of the alpha channel, without listing every opaque pixel
+        alpha = img[:, :, 3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if len(rows) == 0:
+            return None
+        cols = np.flatnonzero(alpha.any(axis=0))
+        return int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)
 
     @staticmethod
     def _crop_transparent_images(
         img: np.ndarray,
+        bbox: Optional[BoundingBox] = None,
     ) -> np.ndarray:
-        # Find non-zero alpha values
-        non_transparent_pixels = cv2.findNonZero(img[:, :, 3])
+        # Use the precomputed bounding box of the non-transparent region if there is one
+        if bbox is None:
+            bbox = ImageGenerator.compute_alpha_bbox(img)
+            if bbox is None:
+                return img
 
-        if non_transparent_pixels is None:
-            return img
+        # Crop the image, the slice is a view of the loaded image
+        x, y, w, h = bbox
+        return img[y : y + h, x : x + w]
 
-        # Get bounding box of non-transparent region
-        x, y, w, h = cv2.boundingRect(non_transparent_pixels)
+    def _index_foreground(
+        self,
+        img_path: str,
+    ) -> Optional[BoundingBox]:
+        get_metrics().inc("images.decoded")
+        return self.compute_alpha_bbox(self._load_foreground(img_path))
 
-        # Crop the image
-        cropped_img = img[y : y + h, x : x + w]
+    def index_foregrounds(
+        self,
+        sample_dir: str,
+    ) -> Dict[str, Optional[BoundingBox]]:
+        """Compute the bounding boxes of the non-transparent regions of the sample foregrounds.
 
-        return cropped_img
+        Args:
+            sample_dir: The sample directory with the images subdirectory.
+
+        Returns:
+            A dictionary mapping foreground paths to (x, y, width, height) boxes, None for fully
+            transparent images.
+        """
+        img_dir = os.path.join(sample_dir, "images")
+        img_paths = self.get_file_list(img_dir, "*.[jpPJ][nNpP][gG]")
+        results = Parallel(n_jobs=-1)(
+            delayed(run_with_metrics)(self._index_foreground, os.getpid(), img_path)
+            for img_path in img_paths
+        )
+        return {img_path: collect_metrics(result) for img_path, result in zip(img_paths, results)}
 
     def _load_layout(
         self,
         layout_path: str,
+    ) -> np.ndarray:
+        if self.variant_cache is None:
+            return self._read_layout(layout_path, self.scaling_factor)
+        return self.variant_cache.get(
+            layout_path,
+            size=f"{self.scaling_factor:g}x",
+            interpolation="nearest",
+            compute=lambda: self._read_layout(layout_path, self.scaling_factor),
+        )
+
+    @staticmethod
+    def _read_layout(
+        layout_path: str,
+        scaling_factor: float,
     ) -> np.ndarray:
         layout = cv2.imread(layout_path, cv2.IMREAD_COLOR)
         gray_layout = cv2.cvtColor(layout, cv2.COLOR_BGR2GRAY)
@@ -76,8 +181,8 @@ class ImageGenerator:
         img_bin_resized = cv2.resize(
             img_bin,
             dsize=None,
-            fx=self.scaling_factor,
-            fy=self.scaling_factor,
+            fx=scaling_factor,
+            fy=scaling_factor,
             interpolation=cv2.INTER_NEAREST,
         )
         return img_bin_resized
@@ -101,6 +206,21 @@ class ImageGenerator:
         else:
             return img
 
+    def _load_scaled_background(
+        self,
+        img_path: str,
+        img_height: int,
+        img_width: int,
+    ) -> np.ndarray:
+        if self.variant_cache is None:
+            return self._load_background(img_path, img_height, img_width)
+        return self.variant_cache.get(
+            img_path,
+            size=f"{img_width}x{img_height}",
+            interpolation="cubic",
+            compute=lambda: self._load_background(img_path, img_height, img_width),
+        )
+
     @staticmethod
     def _load_foreground(
         img_path: str,
@@ -168,77 +288,342 @@ class ImageGenerator:
 
         return x_min, y_min, x_max, y_max
 
+    def _compose_image(
+        self,
+        img_back: np.ndarray,
+        mask_layout: np.ndarray,
+        stats: np.ndarray,
+        centroids: np.ndarray,
+        img_paths: List[str],
+        load_foreground: Callable[[str], np.ndarray],
+        bboxes: Optional[Dict[str, Optional[BoundingBox]]] = None,
+    ) -> np.ndarray:
+        # Place each foreground into its layout slot, the slot with label 0 is the background
+        for object_id, img_path in zip(range(1, len(stats)), img_paths):
+            img_fore = load_foreground(img_path)
+            bbox = bboxes.get(img_path) if bboxes is not None else None
+            img_fore = self._crop_transparent_images(img_fore, bbox)
+            img_fore = cv2.resize(
+                img_fore,
+                dsize=(
+                    stats[object_id, cv2.CC_STAT_WIDTH],
+                    stats[object_id, cv2.CC_STAT_HEIGHT],
+                ),
+            )
+
+            x_min, y_min, x_max, y_max = self._compute_coordinates(
+                img_fore=img_fore,
+                img_back=img_back,
+                centroid=centroids[object_id],
+            )
+
+            if x_max > x_min and y_max > y_min:
+                img_back = self._merge_images_masked(
+                    img_fore=img_fore,
+                    img_back=img_back,
+                    mask_layout=mask_layout,
+                    x_min=x_min,
+                    y_min=y_min,
+                    x_max=x_max,
+                    y_max=y_max,
+                )
+        return img_back
+
     def _process_single_background(
         self,
         row: pd.Series,
-        sample_dir: str,
+        img_paths_plan: List[List[str]],
         save_dir: str,
+        bboxes: Optional[Dict[str, Optional[BoundingBox]]] = None,
     ) -> None:
-        img_dir = os.path.join(sample_dir, "images")
-        img_paths = self.get_file_list(img_dir, "*.[jpPJ][nNpP][gG]")
+        metrics = get_metrics()
         mask_layout = self._load_layout(row.layout_path)
-        img_back = self._load_background(
+        img_back = self._load_scaled_background(
             row.background_path,
             img_height=mask_layout.shape[0],
             img_width=mask_layout.shape[1],
         )
+        metrics.inc("images.decoded", 2)
 
-        num_objects, _, stats, centroids = cv2.connectedComponentsWithStats(
-            mask_layout,
-            connectivity=8,
-        )
-
-        for idx in range(self.num_images_per_bg):
-            img_paths_selected = self._randomly_select_elements(img_paths, num_objects - 1)
-            for object_id, img_path in zip(range(1, num_objects), img_paths_selected):
-                img_fore = self._load_foreground(img_path)
-                img_fore = self._crop_transparent_images(img_fore)
-                img_fore = cv2.resize(
-                    img_fore,
-                    dsize=(
-                        stats[object_id, cv2.CC_STAT_WIDTH],
-                        stats[object_id, cv2.CC_STAT_HEIGHT],
-                    ),
-                )
+        stats, centroids = self.find_slots(mask_layout, self.min_slot_area_ratio)
 
-                x_min, y_min, x_max, y_max = self._compute_coordinates(
-                    img_fore=img_fore,
+        for idx, img_paths_selected in enumerate(img_paths_plan):
+            with metrics.span("composite.image"):
+                img_back = self._compose_image(
                     img_back=img_back,
-                    centroid=centroids[object_id],
+                    mask_layout=mask_layout,
+                    stats=stats,
+                    centroids=centroids,
+                    img_paths=img_paths_selected,
+                    load_foreground=self._load_foreground,
+                    bboxes=bboxes,
                 )
-
-                if x_max > x_min and y_max > y_min:
-                    img_back = self._merge_images_masked(
-                        img_fore=img_fore,
-                        img_back=img_back,
-                        mask_layout=mask_layout,
-                        x_min=x_min,
-                        y_min=y_min,
-                        x_max=x_max,
-                        y_max=y_max,
-                    )
+            metrics.inc("images.decoded", len(img_paths_selected))
 
             filename = f"{row.layout_id}_{row.background_id}_{idx + 1:01d}.png"
             save_path = os.path.join(save_dir, filename)
-            cv2.imwrite(save_path, img_back, [cv2.IMWRITE_PNG_COMPRESSION, 6])
+            with metrics.span("encode.image"):
+                cv2.imwrite(save_path, img_back, [cv2.IMWRITE_PNG_COMPRESSION, 6])
+            metrics.inc("images.written")
+            metrics.inc("bytes.written", os.path.getsize(save_path))
+
+    def generate_previews(
+        self,
+        df: pd.DataFrame,
+        sample_dir: str,
+        num_previews: int = 4,
+        preview_scale: float = 0.25,
+    ) -> List[np.ndarray]:
+        """Composite a few images at reduced resolution to preview the layouts and scaling.
+
+        The previews go through the same compositing code as the full generation, but use a
+        downscaled layout mask and thumbnails of the foregrounds and backgrounds that are cached
+        in memory between calls.
+
+        Args:
+            df: DataFrame with layout and background pairs.
+            sample_dir: The sample directory with the images subdirectory.
+            num_previews: The number of previews to create, one per layout-background pair.
+            preview_scale: The resolution of the previews relative to the full generation.
+
+        Returns:
+            The previews as RGBA arrays.
+        """
+        img_dir = os.path.join(sample_dir, "images")
+        img_paths = self.get_file_list(img_dir, "*.[jpPJ][nNpP][gG]")
+        scaling_factor = self.scaling_factor * preview_scale
+
+        layouts = []
+        for row in df.head(num_previews).itertuples():
+            mask_layout = _load_layout_preview(row.layout_path, scaling_factor)
+            stats, centroids = self.find_slots(mask_layout, self.min_slot_area_ratio)
+            layouts.append((row, mask_layout, stats, centroids))
+        img_paths_plan = self.plan_foregrounds(
+            img_paths=img_paths,
+            layout_paths=[row.layout_path for row, *_ in layouts],
+            num_slots=[len(stats) - 1 for _, _, stats, _ in layouts],
+        )
+
+        previews = []
+        for (row, mask_layout, stats, centroids), img_paths_selected in zip(
+            layouts,
+            img_paths_plan,
+        ):
+            img_height, img_width = mask_layout.shape[:2]
+            img_back = _load_thumbnail(row.background_path, max(img_height, img_width))
+            img_back = cv2.resize(
+                img_back,
+                dsize=(img_width, img_height),
+                interpolation=cv2.INTER_AREA,
+            )
+
+            max_size = int(stats[1:, cv2.CC_STAT_WIDTH : cv2.CC_STAT_HEIGHT + 1].max(initial=1))
+            img_back = self._compose_image(
+                img_back=img_back,
+                mask_layout=mask_layout,
+                stats=stats,
+                centroids=centroids,
+                img_paths=img_paths_selected,
+                # Crop-then-resize keeps the aspect of the slot, so a thumbnail twice the slot
+                # size is indistinguishable from the full image
+                load_foreground=lambda img_path: _load_thumbnail(img_path, 2 * max_size),
+            )
+            previews.append(cv2.cvtColor(img_back, cv2.COLOR_BGRA2RGBA))
+
+        return previews
+
+    def warm_variant_cache(
+        self,
+        df: pd.DataFrame,
+    ) -> None:
+        # Store the layout masks and backgrounds of all pairs at the current scaling factor
+        if self.variant_cache is None:
+            raise ValueError("No variant cache directory was set")
+        for row in df.itertuples():
+            mask_layout = self._load_layout(row.layout_path)
+            self._load_scaled_background(
+                row.background_path,
+                img_height=mask_layout.shape[0],
+                img_width=mask_layout.shape[1],
+            )
 
     def process_sample(
         self,
         df: pd.DataFrame,
         sample_dir: str,
         save_dir: str,
+        callback: Optional[Callable[[int], None]] = None,
+        bboxes: Optional[Dict[str, Optional[BoundingBox]]] = None,
+        layout_ids: Optional[Set[str]] = None,
+        num_slots: Optional[Dict[str, int]] = None,
     ) -> None:
         # Create a directory to store the files
         sample_name = Path(sample_dir).name
         sample_save_dir = os.path.join(save_dir, sample_name)
         os.makedirs(sample_save_dir, exist_ok=True)
 
-        # Iterate over layout-background pairs
-        _ = Parallel(n_jobs=-1)(
-            delayed(self._process_single_background)(
-                row=row,
-                sample_dir=sample_dir,
-                save_dir=sample_save_dir,
-            )
-            for row in tqdm(df.itertuples(), unit="pairs")
+        # Plan the foregrounds of all composites, without a layout report every layout is read
+        # once to count its slots
+        img_dir = os.path.join(sample_dir, "images")
+        img_paths = self.get_file_list(img_dir, "*.[jpPJ][nNpP][gG]")
+        if num_slots is None:
+            num_slots = {
+                layout_path: self._count_slots(layout_path)
+                for layout_path in df.layout_path.unique()
+            }
+        layout_paths = [
+            layout_path for layout_path in df.layout_path for _ in range(self.num_images_per_bg)
+        ]
+        img_paths_plan = self.plan_foregrounds(
+            img_paths=img_paths,
+            layout_paths=layout_paths,
+            num_slots=[num_slots[layout_path] for layout_path in layout_paths],
         )
+
+        # Iterate over layout-background pairs, reporting the number of processed pairs
+        tasks = [
+            {
+                "row": row,
+                "img_paths_plan": img_paths_plan[
+                    idx * self.num_images_per_bg : (idx + 1) * self.num_images_per_bg
+                ],
+                "save_dir": sample_save_dir,
+                "bboxes": bboxes,
+            }
+            for idx, row in enumerate(df.itertuples())
+            # A shard of the sample still gets its slice of the plan of the whole sample
+            if layout_ids is None or row.layout_id in layout_ids
+        ]
+        with tqdm(total=len(tasks), unit="pairs") as pbar:
+            for num_processed in self._run_tasks(tasks):
+                pbar.update(num_processed - pbar.n)
+                if callback is not None:
+                    callback(num_processed)
+
+    def _process_tasks_threaded(
+        self,
+        tasks: List[Dict],
+    ) -> int:
+        # Runs in a worker process of the hybrid backend
+        with ThreadPoolExecutor(max_workers=self.threads_per_worker) as executor:
+            for future in [
+                executor.submit(self._process_single_background, **task) for task in tasks
+            ]:
+                future.result()
+        return len(tasks)
+
+    def _run_tasks(
+        self,
+        tasks: List[Dict],
+    ) -> Iterator[int]:
+        # Yields the number of processed pairs after every finished task
+        num_cores = os.cpu_count() or 1
+        if self.backend == "threads":
+            num_threads_before = cv2.getNumThreads()
+            cv2.setNumThreads(max(num_cores // self.num_workers, 1))
+            try:
+                results = Parallel(
+                    n_jobs=self.num_workers,
+                    backend="threading",
+                    return_as="generator",
+                )(delayed(self._process_single_background)(**task) for task in tasks)
+                for num_processed, _ in enumerate(results, start=1):
+                    yield num_processed
+            finally:
+                cv2.setNumThreads(num_threads_before)
+
+        elif self.backend == "processes":
+            results = Parallel(n_jobs=self.num_workers, return_as="generator")(
+                delayed(run_with_metrics)(
+                    _run_with_cv2_threads,
+                    os.getpid(),
+                    max(num_cores // self.num_workers, 1),
+                    self._process_single_background,
+                    **task,
+                )
+                for task in tasks
+            )
+            for num_processed, result in enumerate(results, start=1):
+                collect_metrics(result)
+                yield num_processed
+
+        else:
+            # Chunks of a few pairs per thread keep the processes busy without pickling per pair
+            num_processes = max(self.num_workers // self.threads_per_worker, 1)
+            chunk_size = 2 * self.threads_per_worker
+            chunks = [
+                tasks[start : start + chunk_size] for start in range(0, len(tasks), chunk_size)
+            ]
+            results = Parallel(n_jobs=num_processes, return_as="generator")(
+                delayed(run_with_metrics)(
+                    _run_with_cv2_threads,
+                    os.getpid(),
+                    max(num_cores // (num_processes * self.threads_per_worker), 1),
+                    self._process_tasks_threaded,
+                    chunk,
+                )
+                for chunk in chunks
+            )
+            num_processed = 0
+            for result in results:
+                num_processed += collect_metrics(result)
+                yield num_processed
+
+
+def _run_with_cv2_threads(
+    num_threads: int,
+    fn: Callable[..., Any],
+    *args,
+    **kwargs,
+) -> Any:
+    # OpenCV keeps its thread pool per process, so every worker process sizes its own
+    cv2.setNumThreads(num_threads)
+    return fn(*args, **kwargs)
+
+
+def _thumbnail_size_bucket(max_size: int) -> int:
+    # Round up to a power of two so that nearby preview sizes share cached thumbnails
+    return 1 << max(int(max_size) - 1, 1).bit_length()
+
+
+@functools.lru_cache(maxsize=512)
+def _load_thumbnail_cached(
+    img_path: str,
+    mtime: float,
+    max_size: int,
+) -> np.ndarray:
+    img = ImageGenerator._load_foreground(img_path)
+    scale = max_size / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, dsize=None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Cached arrays are shared between previews and must never be modified in place
+    img.setflags(write=False)
+    return img
+
+
+def _load_thumbnail(
+    img_path: str,
+    max_size: int,
+) -> np.ndarray:
+    # The mtime is part of the cache key, so edited source files are reloaded
+    mtime = os.path.getmtime(img_path)
+    return _load_thumbnail_cached(img_path, mtime, _thumbnail_size_bucket(max_size))
+
+
+@functools.lru_cache(maxsize=64)
+def _load_layout_preview_cached(
+    layout_path: str,
+    mtime: float,
+    scaling_factor: float,
+) -> np.ndarray:
+    mask_layout = ImageGenerator._read_layout(layout_path, scaling_factor)
+    mask_layout.setflags(write=False)
+    return mask_layout
+
+
+def _load_layout_preview(
+    layout_path: str,
+    scaling_factor: float,
+) -> np.ndarray:
+    mtime = os.path.getmtime(layout_path)
+    return _load_layout_preview_cached(layout_path, mtime, scaling_factor)
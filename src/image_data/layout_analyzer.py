@@ -0,0 +1,172 @@
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+import cv2
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from src.image_data.image_generator import BoundingBox, ImageGenerator
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+REPORT_COLUMNS = [
+    "sample",
+    "layout_name",
+    "layout_path",
+    "num_slots",
+    "num_noise",
+    "min_slot_width",
+    "min_slot_height",
+    "pool_size",
+    "max_stretch",
+    "is_broken",
+    "issues",
+]
+
+
+class LayoutAnalyzer:
+    """A class for checking the layouts of all samples before any image is generated.
+
+    Every layout is thresholded and scaled exactly as ImageGenerator does and its connected
+    components are split into slots and noise, i.e. components smaller than min_slot_area_ratio
+    of the layout. Slots are compared with the foreground pool of their sample: a pool smaller
+    than the number of slots forces repeated foregrounds, and a slot whose aspect ratio is far
+    from that of the foregrounds stretches them when they are resized into it. Layouts are read
+    in threads, which run in parallel because OpenCV releases the GIL while decoding.
+    """
+
+    def __init__(
+        self,
+        scaling_factor: float,
+        min_slot_area_ratio: float = 0.0005,
+        max_stretch: float = 1.5,
+        n_jobs: int = -1,
+    ) -> None:
+        self.scaling_factor = scaling_factor
+        self.min_slot_area_ratio = min_slot_area_ratio
+        self.max_stretch = max_stretch
+        self.n_jobs = n_jobs
+
+    def analyze_layout(self, layout_path: str) -> Dict[str, Any]:
+        mask_layout = ImageGenerator._read_layout(layout_path, self.scaling_factor)
+        num_components = cv2.connectedComponents(mask_layout, connectivity=8)[0] - 1
+        stats, _ = ImageGenerator.find_slots(mask_layout, self.min_slot_area_ratio)
+        widths = stats[1:, cv2.CC_STAT_WIDTH]
+        heights = stats[1:, cv2.CC_STAT_HEIGHT]
+        return {
+            "layout_path": layout_path,
+            "num_slots": len(stats) - 1,
+            "num_noise": num_components - (len(stats) - 1),
+            "min_slot_width": int(widths.min(initial=0)),
+            "min_slot_height": int(heights.min(initial=0)),
+            "slot_aspects": (widths / heights).tolist(),
+        }
+
+    @staticmethod
+    def _get_foreground_aspects(bboxes: Dict[str, Optional[BoundingBox]]) -> List[float]:
+        return [w / h for _, _, w, h in filter(None, bboxes.values())]
+
+    def _find_issues(self, row: Dict[str, Any]) -> List[str]:
+        issues = []
+        if row["num_slots"] == 0:
+            issues.append("no slots")
+        if row["num_noise"]:
+            issues.append(f"{row['num_noise']} noise components ignored")
+        if row["pool_size"] == 0:
+            issues.append("no foregrounds")
+        elif row["num_slots"] > row["pool_size"]:
+            issues.append(f"{row['num_slots'] - row['pool_size']} slots more than foregrounds")
+        if row["max_stretch"] > self.max_stretch:
+            issues.append(f"foregrounds stretched up to {row['max_stretch']:.2f}x")
+        return issues
+
+    def analyze(
+        self,
+        pairs: Dict[str, pd.DataFrame],
+        bboxes: Dict[str, Dict[str, Optional[BoundingBox]]],
+    ) -> pd.DataFrame:
+        """Analyze the layouts of all samples in one parallel batch.
+
+        Args:
+            pairs: Layout-background pairs per sample directory, as used by ImageGenerator.
+            bboxes: Foreground bounding boxes per sample directory, as returned by
+                ImageGenerator.index_foregrounds.
+
+        Returns:
+            A DataFrame with one row per layout, its slot statistics, a list of issues and whether
+            the layout is broken, i.e. has no slots or no foregrounds to fill them.
+        """
+        layout_samples = {
+            layout_path: sample_dir
+            for sample_dir, df in pairs.items()
+            for layout_path in df.layout_path.unique()
+        }
+        results = Parallel(n_jobs=self.n_jobs, prefer="threads")(
+            delayed(self.analyze_layout)(layout_path) for layout_path in layout_samples
+        )
+
+        rows = []
+        for result in results:
+            sample_dir = layout_samples[result["layout_path"]]
+            fg_aspects = self._get_foreground_aspects(bboxes[sample_dir])
+
+            # Stretch is the factor by which the median foreground is distorted in a slot
+            max_stretch = 1.0
+            if fg_aspects and result["slot_aspects"]:
+                fg_aspect = float(np.median(fg_aspects))
+                max_stretch = max(
+                    math.exp(abs(math.log(slot_aspect / fg_aspect)))
+                    for slot_aspect in result["slot_aspects"]
+                )
+            row = {
+                "sample": os.path.basename(sample_dir),
+                "layout_name": os.path.basename(result["layout_path"]),
+                **{key: value for key, value in result.items() if key != "slot_aspects"},
+                # The planner draws from every foreground, fully transparent ones are pasted whole
+                "pool_size": len(bboxes[sample_dir]),
+                "max_stretch": round(max_stretch, 3),
+            }
+            row["is_broken"] = row["num_slots"] == 0 or row["pool_size"] == 0
+            row["issues"] = self._find_issues(row)
+            rows.append(row)
+        # The columns are explicit so that a catalog without layouts gives an empty report
+        return pd.DataFrame(rows, columns=REPORT_COLUMNS).astype({"is_broken": bool})
+
+    def log_report(self, df: pd.DataFrame) -> None:
+        columns = ["sample", "layout_name", "num_slots", "num_noise", "pool_size", "max_stretch"]
+        if df.empty:
+            log.warning("Layout report: no layouts found")
+            return
+        log.info(f"Layout report:\n{df[columns].to_string(index=False)}")
+        # Broken layouts cannot produce a composite, the other issues are warnings
+        for row in df.itertuples():
+            if row.is_broken:
+                log.error(f"{row.sample}/{row.layout_name} is broken: {', '.join(row.issues)}")
+            elif row.issues:
+                log.warning(f"{row.sample}/{row.layout_name}: {', '.join(row.issues)}")
+
+
+if __name__ == "__main__":
+    # Test LayoutAnalyzer class
+    from src.image_data.image_matcher import ImageMatcher
+
+    sample_dir = "data/input/stories/marketing_05"
+    matcher = ImageMatcher()
+    df_pairs = matcher.create_dataframe(
+        matcher.get_file_list(os.path.join(sample_dir, "layouts"), "layout*.[jpPJ][nNpP][gG]"),
+        matcher.get_file_list(
+            os.path.join(sample_dir, "backgrounds"),
+            "background*.[jpPJ][nNpP][gG]",
+        ),
+    )
+    generator = ImageGenerator(num_images_per_bg=0, scaling_factor=1, seed=0)
+    analyzer = LayoutAnalyzer(scaling_factor=1)
+    report = analyzer.analyze(
+        pairs={sample_dir: df_pairs},
+        bboxes={sample_dir: generator.index_foregrounds(sample_dir)},
+    )
+    analyzer.log_report(report)
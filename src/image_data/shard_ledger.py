@@ -0,0 +1,228 @@
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class ShardLedger:
+    """A lock-free ledger of work shards on a shared filesystem.
+
+    Every shard has a claim file, created with O_EXCL so exactly one node wins it, and a done
+    marker written by atomic rename once its outputs are complete. While a node works on its
+    shards, a heartbeat thread refreshes the mtimes of its claim files. A claim whose mtime is
+    older than lease_seconds belongs to a dead node. Every claim holds a unique token, and a node
+    taking over a stale claim first hard-links it to a tombstone named after that token, which
+    succeeds for exactly one of the competing nodes. The winner checks that the linked file still
+    holds the token, i.e. that the claim was not replaced in the meantime, before it removes the
+    claim and claims the shard again.
+
+    Nodes compare claim mtimes with their own clocks, so the clocks must be synchronized, e.g.
+    with NTP, and lease_seconds should cover any remaining skew. A node that stalls for longer
+    than the lease may see its shard taken over; shards must therefore be deterministic, so
+    that two nodes finishing the same shard write the same outputs.
+    """
+
+    def __init__(
+        self,
+        ledger_dir: str,
+        node_id: Optional[str] = None,
+        lease_seconds: float = 60,
+    ) -> None:
+        self.ledger_dir = ledger_dir
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.held: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        os.makedirs(ledger_dir, exist_ok=True)
+
+    def _get_path(self, shard: str, suffix: str) -> str:
+        return os.path.join(self.ledger_dir, *shard.split("/")) + suffix
+
+    def is_done(self, shard: str) -> bool:
+        return os.path.isfile(self._get_path(shard, ".done"))
+
+    def _create_claim(self, claim_path: str) -> Optional[str]:
+        token = f"{self.node_id}:{uuid.uuid4().hex}"
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(token)
+        return token
+
+    @staticmethod
+    def _read_claim(claim_path: str) -> Tuple[str, float]:
+        # Token and mtime are read from the same open file, so they belong to the same claim
+        with open(claim_path, "r", encoding="utf-8") as f:
+            return f.read(), os.fstat(f.fileno()).st_mtime
+
+    def _remove_stale_claim(self, claim_path: str) -> bool:
+        try:
+            token, mtime = self._read_claim(claim_path)
+        except FileNotFoundError:
+            return True
+        claim_age = time.time() - mtime
+        if claim_age < self.lease_seconds:
+            return False
+
+        # Only one node can create the tombstone of this claim. The link may have caught a newer
+        # claim that replaced the stale one, which then holds a different token or a fresh mtime,
+        # e.g. when a node died before writing its token, and is kept
+        token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+        tombstone_path = f"{claim_path}.reclaim.{token_hash}"
+        try:
+            os.link(claim_path, tombstone_path)
+        except (FileExistsError, FileNotFoundError):
+            return False
+        try:
+            linked_token, linked_mtime = self._read_claim(tombstone_path)
+            if linked_token != token or linked_mtime != mtime:
+                return False
+            os.remove(claim_path)
+        finally:
+            os.remove(tombstone_path)
+        log.warning(f"Reclaiming {claim_path} abandoned for {claim_age:.0f} s")
+        return True
+
+    def try_claim(self, shard: str) -> bool:
+        claim_path = self._get_path(shard, ".claim")
+        os.makedirs(os.path.dirname(claim_path), exist_ok=True)
+        if self.is_done(shard):
+            return False
+        token = self._create_claim(claim_path)
+        if token is None:
+            if not self._remove_stale_claim(claim_path):
+                return False
+            token = self._create_claim(claim_path)
+            if token is None:
+                return False
+
+        # The shard may have been completed between the first check and the claim
+        if self.is_done(shard):
+            os.remove(claim_path)
+            return False
+        with self.lock:
+            self.held[shard] = token
+        return True
+
+    def _release_claim(self, shard: str) -> None:
+        with self.lock:
+            token = self.held.pop(shard, None)
+        claim_path = self._get_path(shard, ".claim")
+        try:
+            claim_token, _ = self._read_claim(claim_path)
+            if claim_token == token:
+                os.remove(claim_path)
+        except FileNotFoundError:
+            pass
+
+    def complete(self, shard: str) -> None:
+        done_path = self._get_path(shard, ".done")
+        tmp_path = f"{done_path}.{self.node_id}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.node_id)
+        os.replace(tmp_path, done_path)
+        self._release_claim(shard)
+
+    def release(self, shard: str) -> None:
+        # Give a failed shard back so that another node can take it without waiting for the lease
+        self._release_claim(shard)
+
+    def _heartbeat(self, stop_event: threading.Event) -> None:
+        while not stop_event.wait(self.lease_seconds / 4):
+            with self.lock:
+                held = list(self.held)
+            for shard in held:
+                try:
+                    os.utime(self._get_path(shard, ".claim"))
+                except FileNotFoundError:
+                    log.warning(f"Lost the claim of shard {shard}")
+
+    def run(
+        self,
+        shards: Iterable[str],
+        fn: Callable[[str], None],
+        poll_interval: float = 5,
+    ) -> int:
+        """Process shards until all of them are done by this node or by others.
+
+        Args:
+            shards: Names of the shards, path-like strings such as sample/run/layout.
+            fn: Function processing a shard.
+            poll_interval: Seconds between checks of shards claimed by other nodes.
+
+        Returns:
+            The number of shards processed by this node.
+        """
+        pending = list(shards)
+        num_processed = 0
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(stop_event,), daemon=True)
+        heartbeat.start()
+        try:
+            while pending:
+                for shard in pending:
+                    if not self.try_claim(shard):
+                        continue
+                    try:
+                        fn(shard)
+                    except BaseException:
+                        self.release(shard)
+                        raise
+                    self.complete(shard)
+                    num_processed += 1
+
+                # The remaining shards are held by other nodes, wait for them or their leases
+                pending = [shard for shard in pending if not self.is_done(shard)]
+                if pending:
+                    time.sleep(poll_interval)
+        finally:
+            stop_event.set()
+            heartbeat.join()
+        return num_processed
+
+
+if __name__ == "__main__":
+    # Test ShardLedger class
+    ledger = ShardLedger(ledger_dir="data/cache/ledger", lease_seconds=10)
+    num_processed = ledger.run(
+        shards=[f"sample/run/{layout_id:02d}" for layout_id in range(1, 5)],
+        fn=lambda shard: print(f"{ledger.node_id} processing {shard}"),
+        poll_interval=1,
+    )
+    print(f"Processed {num_processed} shards")
+
+    # Nodes racing for the same stale claim, exactly one of them may take the shard over
+    import multiprocessing
+
+    def _race(barrier: multiprocessing.Barrier, wins: multiprocessing.Queue) -> None:
+        node = ShardLedger(ledger_dir="data/cache/ledger", lease_seconds=10)
+        barrier.wait()
+        wins.put(node.try_claim("race/run/01"))
+
+    context = multiprocessing.get_context("fork")
+    for _ in range(20):
+        claim_path = ledger._get_path("race/run/01", ".claim")
+        os.makedirs(os.path.dirname(claim_path), exist_ok=True)
+        with open(claim_path, "w", encoding="utf-8") as f:
+            f.write("dead-node:0")
+        os.utime(claim_path, (time.time() - 60, time.time() - 60))
+        barrier = context.Barrier(8)
+        wins = context.Queue()
+        nodes = [context.Process(target=_race, args=(barrier, wins)) for _ in range(8)]
+        for node in nodes:
+            node.start()
+        for node in nodes:
+            node.join()
+        num_wins = sum(wins.get() for _ in nodes)
+        assert num_wins == 1, f"{num_wins} nodes took over the same stale claim"
+        os.remove(claim_path)
+    print("Stale claims are taken over by exactly one node")
@@ -0,0 +1,105 @@
+import functools
+import hashlib
+import os
+from typing import Callable
+
+import numpy as np
+
+from src.metrics import get_metrics
+
+
+@functools.lru_cache(maxsize=1024)
+def _compute_hash_cached(file_path: str, size: int, mtime_ns: int) -> str:
+    # Size and mtime are part of the key, so edited files are hashed again
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(2**20):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class VariantCache:
+    """A class for storing pre-scaled backgrounds and layout masks on disk.
+
+    Decoding a background and resizing it with INTER_CUBIC, or thresholding and resizing a
+    layout, is repeated for every layout-background pair of every run. Variants are stored as
+    uncompressed .npy files keyed by the SHA-256 of the source file, the target size and the
+    interpolation, so loading one is a plain read and edited sources get new variants.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+    ) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def compute_hash(file_path: str) -> str:
+        file_stat = os.stat(file_path)
+        return _compute_hash_cached(file_path, file_stat.st_size, file_stat.st_mtime_ns)
+
+    def _get_cache_path(
+        self,
+        src_hash: str,
+        size: str,
+        interpolation: str,
+    ) -> str:
+        return os.path.join(self.cache_dir, src_hash[:2], f"{src_hash}_{size}_{interpolation}.npy")
+
+    def get(
+        self,
+        src_path: str,
+        size: str,
+        interpolation: str,
+        compute: Callable[[], np.ndarray],
+    ) -> np.ndarray:
+        """Load a variant of an image, computing and storing it on a miss.
+
+        Args:
+            src_path: Path to the source image.
+            size: The target size, e.g. 1080x1920, or a scaling factor, e.g. 0.5x.
+            interpolation: Name of the interpolation used for resizing.
+            compute: Function producing the variant from the source image.
+
+        Returns:
+            The variant as a writable array.
+        """
+        cache_path = self._get_cache_path(self.compute_hash(src_path), size, interpolation)
+        metrics = get_metrics()
+        if os.path.isfile(cache_path):
+            try:
+                img = np.load(cache_path, allow_pickle=False)
+                metrics.inc("variant_cache.hits")
+                return img
+            except (OSError, ValueError):
+                pass
+
+        metrics.inc("variant_cache.misses")
+        img = compute()
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, img, allow_pickle=False)
+        os.replace(tmp_path, cache_path)
+        metrics.inc("bytes.written", img.nbytes)
+        return img
+
+
+if __name__ == "__main__":
+    # Test VariantCache class
+    import cv2
+
+    variant_cache = VariantCache(cache_dir="data/cache/variants")
+    img = variant_cache.get(
+        src_path="data/test-img.jpg",
+        size="0.5x",
+        interpolation="cubic",
+        compute=lambda: cv2.resize(
+            cv2.imread("data/test-img.jpg"),
+            dsize=None,
+            fx=0.5,
+            fy=0.5,
+            interpolation=cv2.INTER_CUBIC,
+        ),
+    )
+    print(img.shape)
@@ -0,0 +1,217 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class Metrics:
+    """A thread-safe registry of counters, histograms and spans for a run.
+
+    Counters accumulate totals such as images decoded or bytes uploaded, histograms keep the
+    observed values such as per-file upload latencies, and spans time a block of code on the
+    calling thread. Spans also feed a histogram of their durations and, per span name, the busy
+    time of each thread, from which worker utilization is derived.
+
+    Work done in worker processes is not recorded in the parent registry. Tasks submitted to a
+    process pool are wrapped with run_with_metrics, which returns a snapshot of the worker
+    registry that the parent folds in with collect_metrics.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.start_time = time.time()
+            self.counters: Dict[str, float] = defaultdict(float)
+            self.histograms: Dict[str, List[float]] = defaultdict(list)
+            self.busy_time: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        with self.lock:
+            self.histograms[name].append(value)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            thread_name = threading.current_thread().name
+            with self.lock:
+                self.histograms[f"{name}.seconds"].append(elapsed_time)
+                self.busy_time[name][thread_name] += elapsed_time
+
+    def export(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "counters": dict(self.counters),
+                "histograms": {name: list(values) for name, values in self.histograms.items()},
+                "busy_time": {name: dict(threads) for name, threads in self.busy_time.items()},
+            }
+
+    def merge(self, snapshot: Dict[str, Any]) -> None:
+        # Threads of different processes share names, e.g. MainThread, so they are told apart by pid
+        worker_id = f"{snapshot['pid']}:" if snapshot["pid"] != os.getpid() else ""
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] += value
+            for name, values in snapshot["histograms"].items():
+                self.histograms[name].extend(values)
+            for name, threads in snapshot["busy_time"].items():
+                for thread_name, busy_time in threads.items():
+                    self.busy_time[name][f"{worker_id}{thread_name}"] += busy_time
+
+    @staticmethod
+    def _compute_quantile(sorted_values: List[float], quantile: float) -> float:
+        # Linear interpolation between the closest ranks, like numpy.quantile
+        position = quantile * (len(sorted_values) - 1)
+        lower = math.floor(position)
+        upper = min(lower + 1, len(sorted_values) - 1)
+        weight = position - lower
+        return sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+
+    def _summarize(self, values: List[float]) -> Dict[str, float]:
+        summary = {"count": len(values), "sum": float(sum(values))}
+        if values:
+            sorted_values = sorted(values)
+            for quantile in QUANTILES:
+                summary[f"p{int(quantile * 100)}"] = self._compute_quantile(sorted_values, quantile)
+            summary["max"] = sorted_values[-1]
+        return summary
+
+    def report(self) -> Dict[str, Any]:
+        snapshot = self.export()
+        wall_time = time.time() - self.start_time
+
+        # Utilization is the busy time of the threads that ran a span relative to the wall time
+        utilization = {}
+        for name, threads in snapshot["busy_time"].items():
+            utilization[name] = {
+                "workers": len(threads),
+                "busy_seconds": sum(threads.values()),
+                "utilization": sum(threads.values()) / (wall_time * len(threads))
+                if wall_time > 0
+                else 0.0,
+            }
+
+        return {
+            "start_time": self.start_time,
+            "wall_seconds": wall_time,
+            "counters": snapshot["counters"],
+            "histograms": {
+                name: self._summarize(values) for name, values in snapshot["histograms"].items()
+            },
+            "utilization": utilization,
+        }
+
+    def save_report(self, report_path: str) -> str:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        return report_path
+
+    @staticmethod
+    def _get_prometheus_name(name: str) -> str:
+        return "atriel_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+    def to_prometheus(self) -> str:
+        # Counters and histogram summaries in the Prometheus text exposition format
+        report = self.report()
+        lines = []
+        for name, value in sorted(report["counters"].items()):
+            metric_name = f"{self._get_prometheus_name(name)}_total"
+            lines.append(f"# TYPE {metric_name} counter")
+            lines.append(f"{metric_name} {value}")
+        for name, summary in sorted(report["histograms"].items()):
+            metric_name = self._get_prometheus_name(name)
+            lines.append(f"# TYPE {metric_name} summary")
+            for quantile in QUANTILES:
+                key = f"p{int(quantile * 100)}"
+                if key in summary:
+                    lines.append(f'{metric_name}{{quantile="{quantile}"}} {summary[key]}')
+            lines.append(f"{metric_name}_sum {summary['sum']}")
+            lines.append(f"{metric_name}_count {summary['count']}")
+        for name, stats in sorted(report["utilization"].items()):
+            metric_name = f"{self._get_prometheus_name(name)}_utilization"
+            lines.append(f"# TYPE {metric_name} gauge")
+            lines.append(f"{metric_name} {stats['utilization']}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def run_with_metrics(
+    fn: Callable[..., Any],
+    parent_pid: int,
+    *args,
+    **kwargs,
+) -> Tuple[Any, Optional[Dict[str, Any]]]:
+    # In the parent process the metrics are already recorded in the right registry
+    if os.getpid() == parent_pid:
+        return fn(*args, **kwargs), None
+
+    # Pool workers run one task at a time, so the worker registry holds this task only
+    metrics = get_metrics()
+    metrics.reset()
+    result = fn(*args, **kwargs)
+    return result, metrics.export()
+
+
+def collect_metrics(result: Tuple[Any, Optional[Dict[str, Any]]]) -> Any:
+    value, snapshot = result
+    if snapshot is not None:
+        get_metrics().merge(snapshot)
+    return value
+
+
+def get_report_path(log_dir: str) -> str:
+    # Named like the Hydra log file of the run, so the two sit side by side
+    return os.path.join(log_dir, f"{time.strftime('%d-%m-%Y_%H-%M-%S')}_report.json")
+
+
+def start_prometheus_server(
+    port: int,
+    host: str = "127.0.0.1",
+    metrics: Optional[Metrics] = None,
+) -> ThreadingHTTPServer:
+    metrics = metrics or get_metrics()
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
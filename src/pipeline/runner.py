@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from src.metrics import get_metrics
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class Stage:
+    """A pipeline stage producing one typed artifact from the artifacts of its inputs.
+
+    The stage function is called with the input artifacts as keyword arguments named after the
+    producing stages. A cacheable stage must be a pure function of its inputs and params. Stages
+    with side effects may pass a validate function that checks whether a cached artifact still
+    describes the world, e.g. that the files it lists exist. Source stages, which read the
+    world instead of their inputs, are never cached and pass a fingerprint function instead.
+
+    A streaming stage returns an iterator of output_type items. Downstream stages start at once
+    and consume the items while they are still being produced, and a cacheable streaming stage
+    stores the list of its items once the iterator is exhausted. On a cache hit, downstream
+    stages get an iterator over the cached list.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[..., Any],
+        output_type: type,
+        inputs: Iterable[str] = (),
+        params: Optional[Dict[str, Any]] = None,
+        cacheable: bool = False,
+        fingerprint: Optional[Callable[[Any], str]] = None,
+        validate: Optional[Callable[[Any], bool]] = None,
+        stream: bool = False,
+    ) -> None:
+        if cacheable and fingerprint is not None:
+            raise ValueError(f"Stage {name} is a source stage and cannot be cached")
+        if stream and fingerprint is not None:
+            raise ValueError(f"Stage {name} is a source stage and cannot stream")
+        self.name = name
+        self.fn = fn
+        self.output_type = output_type
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.cacheable = cacheable
+        self.fingerprint = fingerprint
+        self.validate = validate
+        self.stream = stream
+
+
+class ArtifactCache:
+    """A class for storing stage artifacts on disk keyed by their content fingerprint."""
+
+    def __init__(
+        self,
+        cache_dir: str,
+    ) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_path(self, stage_name: str, key: str) -> str:
+        return os.path.join(self.cache_dir, stage_name, f"{key}.pkl")
+
+    def get(self, stage_name: str, key: str) -> Optional[Any]:
+        path = self._get_path(stage_name, key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, stage_name: str, key: str, value: Any) -> None:
+        path = self._get_path(stage_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Runs sharing the cache dir may write the same artifact, each writer has its own temp file
+        tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+class PipelineRunner:
+    """A class for running pipeline stages as a DAG.
+
+    Every artifact gets a fingerprint. Source stages fingerprint their output, e.g. the sizes and
+    mtimes of the files they list, and other stages derive theirs from the stage name, params and
+    input fingerprints. Cacheable stages whose fingerprint is found in the artifact cache are not
+    run, so a rerun only recomputes the stages downstream of what changed. Stages whose inputs
+    are ready run in parallel, so independent branches overlap.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_workers: int = 4,
+    ) -> None:
+        self.cache = ArtifactCache(cache_dir) if cache_dir else None
+        self.max_workers = max_workers
+        self.stages: Dict[str, Stage] = {}
+
+    def add_stage(self, stage: Stage) -> None:
+        missing_inputs = [name for name in stage.inputs if name not in self.stages]
+        if missing_inputs:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages: {missing_inputs}")
+        self.stages[stage.name] = stage
+
+    def get_dependencies(self, targets: Iterable[str]) -> List[str]:
+        # Stages needed for the targets in topological order, stages can only depend on earlier ones
+        needed: Set[str] = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.stages[name].inputs)
+        return [name for name in self.stages if name in needed]
+
+    @staticmethod
+    def _compute_key(
+        stage: Stage,
+        input_fingerprints: Dict[str, str],
+    ) -> str:
+        payload = json.dumps(
+            {"stage": stage.name, "params": stage.params, "inputs": input_fingerprints},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _run_stage(
+        self,
+        stage: Stage,
+        artifacts: Dict[str, Any],
+        fingerprints: Dict[str, str],
+    ) -> Tuple[Any, str]:
+        key = self._compute_key(stage, {name: fingerprints[name] for name in stage.inputs})
+        if stage.cacheable and self.cache is not None:
+            value = self.cache.get(stage.name, key)
+            if value is not None and (stage.validate is None or stage.validate(value)):
+                log.info(f"Stage {stage.name}: cached")
+                get_metrics().inc("stage.cache_hits")
+                return (iter(value) if stage.stream else value), key
+            get_metrics().inc("stage.cache_misses")
+
+        if stage.stream:
+            items = stage.fn(**{name: artifacts[name] for name in stage.inputs})
+            return self._stream_items(stage, key, items), key
+
+        start_time = time.perf_counter()
+        with get_metrics().span(f"stage.{stage.name}"):
+            value = stage.fn(**{name: artifacts[name] for name in stage.inputs})
+        if not isinstance(value, stage.output_type):
+            raise TypeError(
+                f"Stage {stage.name} returned {type(value).__name__}, "
+                f"expected {stage.output_type.__name__}",
+            )
+        if stage.fingerprint is not None:
+            key = hashlib.sha256(f"{key}:{stage.fingerprint(value)}".encode("utf-8")).hexdigest()
+        if stage.cacheable and self.cache is not None:
+            self.cache.put(stage.name, key, value)
+        log.info(f"Stage {stage.name}: {time.perf_counter() - start_time:.1f} s")
+        return value, key
+
+    def _stream_items(
+        self,
+        stage: Stage,
+        key: str,
+        items: Iterable[Any],
+    ) -> Iterator[Any]:
+        # Runs in the consuming stage, the items are cached only if all of them were produced
+        start_time = time.perf_counter()
+        values = []
+        for value in items:
+            if not isinstance(value, stage.output_type):
+                raise TypeError(
+                    f"Stage {stage.name} yielded {type(value).__name__}, "
+                    f"expected {stage.output_type.__name__}",
+                )
+            values.append(value)
+            yield value
+        if stage.cacheable and self.cache is not None:
+            self.cache.put(stage.name, key, values)
+        log.info(f"Stage {stage.name}: {time.perf_counter() - start_time:.1f} s, streamed")
+
+    def run(
+        self,
+        targets: Optional[Iterable[str]] = None,
+        on_stage_start: Optional[Callable[[str], None]] = None,
+    ) -> Dict[str, Any]:
+        """Run the stages needed for the targets.
+
+        Args:
+            targets: Names of the stages to produce, all stages by default.
+            on_stage_start: Function called with the stage name before a stage starts.
+
+        Returns:
+            A dictionary mapping the names of the executed stages to their artifacts.
+        """
+        order = self.get_dependencies(targets or list(self.stages))
+        artifacts: Dict[str, Any] = {}
+        fingerprints: Dict[str, str] = {}
+        running: Dict[Future, str] = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(artifacts) < len(order):
+                for name in order:
+                    stage = self.stages[name]
+                    is_started = name in artifacts or name in running.values()
+                    if is_started or not all(dep in artifacts for dep in stage.inputs):
+                        continue
+                    if on_stage_start is not None:
+                        on_stage_start(name)
+                    future = executor.submit(self._run_stage, stage, artifacts, fingerprints)
+                    running[future] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        artifacts[name], fingerprints[name] = future.result()
+                    except BaseException:
+                        for other_future in running:
+                            other_future.cancel()
+                        raise
+
+        return artifacts
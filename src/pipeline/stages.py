@@ -0,0 +1,605 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import threading
+from glob import glob
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+from tqdm import tqdm
+
+from src import PROJECT_DIR
+from src.generate_csv_files import (
+    _write_archive,
+    _write_file_atomic,
+    filter_paths_by_category,
+    get_csv_path,
+    get_upload_jobs,
+    load_credentials,
+    save_csv_files,
+    schedule_days,
+    schedule_days_from_index,
+    stream_days_to_server,
+    verify_pin_availability,
+    verify_pin_counts,
+)
+from src.image_data.shard_ledger import ShardLedger
+from src.pipeline.runner import PipelineRunner, Stage
+from src.text_data.metadata_cache import MetadataCache
+from src.text_data.pin_index import PinIndex
+from src.text_data.sample_processor import SampleProcessor
+from src.utils import CSV_COLUMNS, get_dir_list
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def load_config(
+    config_name: str,
+    **overrides,
+) -> DictConfig:
+    # Same defaults as the Hydra entry points, for callers that do not go through Hydra
+    cfg = OmegaConf.load(os.path.join(PROJECT_DIR, "configs", f"{config_name}.yaml"))
+    cfg.pop("defaults", None)
+    for key, value in overrides.items():
+        cfg[key] = value
+    return cfg
+
+
+def fingerprint_dir(dir_path: str) -> str:
+    # Paths, sizes and mtimes are enough to notice added, removed and edited files
+    hasher = hashlib.sha256()
+    for root, dirs, files in os.walk(dir_path):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            file_stat = os.stat(file_path)
+            rel_path = os.path.relpath(file_path, dir_path)
+            hasher.update(f"{rel_path}:{file_stat.st_size}:{file_stat.st_mtime_ns}\n".encode())
+    return hasher.hexdigest()
+
+
+def _fingerprint_catalog(catalog: Dict[str, str]) -> str:
+    return json.dumps(catalog, sort_keys=True)
+
+
+def _has_upload_files(days: List[pd.DataFrame]) -> bool:
+    # Derivatives live in a cache directory that may have been cleaned up
+    return all(os.path.isfile(path) for df_day in days for path, _ in get_upload_jobs(df_day))
+
+
+def _add_image_stages(
+    pipeline: PipelineRunner,
+    cfg: DictConfig,
+    progress: Optional[Callable[[int], None]] = None,
+) -> None:
+    data_dir = str(os.path.join(PROJECT_DIR, cfg.data_dir))
+    save_dir = str(os.path.join(PROJECT_DIR, cfg.save_dir))
+    variant_cache_dir = None
+    if cfg.variant_cache_dir:
+        variant_cache_dir = str(os.path.join(PROJECT_DIR, cfg.variant_cache_dir))
+    ledger = None
+    if cfg.ledger_dir:
+        ledger = ShardLedger(
+            ledger_dir=str(os.path.join(PROJECT_DIR, cfg.ledger_dir)),
+            node_id=cfg.node_id,
+            lease_seconds=cfg.lease_seconds,
+        )
+    composite_params = {
+        "num_images_per_bg": cfg.num_images_per_bg,
+        "scaling_factor": cfg.scaling_factor,
+        "seed": cfg.seed,
+        "min_slot_area_ratio": cfg.min_slot_area_ratio,
+    }
+    report_params = {
+        "scaling_factor": cfg.scaling_factor,
+        "min_slot_area_ratio": cfg.min_slot_area_ratio,
+        "max_stretch": cfg.max_stretch,
+    }
+    strict_layouts = cfg.strict_layouts or cfg.preflight_only
+
+    def image_catalog() -> Dict[str, str]:
+        sample_dirs = get_dir_list(
+            data_dir=data_dir,
+            include_dirs=cfg.include_samples,
+            exclude_dirs=cfg.exclude_samples,
+        )
+        return {sample_dir: fingerprint_dir(sample_dir) for sample_dir in sample_dirs}
+
+    def layout_analysis(image_catalog: Dict[str, str]) -> Dict[str, pd.DataFrame]:
+        from src.image_data.image_matcher import ImageMatcher
+
+        matcher = ImageMatcher()
+        pairs = {}
+        for sample_dir in image_catalog:
+            layout_dir = os.path.join(sample_dir, "layouts")
+            bg_dir = os.path.join(sample_dir, "backgrounds")
+            layout_paths = matcher.get_file_list(layout_dir, "layout*.[jpPJ][nNpP][gG]")
+            bg_paths = matcher.get_file_list(bg_dir, "background*.[jpPJ][nNpP][gG]")
+            pairs[sample_dir] = matcher.create_dataframe(layout_paths, bg_paths)
+        return pairs
+
+    def foreground_index(image_catalog: Dict[str, str]) -> Dict[str, dict]:
+        from src.image_data.image_generator import ImageGenerator
+
+        # Bounding boxes only depend on the foregrounds, so the index is shared by all settings
+        generator = ImageGenerator(num_images_per_bg=0, scaling_factor=1, seed=0)
+        return {sample_dir: generator.index_foregrounds(sample_dir) for sample_dir in image_catalog}
+
+    def layout_report(
+        layout_analysis: Dict[str, pd.DataFrame],
+        foreground_index: Dict[str, dict],
+    ) -> pd.DataFrame:
+        from src.image_data.layout_analyzer import LayoutAnalyzer
+
+        # Broken layouts are skipped by composite, strict runs fail before any sample is generated
+        analyzer = LayoutAnalyzer(**report_params)
+        df = analyzer.analyze(pairs=layout_analysis, bboxes=foreground_index)
+        analyzer.log_report(df)
+        df_broken = df[df.is_broken]
+        if strict_layouts and len(df_broken):
+            broken = [f"{row.sample}/{row.layout_name}" for row in df_broken.itertuples()]
+            raise ValueError(f"Layouts without slots or foregrounds: {', '.join(broken)}")
+        return df
+
+    def composite(
+        image_catalog: Dict[str, str],
+        layout_analysis: Dict[str, pd.DataFrame],
+        foreground_index: Dict[str, dict],
+        layout_report: pd.DataFrame,
+    ) -> Dict[str, str]:
+        from src.image_data.image_generator import ImageGenerator
+
+        generator = ImageGenerator(
+            **composite_params,
+            variant_cache_dir=variant_cache_dir,
+            backend=cfg.backend,
+            num_workers=cfg.num_workers,
+            threads_per_worker=cfg.threads_per_worker,
+        )
+
+        num_slots = dict(zip(layout_report.layout_path, layout_report.num_slots))
+        broken_paths = set(layout_report.layout_path[layout_report.is_broken])
+        pairs = {
+            sample_dir: df[~df.layout_path.isin(broken_paths)]
+            for sample_dir, df in layout_analysis.items()
+        }
+
+        # Compositing writes the encoded PNGs directly, so each output directory keeps the
+        # fingerprint it was generated from and unchanged samples are skipped
+        sample_save_dirs = {}
+        pending_fingerprints = {}
+        for sample_dir, sample_fingerprint in image_catalog.items():
+            sample_save_dir = os.path.join(save_dir, Path(sample_dir).name)
+            fingerprint_path = os.path.join(sample_save_dir, ".fingerprint")
+            fingerprint = json.dumps([sample_fingerprint, composite_params], sort_keys=True)
+            sample_save_dirs[sample_dir] = sample_save_dir
+            if pairs[sample_dir].empty:
+                log.error(f"Sample {Path(sample_dir).name} is skipped, it has no usable layouts")
+                continue
+            if os.path.isfile(fingerprint_path):
+                with open(fingerprint_path, "r", encoding="utf-8") as f:
+                    if f.read() == fingerprint:
+                        log.info(f"Sample {Path(sample_dir).name} is up to date")
+                        continue
+            pending_fingerprints[sample_dir] = fingerprint
+
+        if ledger is None:
+            num_processed = 0
+            for sample_dir in tqdm(pending_fingerprints, desc="Creating images", unit="samples"):
+                df = pairs[sample_dir]
+                generator.process_sample(
+                    df=df,
+                    sample_dir=sample_dir,
+                    save_dir=save_dir,
+                    callback=None if progress is None else lambda n: progress(num_processed + n),
+                    bboxes=foreground_index[sample_dir],
+                    num_slots=num_slots,
+                )
+                num_processed += len(df)
+        else:
+            # Shards are (sample, layout) pairs, namespaced by the sample fingerprint so that
+            # changed inputs or settings are never mistaken for finished work
+            shards = {}
+            for sample_dir, fingerprint in pending_fingerprints.items():
+                run_id = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16]
+                for layout_id in pairs[sample_dir].layout_id.unique():
+                    shards[f"{Path(sample_dir).name}/{run_id}/{layout_id}"] = (
+                        sample_dir,
+                        layout_id,
+                    )
+
+            def _process_shard(shard: str) -> None:
+                sample_dir, layout_id = shards[shard]
+                log.info(f"Node {ledger.node_id}: shard {shard}")
+                generator.process_sample(
+                    df=pairs[sample_dir],
+                    sample_dir=sample_dir,
+                    save_dir=save_dir,
+                    bboxes=foreground_index[sample_dir],
+                    layout_ids={layout_id},
+                    num_slots=num_slots,
+                )
+
+            num_shards = ledger.run(list(shards), _process_shard, poll_interval=cfg.poll_interval)
+            log.info(f"Node {ledger.node_id}: {num_shards} of {len(shards)} shards processed")
+
+        for sample_dir, fingerprint in pending_fingerprints.items():
+            os.makedirs(sample_save_dirs[sample_dir], exist_ok=True)
+            fingerprint_path = os.path.join(sample_save_dirs[sample_dir], ".fingerprint")
+            with open(fingerprint_path, "w", encoding="utf-8") as f:
+                f.write(fingerprint)
+        return sample_save_dirs
+
+    pipeline.add_stage(
+        Stage("image_catalog", image_catalog, dict, fingerprint=_fingerprint_catalog),
+    )
+    pipeline.add_stage(
+        Stage("layout_analysis", layout_analysis, dict, inputs=["image_catalog"], cacheable=True),
+    )
+    pipeline.add_stage(
+        Stage(
+            "foreground_index",
+            foreground_index,
+            dict,
+            inputs=["image_catalog"],
+            cacheable=True,
+        ),
+    )
+    pipeline.add_stage(
+        Stage(
+            "layout_report",
+            layout_report,
+            pd.DataFrame,
+            inputs=["layout_analysis", "foreground_index"],
+            params={**report_params, "strict_layouts": strict_layouts},
+            cacheable=True,
+        ),
+    )
+    pipeline.add_stage(
+        Stage(
+            "composite",
+            composite,
+            dict,
+            inputs=["image_catalog", "layout_analysis", "foreground_index", "layout_report"],
+            params=composite_params,
+        ),
+    )
+
+
+def _add_csv_stages(
+    pipeline: PipelineRunner,
+    cfg: DictConfig,
+    progress: Optional[Callable[[int], None]] = None,
+) -> None:
+    data_dir = str(os.path.join(PROJECT_DIR, cfg.data_dir))
+    save_dir = str(os.path.join(PROJECT_DIR, cfg.save_dir))
+    pins_per_day = dict(cfg.pins_per_day)
+    start_date = datetime.datetime.strptime(str(cfg.start_date), "%Y-%m-%d")
+    pin_db = None
+    if cfg.pin_index_path:
+        pin_db = PinIndex(db_path=os.path.join(PROJECT_DIR, cfg.pin_index_path))
+    HOSTNAME, USERNAME, PASSWORD, PORT, REMOTE_ROOT_DIR, URL = load_credentials()
+
+    def csv_catalog() -> Dict[str, str]:
+        sample_dirs_ = sorted(glob(os.path.join(data_dir, "*/*")))
+        sample_dirs = filter_paths_by_category(sample_dirs_, pins_per_day)
+        return {sample_dir: fingerprint_dir(sample_dir) for sample_dir in sample_dirs}
+
+    def text_metadata(csv_catalog: Dict[str, str]) -> pd.DataFrame:
+        metadata_cache = None
+        if cfg.cache_path:
+            metadata_cache = MetadataCache(db_path=os.path.join(PROJECT_DIR, cfg.cache_path))
+        sample_processor = SampleProcessor(
+            url=URL,
+            remote_root_dir=REMOTE_ROOT_DIR,
+            column_names=CSV_COLUMNS,
+            seed=cfg.seed,
+            cache=metadata_cache,
+        )
+        return sample_processor.process_samples(
+            list(csv_catalog),
+            n_jobs=cfg.num_workers,
+            callback=progress,
+        )
+
+    def add_derivatives(days: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        if not cfg.create_derivatives:
+            yield from days
+            return
+
+        from src.text_data.derivative_generator import DerivativeGenerator
+
+        # Only scheduled pins are published, so only they get web-optimized media and thumbnails
+        derivative_generator = DerivativeGenerator(
+            cache_dir=os.path.join(PROJECT_DIR, cfg.derivative_dir),
+            url=URL,
+            image_format=cfg.derivative_format,
+            quality=cfg.derivative_quality,
+            media_size=cfg.media_size,
+            thumbnail_size=cfg.thumbnail_size,
+        )
+        for df_day in days:
+            yield derivative_generator.process(df_day, n_jobs=cfg.num_workers)
+
+    def near_duplicates(text_metadata: pd.DataFrame) -> pd.DataFrame:
+        df = text_metadata.drop_duplicates(subset=["Title"], keep="first")
+        if cfg.near_duplicate_distance is None:
+            return df
+
+        from src.text_data.duplicate_filter import DuplicateFilter
+
+        dhash_cache_path = None
+        if cfg.dhash_cache_path:
+            dhash_cache_path = os.path.join(PROJECT_DIR, cfg.dhash_cache_path)
+        duplicate_filter = DuplicateFilter(
+            max_distance=cfg.near_duplicate_distance,
+            cache_path=dhash_cache_path,
+        )
+        df_filtered = duplicate_filter.process(df, n_jobs=cfg.num_workers)
+        log.info(f"Near-duplicates removed: {len(df) - len(df_filtered)}")
+        return df_filtered
+
+    def pin_index(near_duplicates: pd.DataFrame) -> dict:
+        num_changed = pin_db.update(near_duplicates)
+        log.info(f"Pin index: {num_changed} pins added or changed")
+        return pin_db.count_unpublished(
+            list(pins_per_day),
+            before_date=start_date.strftime("%Y-%m-%d"),
+        )
+
+    def schedule(near_duplicates: pd.DataFrame) -> Iterator[pd.DataFrame]:
+        verify_pin_availability(near_duplicates, pins_per_day, num_days=cfg.num_days)
+        days = schedule_days(
+            df=near_duplicates,
+            pins_per_day=pins_per_day,
+            num_days=cfg.num_days,
+            start_date=start_date,
+            seed=cfg.seed,
+            overflow_step=cfg.publish_overflow_step,
+            jitter=cfg.publish_jitter,
+        )
+        return add_derivatives(days)
+
+    def schedule_from_index(pin_index: Dict[str, int]) -> Iterator[pd.DataFrame]:
+        verify_pin_counts(pin_index, pins_per_day, num_days=cfg.num_days)
+        days = schedule_days_from_index(
+            pin_index=pin_db,
+            pins_per_day=pins_per_day,
+            num_days=cfg.num_days,
+            start_date=start_date,
+            seed=cfg.seed,
+            overflow_step=cfg.publish_overflow_step,
+            jitter=cfg.publish_jitter,
+        )
+        return add_derivatives(days)
+
+    def upload(schedule: Iterator[pd.DataFrame]) -> list:
+        if not cfg.copy_files_to_server:
+            return list(schedule)
+
+        from src.text_data.ssh_file_transfer import SSHFileTransfer
+        from src.text_data.upload_journal import UploadJournal
+
+        # Upload images day by day and save each day's CSV once its uploads are confirmed
+        ssh_file_transfer = SSHFileTransfer(
+            username=USERNAME,
+            hostname=HOSTNAME,
+            port=PORT,
+            password=PASSWORD,
+            url=URL,
+        )
+        ssh_file_transfer.connect()
+        journal = None
+        if cfg.journal_path:
+            journal = UploadJournal(journal_path=os.path.join(PROJECT_DIR, cfg.journal_path))
+        remote_listing = None
+        if cfg.sync_remote_files or (journal is not None and cfg.verify_journal):
+            remote_listing = ssh_file_transfer.list_remote_files(REMOTE_ROOT_DIR)
+            if journal is not None:
+                journal.verify(remote_listing)
+        # Without sync, the remote listing is only used to verify the journal and remove stale
+        # files, the files to upload are decided by the journal alone
+        remote_files = remote_listing if cfg.sync_remote_files else None
+        if remote_files is None and journal is None:
+            ssh_file_transfer.remove_remote_dir(os.path.join(REMOTE_ROOT_DIR, "*"))
+
+        # A failing progress report, e.g. a cancelled job, stops the upload workers
+        stop_event = threading.Event()
+        errors: List[BaseException] = []
+
+        def _on_upload(*_) -> None:
+            pbar.update(1)
+            if progress is None:
+                return
+            try:
+                progress(pbar.n)
+            except Exception as e:
+                errors.append(e)
+                stop_event.set()
+
+        with tqdm(desc="Uploading images", unit="images") as pbar:
+            df_day_list, _ = stream_days_to_server(
+                days=schedule,
+                ssh_file_transfer=ssh_file_transfer,
+                save_dir=save_dir,
+                remote_files=remote_files,
+                journal=journal,
+                callback=_on_upload,
+                num_workers=cfg.num_upload_workers,
+                max_retries=cfg.upload_retries,
+                stop_event=stop_event,
+            )
+        if errors:
+            ssh_file_transfer.disconnect()
+            raise errors[0]
+        if not df_day_list:
+            ssh_file_transfer.disconnect()
+            raise RuntimeError("No day was uploaded completely, no CSV files were saved")
+        if remote_listing is not None or journal is not None:
+            # Remove the files of earlier runs that are not part of this schedule, without a
+            # remote listing the journal tells which files earlier runs left on the server
+            df_out = pd.concat(df_day_list, ignore_index=True)
+            used_paths = set(posixpath.normpath(path) for _, path in get_upload_jobs(df_out))
+            known_paths = set(remote_listing if remote_listing is not None else journal.entries)
+            stale_paths = known_paths - used_paths
+            ssh_file_transfer.remove_remote_files(stale_paths)
+            if journal is not None:
+                journal.discard(stale_paths)
+        ssh_file_transfer.disconnect()
+        if len(df_day_list) < cfg.num_days:
+            log.warning(f"CSV files saved for {len(df_day_list)} out of {cfg.num_days} days")
+        return df_day_list
+
+    def csv_write(upload: List[pd.DataFrame]) -> list:
+        df_out = pd.concat(upload, ignore_index=True)
+        archive_path = os.path.join(save_dir, "pins.zip") if cfg.archive_csv_files else None
+        if cfg.copy_files_to_server:
+            # The upload stage saved each day's CSV as soon as its images were confirmed
+            csv_paths = [
+                get_csv_path(pd.to_datetime(df_day["Publish date"].iloc[0]).date(), save_dir)
+                for df_day in upload
+            ]
+            if archive_path:
+                _write_file_atomic(lambda path: _write_archive(csv_paths, path), archive_path)
+        else:
+            csv_paths = save_csv_files(
+                df=df_out[CSV_COLUMNS],
+                save_dir=save_dir,
+                num_workers=cfg.num_workers,
+                archive_path=archive_path,
+            )
+
+        # Pins of the saved days are not scheduled again by runs starting after them
+        if pin_db is not None:
+            for df_day in upload:
+                pin_db.record_published(df_day)
+
+        # Remove local files
+        if cfg.remove_local_files:
+            for row in df_out.itertuples():
+                os.remove(row.src_path)
+        return csv_paths
+
+    schedule_params = {
+        "pins_per_day": pins_per_day,
+        "num_days": cfg.num_days,
+        "start_date": str(cfg.start_date),
+        "seed": cfg.seed,
+        "publish_overflow_step": cfg.publish_overflow_step,
+        "publish_jitter": cfg.publish_jitter,
+        "create_derivatives": cfg.create_derivatives,
+        "derivative_dir": cfg.derivative_dir,
+        "derivative_format": cfg.derivative_format,
+        "derivative_quality": cfg.derivative_quality,
+        "media_size": list(cfg.media_size),
+        "thumbnail_size": list(cfg.thumbnail_size),
+    }
+    pipeline.add_stage(Stage("csv_catalog", csv_catalog, dict, fingerprint=_fingerprint_catalog))
+    pipeline.add_stage(
+        Stage(
+            "text_metadata",
+            text_metadata,
+            pd.DataFrame,
+            inputs=["csv_catalog"],
+            params={"url": URL, "remote_root_dir": REMOTE_ROOT_DIR, "seed": cfg.seed},
+            cacheable=True,
+        ),
+    )
+    pipeline.add_stage(
+        Stage(
+            "near_duplicates",
+            near_duplicates,
+            pd.DataFrame,
+            inputs=["text_metadata"],
+            params={"near_duplicate_distance": cfg.near_duplicate_distance},
+            cacheable=True,
+        ),
+    )
+    if pin_db is None:
+        pipeline.add_stage(
+            Stage(
+                "schedule",
+                schedule,
+                pd.DataFrame,
+                inputs=["near_duplicates"],
+                params=schedule_params,
+                cacheable=True,
+                validate=_has_upload_files,
+                stream=True,
+            ),
+        )
+    else:
+        # The index is updated in place, so its stage is a source stage fingerprinted by the
+        # pins and publish history that the schedule depends on
+        before_date = start_date.strftime("%Y-%m-%d")
+        pipeline.add_stage(
+            Stage(
+                "pin_index",
+                pin_index,
+                dict,
+                inputs=["near_duplicates"],
+                fingerprint=lambda _: pin_db.get_history_fingerprint(before_date),
+            ),
+        )
+        pipeline.add_stage(
+            Stage(
+                "schedule",
+                schedule_from_index,
+                pd.DataFrame,
+                inputs=["pin_index"],
+                params=schedule_params,
+                cacheable=True,
+                validate=_has_upload_files,
+                stream=True,
+            ),
+        )
+    pipeline.add_stage(Stage("upload", upload, list, inputs=["schedule"]))
+    pipeline.add_stage(Stage("csv_write", csv_write, list, inputs=["upload"]))
+
+
+def build_pipeline(
+    images_cfg: Optional[DictConfig] = None,
+    csv_cfg: Optional[DictConfig] = None,
+    cache_dir: Optional[str] = None,
+    max_workers: int = 2,
+    progress: Optional[Callable[[int], None]] = None,
+) -> PipelineRunner:
+    """Build the pipeline with the image branch, the CSV branch or both.
+
+    Image branch: image_catalog -> layout_analysis, foreground_index -> layout_report ->
+    composite, where layout_report checks all layouts before any image is generated and
+    composite skips the broken ones.
+    CSV branch: csv_catalog -> text_metadata -> near_duplicates -> [pin_index] -> schedule ->
+    upload -> csv_write, where pin_index is only added when the CSV config sets pin_index_path
+    and schedule creates the derivatives of the scheduled pins. The schedule streams its days
+    into upload, so images of early days are uploaded while later days are still planned.
+
+    The DAG does not link the two branches: the CSV branch reads category/sample directories
+    with hand-written keywords, descriptions and links, which composite does not produce, so
+    generated images are still copied into the CSV data_dir by hand. The branches share no
+    artifacts, so with both enabled they run in parallel.
+
+    Args:
+        images_cfg: Config of the image generation, as in generate_images.yaml.
+        csv_cfg: Config of the CSV generation, as in generate_csv_files.yaml.
+        cache_dir: Directory of the artifact cache, relative to the project directory.
+        max_workers: The number of stages that may run at once.
+        progress: Function called with the number of processed items in long stages.
+
+    Returns:
+        The pipeline runner with the stages of the enabled branches.
+    """
+    if cache_dir:
+        cache_dir = os.path.join(PROJECT_DIR, cache_dir)
+    pipeline = PipelineRunner(cache_dir=cache_dir, max_workers=max_workers)
+    if images_cfg is not None:
+        _add_image_stages(pipeline, images_cfg, progress=progress)
+    if csv_cfg is not None:
+        _add_csv_stages(pipeline, csv_cfg, progress=progress)
+    return pipeline
@@ -0,0 +1,48 @@
+import logging
+import os
+
+import hydra
+from hydra.core.hydra_config import HydraConfig
+from omegaconf import DictConfig, OmegaConf
+
+from src import PROJECT_DIR
+from src.metrics import get_metrics, get_report_path
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+@hydra.main(
+    config_path=os.path.join(PROJECT_DIR, "configs"),
+    config_name="run_pipeline",
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f"Config:\n\n{OmegaConf.to_yaml(cfg)}")
+
+    # Imported here so that config errors and --help do not wait for cv2 and pandas
+    from src.pipeline.stages import build_pipeline
+
+    # Run both branches in one go, they are not linked and generated images are not passed to
+    # the CSV branch. Only stages downstream of changed inputs are recomputed
+    pipeline = build_pipeline(
+        images_cfg=cfg.images if cfg.run_images else None,
+        csv_cfg=cfg.csv if cfg.run_csv else None,
+        cache_dir=cfg.pipeline_cache_dir,
+        max_workers=cfg.max_workers,
+    )
+    artifacts = pipeline.run()
+
+    if "csv_write" in artifacts:
+        log.info(f"Saved CSV files: {len(artifacts['csv_write'])}")
+    if "composite" in artifacts:
+        log.info(f"Processed samples: {len(artifacts['composite'])}")
+    # Save the run report next to the Hydra log
+    report_path = get_metrics().save_report(get_report_path(HydraConfig.get().runtime.output_dir))
+    log.info(f"Run report: {report_path}")
+
+    log.info("Complete")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import contextlib
+import hashlib
+import os
+import posixpath
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from src.metrics import collect_metrics, get_metrics, run_with_metrics
+from src.text_data.sample_processor import SampleProcessor
+
+
+class DerivativeGenerator:
+    """A class for creating web-optimized derivatives of pin images.
+
+    Every source image gets a media variant fitted into media_size (Pinterest recommends
+    1000x1500) and a small thumbnail, both encoded as WebP or JPEG. Derivatives are stored in
+    cache_dir under the SHA-256 of the source content and the encoding parameters, so unchanged
+    images are never encoded twice and edited images get new derivatives. Source hashes are kept
+    in an SQLite index keyed by the path, size and mtime of the source, so a rerun only hashes
+    new or edited images. Rows of deleted sources are pruned when the generator is created.
+    """
+
+    EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg"}
+
+    def __init__(
+        self,
+        cache_dir: str,
+        url: str,
+        image_format: str = "webp",
+        quality: int = 85,
+        media_size: Tuple[int, int] = (1000, 1500),
+        thumbnail_size: Tuple[int, int] = (200, 300),
+    ) -> None:
+        if image_format not in self.EXTENSIONS:
+            raise ValueError(f"Unsupported image format: {image_format}")
+        self.cache_dir = cache_dir
+        self.url = url
+        self.image_format = image_format
+        self.quality = quality
+        self.media_size = tuple(media_size)
+        self.thumbnail_size = tuple(thumbnail_size)
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS source_hash (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL
+                )
+                """,
+            )
+        self._prune_hashes()
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        db_path = os.path.join(self.cache_dir, "source_hashes.sqlite")
+        with contextlib.closing(sqlite3.connect(db_path, timeout=30)) as conn, conn:
+            yield conn
+
+    @staticmethod
+    def compute_hash(file_path: str, chunk_size: int = 2**20) -> str:
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    @property
+    def extension(self) -> str:
+        return self.EXTENSIONS[self.image_format]
+
+    def _get_cache_path(
+        self,
+        src_hash: str,
+        size: Tuple[int, int],
+    ) -> str:
+        width, height = size
+        filename = f"{src_hash}_{width}x{height}_q{self.quality}{self.extension}"
+        return os.path.join(self.cache_dir, src_hash[:2], filename)
+
+    @staticmethod
+    def _resize_to_fit(
+        img: np.ndarray,
+        size: Tuple[int, int],
+    ) -> np.ndarray:
+        # Keep the aspect ratio and never upscale
+        width, height = size
+        scale = min(width / img.shape[1], height / img.shape[0])
+        if scale >= 1:
+            return img
+        dsize = (max(round(img.shape[1] * scale), 1), max(round(img.shape[0] * scale), 1))
+        return cv2.resize(img, dsize=dsize, interpolation=cv2.INTER_AREA)
+
+    def _encode(
+        self,
+        img: np.ndarray,
+    ) -> bytes:
+        if self.image_format == "jpeg":
+            if img.ndim == 3 and img.shape[2] == 4:
+                # JPEG has no alpha channel, so transparent regions are flattened onto white
+                alpha = img[:, :, 3:4] / 255.0
+                img = (img[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8)
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+        else:
+            params = [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        success, buffer = cv2.imencode(self.extension, img, params)
+        if not success:
+            raise RuntimeError(f"Failed to encode image as {self.image_format}")
+        return buffer.tobytes()
+
+    @staticmethod
+    def _write_atomic(
+        data: bytes,
+        path: str,
+    ) -> None:
+        # Concurrent workers may produce the same derivative, the last rename wins
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _prune_hashes(self) -> None:
+        # Sources are removed after upload, rows of files that no longer exist are dropped once per
+        # generator rather than on every batch of pins
+        with self._connect() as conn:
+            deleted_paths = [
+                (path,)
+                for (path,) in conn.execute("SELECT path FROM source_hash")
+                if not os.path.exists(path)
+            ]
+            conn.executemany("DELETE FROM source_hash WHERE path = ?", deleted_paths)
+        get_metrics().inc("derivative.pruned", len(deleted_paths))
+
+    def _get_cached_hashes(
+        self,
+        img_paths: List[str],
+    ) -> List[Optional[str]]:
+        with self._connect() as conn:
+            # Only the requested rows are read, the temporary table is dropped with the connection
+            conn.execute("CREATE TEMP TABLE requested (path TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO requested VALUES (?)",
+                [(os.path.abspath(img_path),) for img_path in img_paths],
+            )
+            cached = {
+                path: (size, mtime_ns, sha256)
+                for path, size, mtime_ns, sha256 in conn.execute(
+                    "SELECT source_hash.* FROM source_hash JOIN requested USING (path)",
+                )
+            }
+        src_hashes: List[Optional[str]] = []
+        for img_path in img_paths:
+            entry = cached.get(os.path.abspath(img_path))
+            img_stat = os.stat(img_path)
+            is_valid = entry is not None and entry[:2] == (img_stat.st_size, img_stat.st_mtime_ns)
+            src_hashes.append(entry[2] if is_valid else None)
+        return src_hashes
+
+    def _put_hashes(
+        self,
+        img_paths: List[str],
+        src_hashes: List[str],
+    ) -> None:
+        records = []
+        for img_path, src_hash in zip(img_paths, src_hashes):
+            img_stat = os.stat(img_path)
+            records.append(
+                (os.path.abspath(img_path), img_stat.st_size, img_stat.st_mtime_ns, src_hash),
+            )
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO source_hash VALUES (?, ?, ?, ?)", records)
+
+    def create_derivatives(
+        self,
+        img_path: str,
+        src_hash: Optional[str] = None,
+    ) -> Dict[str, str]:
+        if src_hash is None:
+            src_hash = self.compute_hash(img_path)
+            get_metrics().inc("derivative.hashed")
+        derivative_paths = {
+            "media_path": self._get_cache_path(src_hash, self.media_size),
+            "thumbnail_path": self._get_cache_path(src_hash, self.thumbnail_size),
+        }
+        metrics = get_metrics()
+        if all(os.path.isfile(path) for path in derivative_paths.values()):
+            metrics.inc("derivative.cache_hits")
+            return {**derivative_paths, "src_hash": src_hash}
+
+        metrics.inc("derivative.cache_misses")
+        with metrics.span("derivative.image"):
+            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+            if img is None:
+                raise ValueError(f"Failed to read image: {img_path}")
+            metrics.inc("images.decoded")
+            img_media = self._resize_to_fit(img, self.media_size)
+            img_thumbnail = self._resize_to_fit(img_media, self.thumbnail_size)
+            for img_variant, key in [(img_media, "media_path"), (img_thumbnail, "thumbnail_path")]:
+                data = self._encode(img_variant)
+                self._write_atomic(data, derivative_paths[key])
+                metrics.inc("bytes.written", len(data))
+        return {**derivative_paths, "src_hash": src_hash}
+
+    def _get_remote_path(
+        self,
+        dst_path: str,
+        suffix: str = "",
+    ) -> str:
+        stem = Path(dst_path).stem
+        return posixpath.join(posixpath.dirname(dst_path), f"{stem}{suffix}{self.extension}")
+
+    def process(
+        self,
+        df: pd.DataFrame,
+        n_jobs: int = 1,
+    ) -> pd.DataFrame:
+        """Create derivatives for every pin and point the pin URLs at them.
+
+        Args:
+            df: DataFrame produced by SampleProcessor with src_path and dst_path columns.
+            n_jobs: The number of images processed in parallel.
+
+        Returns:
+            A copy of the DataFrame with media_path, thumbnail_path and thumbnail_dst_path added,
+            dst_path pointing at the remote media variant and the Media URL and Thumbnail columns
+            filled with the URLs of the variants.
+        """
+        img_paths = df.src_path.tolist()
+        cached_hashes = self._get_cached_hashes(img_paths)
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(run_with_metrics)(self.create_derivatives, os.getpid(), img_path, src_hash)
+            for img_path, src_hash in tqdm(
+                zip(img_paths, cached_hashes),
+                total=len(img_paths),
+                desc="Creating derivatives",
+                unit="images",
+            )
+        )
+        derivative_list: List[Dict[str, str]] = [collect_metrics(result) for result in results]
+        missing_idx = [idx for idx, src_hash in enumerate(cached_hashes) if src_hash is None]
+        if missing_idx:
+            self._put_hashes(
+                [img_paths[idx] for idx in missing_idx],
+                [derivative_list[idx]["src_hash"] for idx in missing_idx],
+            )
+
+        df = df.copy()
+        df["media_path"] = [paths["media_path"] for paths in derivative_list]
+        df["thumbnail_path"] = [paths["thumbnail_path"] for paths in derivative_list]
+        df["dst_path"] = [self._get_remote_path(dst_path) for dst_path in df.dst_path]
+        df["thumbnail_dst_path"] = [
+            self._get_remote_path(dst_path, suffix="_thumbnail") for dst_path in df.dst_path
+        ]
+        df["Media URL"] = [
+            SampleProcessor._get_file_url(dst_path, self.url) for dst_path in df.dst_path
+        ]
+        df["Thumbnail"] = [
+            SampleProcessor._get_file_url(dst_path, self.url) for dst_path in df.thumbnail_dst_path
+        ]
+        return df
+
+
+if __name__ == "__main__":
+    # Test DerivativeGenerator class
+    derivative_generator = DerivativeGenerator(
+        cache_dir="data/cache/derivatives",
+        url="https://example.com/pins",
+    )
+    print(derivative_generator.create_derivatives("data/test-img.jpg"))
@@ -1,50 +1,52 @@
 import random
-from typing import List
+from itertools import islice
+from typing import Iterator, List, Optional
 
 import pandas as pd
 
 
 class DescriptionGenerator:
-    """A class for generating a list of descriptions with diversity and randomness."""
+    """A class for generating a list of descriptions with diversity and randomness.
+
+    Descriptions are emitted in blocks, each block being a shuffled permutation of the unique
+    descriptions, so every description is used once before any of them repeats and no two
+    consecutive descriptions are equal, including across block boundaries.
+    """
 
     def __init__(
         self,
         df: pd.DataFrame,
+        rng: Optional[random.Random] = None,
     ) -> None:
-        self.descriptions = df["Description"].tolist()
-        self.unique_descriptions = set(self.descriptions)
-        random.shuffle(self.descriptions)
+        # Sort to make the shuffles independent of the string hash randomization
+        self.unique_descriptions = sorted(set(df["Description"].tolist()))
+        self.rng = rng if rng is not None else random.Random()
         self.prev_desc = None
 
-    def generate_descriptions(
-        self,
-        num_descriptions: int,
-    ) -> List[str]:
-        result: List[str] = []
-        remaining_unique = self.unique_descriptions.copy()
+    def _next_block(self) -> List[str]:
+        block = self.unique_descriptions.copy()
+        self.rng.shuffle(block)
 
-        while len(result) < num_descriptions:
-            if self.prev_desc is not None:
-                remaining_unique.discard(self.prev_desc)
+        # Avoid repeating the last emitted description at the block boundary
+        if len(block) > 1 and block[0] == self.prev_desc:
+            swap_idx = self.rng.randrange(1, len(block))
+            block[0], block[swap_idx] = block[swap_idx], block[0]
+        return block
 
-            remaining_descriptions = list(remaining_unique)
-            random.shuffle(remaining_descriptions)
+    def iter_descriptions(self) -> Iterator[str]:
+        if not self.unique_descriptions:
+            return
 
-            for desc in remaining_descriptions:
-                if desc != self.prev_desc:
-                    result.append(desc)
-                    self.prev_desc = desc
-                    remaining_unique.discard(desc)
-                    break
+        while True:
+            for desc in self._next_block():
+                self.prev_desc = desc
+                yield desc
 
-            if not remaining_unique:
-                random.shuffle(self.descriptions)
-                for desc in self.descriptions:
-                    if desc != self.prev_desc:
-                        result.append(desc)
-                        self.prev_desc = desc
-                        break
-        return result[:num_descriptions]
+    def generate_descriptions(
+        self,
+        num_descriptions: int,
+    ) -> List[str]:
+        return list(islice(self.iter_descriptions(), num_descriptions))
 
 
 if __name__ == "__main__":
@@ -54,6 +56,6 @@ if __name__ == "__main__":
         "data/csv_generation/ds-01/instagram-highlight-covers/black-celestial/descriptions.csv"
     )
     df = pd.read_csv(description_path)
-    desc_generator = DescriptionGenerator(df=df)
+    desc_generator = DescriptionGenerator(df=df, rng=random.Random(11))
     desc_list = desc_generator.generate_descriptions(num_descriptions=num_images)
     print("Generated Descriptions:", desc_list)
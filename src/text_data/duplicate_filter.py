@@ -0,0 +1,224 @@
+import contextlib
+import os
+import sqlite3
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from src.metrics import collect_metrics, get_metrics, run_with_metrics
+
+HASH_SIZE = 8  # 8x8 difference bits fit a 64-bit hash
+
+
+class DuplicateFilter:
+    """A class for removing visually near-identical pins.
+
+    Every image is reduced to a 64-bit difference hash (dHash): the grayscale image is shrunk to
+    9x8 pixels and each bit tells whether a pixel is brighter than its left neighbour, so
+    composites that differ only in a swapped foreground or two end up a few bits apart. Hashes
+    are computed in batches with NumPy and, with a cache path, stored in SQLite keyed by the file
+    path, size and mtime, so daily runs only hash new images. Only the rows of the requested
+    images are read and rows of deleted images are pruned.
+
+    Near-duplicates are found with multi-index hashing: the hash is split into max_distance + 1
+    chunks and any two hashes within max_distance bits agree on at least one chunk. Only images
+    sharing a chunk value are compared, which keeps queries sub-linear in the number of images.
+    """
+
+    def __init__(
+        self,
+        max_distance: int = 4,
+        cache_path: Optional[str] = None,
+    ) -> None:
+        if not 0 <= max_distance < HASH_SIZE * HASH_SIZE:
+            raise ValueError(f"Invalid Hamming distance: {max_distance}")
+        self.max_distance = max_distance
+        self.cache_path = cache_path
+        if cache_path:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS dhash (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        hash INTEGER NOT NULL
+                    )
+                    """,
+                )
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Committed and closed on exit, a bare connection context only commits
+        with contextlib.closing(sqlite3.connect(self.cache_path, timeout=30)) as conn, conn:
+            yield conn
+
+    @staticmethod
+    def _load_image(img_path: str) -> np.ndarray:
+        # Reduced decoding skips most of the work for JPEG and WebP, the hash only needs 9x8 pixels
+        img = cv2.imread(img_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        if img is None:
+            raise ValueError(f"Failed to read image: {img_path}")
+        get_metrics().inc("images.decoded")
+        return cv2.resize(img, dsize=(HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def compute_dhashes(images: np.ndarray) -> np.ndarray:
+        """Compute the difference hashes of a stack of 9x8 grayscale images.
+
+        Args:
+            images: Array of shape (N, 8, 9).
+
+        Returns:
+            Array of N unsigned 64-bit hashes.
+        """
+        bits = images[:, :, 1:] > images[:, :, :-1]
+        packed = np.packbits(bits.reshape(len(images), -1), axis=1)
+        return packed.view(">u8").ravel().astype(np.uint64)
+
+    def _hash_batch(self, img_paths: List[str]) -> np.ndarray:
+        return self.compute_dhashes(np.stack([self._load_image(path) for path in img_paths]))
+
+    def _get_cached_hashes(self, img_paths: List[str]) -> Dict[str, Tuple[int, int, int]]:
+        with self._connect() as conn:
+            # Only the requested rows are read, the temporary table is dropped with the connection
+            conn.execute("CREATE TEMP TABLE requested (path TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO requested VALUES (?)",
+                [(path,) for path in img_paths],
+            )
+            cached = {
+                path: (size, mtime_ns, value)
+                for path, size, mtime_ns, value in conn.execute(
+                    "SELECT dhash.* FROM dhash JOIN requested USING (path)",
+                )
+            }
+
+            # Sources are removed after upload, rows of files that no longer exist are pruned
+            deleted_paths = [
+                (path,)
+                for (path,) in conn.execute(
+                    "SELECT path FROM dhash WHERE path NOT IN (SELECT path FROM requested)",
+                )
+                if not os.path.exists(path)
+            ]
+            conn.executemany("DELETE FROM dhash WHERE path = ?", deleted_paths)
+        get_metrics().inc("dhash.pruned", len(deleted_paths))
+        return cached
+
+    def compute_hashes(
+        self,
+        img_paths: List[str],
+        n_jobs: int = 1,
+        batch_size: int = 256,
+    ) -> np.ndarray:
+        stats = [os.stat(path) for path in img_paths]
+        hashes = np.zeros(len(img_paths), dtype=np.uint64)
+
+        cached: Dict[str, Tuple[int, int, int]] = {}
+        if self.cache_path:
+            cached = self._get_cached_hashes(img_paths)
+        missing_idx = []
+        for idx, (path, stat) in enumerate(zip(img_paths, stats)):
+            entry = cached.get(path)
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                # SQLite integers are signed, hashes are stored as their two's complement
+                hashes[idx] = np.int64(entry[2]).view(np.uint64)
+            else:
+                missing_idx.append(idx)
+        get_metrics().inc("dhash.cache_hits", len(img_paths) - len(missing_idx))
+        get_metrics().inc("dhash.cache_misses", len(missing_idx))
+        if not missing_idx:
+            return hashes
+
+        batches = [
+            missing_idx[start : start + batch_size]
+            for start in range(0, len(missing_idx), batch_size)
+        ]
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(run_with_metrics)(
+                self._hash_batch,
+                os.getpid(),
+                [img_paths[idx] for idx in batch],
+            )
+            for batch in tqdm(batches, desc="Hashing images", unit="batches")
+        )
+        for batch, result in zip(batches, results):
+            hashes[batch] = collect_metrics(result)
+
+        if self.cache_path:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO dhash VALUES (?, ?, ?, ?)",
+                    [
+                        (
+                            img_paths[idx],
+                            stats[idx].st_size,
+                            stats[idx].st_mtime_ns,
+                            int(hashes[idx].view(np.int64)),
+                        )
+                        for idx in missing_idx
+                    ],
+                )
+        return hashes
+
+    def find_duplicates(self, hashes: np.ndarray) -> np.ndarray:
+        """Flag every hash within max_distance bits of an earlier kept hash.
+
+        Args:
+            hashes: Array of unsigned 64-bit hashes in priority order.
+
+        Returns:
+            Boolean array, True for near-duplicates of an earlier image.
+        """
+        num_chunks = self.max_distance + 1
+        bounds = np.linspace(0, HASH_SIZE * HASH_SIZE, num_chunks + 1).astype(np.uint64)
+        chunks = np.stack(
+            [
+                (hashes >> lower) & np.uint64((1 << int(upper - lower)) - 1)
+                for lower, upper in zip(bounds[:-1], bounds[1:])
+            ],
+            axis=1,
+        ).tolist()
+        hash_list = hashes.tolist()
+
+        # Buckets hold the kept images only, so every group of near-duplicates keeps its first image
+        buckets: List[Dict[int, List[int]]] = [defaultdict(list) for _ in range(num_chunks)]
+        is_duplicate = np.zeros(len(hash_list), dtype=bool)
+        for idx, (value, chunk_values) in enumerate(zip(hash_list, chunks)):
+            candidates = set()
+            for bucket, chunk_value in zip(buckets, chunk_values):
+                candidates.update(bucket.get(chunk_value, ()))
+            if any(
+                (value ^ hash_list[other]).bit_count() <= self.max_distance for other in candidates
+            ):
+                is_duplicate[idx] = True
+                continue
+            for bucket, chunk_value in zip(buckets, chunk_values):
+                bucket[chunk_value].append(idx)
+        return is_duplicate
+
+    def process(
+        self,
+        df: pd.DataFrame,
+        n_jobs: int = 1,
+    ) -> pd.DataFrame:
+        # Derivatives are only created for scheduled pins, so the sources are hashed, their cached
+        # hashes make this a one-time cost per image
+        hashes = self.compute_hashes(df.src_path.tolist(), n_jobs=n_jobs)
+        is_duplicate = self.find_duplicates(hashes)
+        get_metrics().inc("near_duplicates.removed", int(is_duplicate.sum()))
+        return df[~is_duplicate]
+
+
+if __name__ == "__main__":
+    # Test DuplicateFilter class
+    duplicate_filter = DuplicateFilter(max_distance=4)
+    hashes = duplicate_filter.compute_hashes(["data/test-img.jpg", "data/test-img.jpg"])
+    print([f"{value:016x}" for value in hashes], duplicate_filter.find_duplicates(hashes))
@@ -0,0 +1,137 @@
+import contextlib
+import hashlib
+import os
+import sqlite3
+from glob import glob
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import pandas as pd
+
+
+class MetadataCache:
+    """A class for caching generated pin metadata on disk.
+
+    Generated titles, descriptions, links and boards are stored in an SQLite database keyed by
+    the absolute path of the sample, a hash of its content and the seed. The content hash covers
+    the text files of the sample and its image set, so editing any of them invalidates the cached
+    rows.
+    """
+
+    SAMPLE_FILES = ["keywords.csv", "descriptions.csv", "links.csv", "board.csv"]
+    METADATA_COLUMNS = ["Title", "Description", "Link", "Pinterest board"]
+
+    def __init__(
+        self,
+        db_path: str,
+    ) -> None:
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS metadata (
+                    sample_key TEXT NOT NULL,
+                    sample_hash TEXT NOT NULL,
+                    seed INTEGER NOT NULL,
+                    img_key TEXT NOT NULL,
+                    title TEXT,
+                    description TEXT,
+                    link TEXT,
+                    board TEXT,
+                    PRIMARY KEY (sample_key, sample_hash, seed, img_key)
+                )
+                """,
+            )
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per call keeps the cache usable from joblib workers, it is committed and
+        # closed on exit
+        with contextlib.closing(sqlite3.connect(self.db_path, timeout=30)) as conn, conn:
+            yield conn
+
+    @staticmethod
+    def get_sample_key(sample_dir: str) -> str:
+        # Samples of different data directories may share their category and name
+        return Path(sample_dir).resolve().as_posix()
+
+    @staticmethod
+    def get_img_key(img_path: str) -> str:
+        return "/".join(Path(img_path).parts[-2:])
+
+    def compute_sample_hash(
+        self,
+        sample_dir: str,
+        img_paths: List[str],
+    ) -> str:
+        hasher = hashlib.sha256()
+        for filename in self.SAMPLE_FILES:
+            file_path = os.path.join(sample_dir, filename)
+            hasher.update(filename.encode("utf-8"))
+            if os.path.isfile(file_path):
+                with open(file_path, "rb") as f:
+                    hasher.update(f.read())
+        for img_path in sorted(img_paths):
+            hasher.update(self.get_img_key(img_path).encode("utf-8"))
+            hasher.update(str(os.path.getsize(img_path)).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def get(
+        self,
+        sample_dir: str,
+        sample_hash: str,
+        seed: int,
+    ) -> Optional[pd.DataFrame]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT img_key, title, description, link, board FROM metadata "
+                "WHERE sample_key = ? AND sample_hash = ? AND seed = ?",
+                (self.get_sample_key(sample_dir), sample_hash, seed),
+            ).fetchall()
+        if not rows:
+            return None
+        df = pd.DataFrame(rows, columns=["img_key"] + self.METADATA_COLUMNS)
+        return df.set_index("img_key")
+
+    def put(
+        self,
+        sample_dir: str,
+        sample_hash: str,
+        seed: int,
+        img_paths: List[str],
+        df: pd.DataFrame,
+    ) -> None:
+        sample_key = self.get_sample_key(sample_dir)
+        records = [
+            (sample_key, sample_hash, seed, self.get_img_key(img_path), *values)
+            for img_path, values in zip(
+                img_paths,
+                df[self.METADATA_COLUMNS].itertuples(index=False, name=None),
+            )
+        ]
+        with self._connect() as conn:
+            # Drop rows of outdated versions of the sample before storing the new ones
+            conn.execute(
+                "DELETE FROM metadata WHERE sample_key = ? AND seed = ? AND sample_hash != ?",
+                (sample_key, seed, sample_hash),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                records,
+            )
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM metadata")
+
+
+if __name__ == "__main__":
+    # Test MetadataCache class
+    sample_dir = "data/csv_generation/instagram-highlight-covers/black-celestial"
+    img_paths = sorted(glob(os.path.join(sample_dir, "*/*.[jpPJ][nNpP][gG]")))
+    cache = MetadataCache(db_path="data/cache/metadata.sqlite")
+    sample_hash = cache.compute_sample_hash(sample_dir, img_paths)
+    df_cached = cache.get(sample_dir, sample_hash, seed=11)
+    print("Sample hash:", sample_hash)
+    print("Cached rows:", 0 if df_cached is None else len(df_cached))
@@ -0,0 +1,227 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+import pandas as pd
+
+
+class PinIndex:
+    """A persistent SQLite index of candidate pins and their publish history.
+
+    Every pin produced by SampleProcessor is stored with its category, title, link and the full
+    row, keyed by its category/sample/sample_id/image path. Updates are incremental: unchanged
+    rows are left alone and pins that disappeared from disk are deactivated. Published pins are
+    recorded per publish date, so scheduling can query the unpublished pins of a category in
+    index order instead of rebuilding and deduplicating the full DataFrame on every run.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+    ) -> None:
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS pins (
+                    pin_key TEXT PRIMARY KEY,
+                    category TEXT NOT NULL,
+                    title TEXT,
+                    link TEXT,
+                    rank TEXT NOT NULL,
+                    active INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS pins_category_rank ON pins (category, active, rank);
+                CREATE TABLE IF NOT EXISTS publish_history (
+                    pin_key TEXT NOT NULL,
+                    publish_date TEXT NOT NULL,
+                    recorded_at INTEGER NOT NULL,
+                    PRIMARY KEY (pin_key, publish_date)
+                );
+                CREATE INDEX IF NOT EXISTS publish_history_date ON publish_history (publish_date);
+                """,
+            )
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Committed and closed on exit, a bare connection context only commits
+        with contextlib.closing(sqlite3.connect(self.db_path, timeout=30)) as conn, conn:
+            yield conn
+
+    @staticmethod
+    def get_pin_key(src_path: str) -> str:
+        return "/".join(Path(src_path).parts[-4:])
+
+    @staticmethod
+    def _get_rank(pin_key: str) -> str:
+        # A stable pseudo-random order, so consecutive days draw from all samples of a category
+        return hashlib.sha256(pin_key.encode("utf-8")).hexdigest()
+
+    def update(self, df: pd.DataFrame) -> int:
+        """Upsert the pins of a catalog and deactivate pins of its categories that are gone.
+
+        Args:
+            df: DataFrame of pins with at least src_path, category, Title and Link columns.
+
+        Returns:
+            The number of inserted or changed pins.
+        """
+        now = int(time.time())
+        records = []
+        for row in df.to_dict(orient="records"):
+            pin_key = self.get_pin_key(row["src_path"])
+            data = json.dumps(row, sort_keys=True, default=str)
+            records.append(
+                (
+                    pin_key,
+                    row["category"],
+                    row["Title"],
+                    row["Link"],
+                    self._get_rank(pin_key),
+                    data,
+                ),
+            )
+
+        with self._connect() as conn:
+            num_changes_before = conn.total_changes
+            conn.executemany(
+                """
+                INSERT INTO pins (pin_key, category, title, link, rank, active, data, updated_at)
+                VALUES (?, ?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT (pin_key) DO UPDATE SET
+                    category = excluded.category,
+                    title = excluded.title,
+                    link = excluded.link,
+                    active = 1,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+                WHERE pins.data != excluded.data OR pins.active = 0
+                """,
+                [(*record, now) for record in records],
+            )
+            num_changed = conn.total_changes - num_changes_before
+
+            # Pins of the indexed categories that are no longer in the catalog stay in the
+            # history but can no longer be scheduled
+            conn.execute("CREATE TEMP TABLE current_pins (pin_key TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT INTO current_pins VALUES (?)",
+                [(record[0],) for record in records],
+            )
+            categories = sorted(set(df["category"]))
+            conn.execute(
+                f"""
+                UPDATE pins SET active = 0, updated_at = ?
+                WHERE active = 1
+                AND category IN ({", ".join("?" * len(categories))})
+                AND pin_key NOT IN (SELECT pin_key FROM current_pins)
+                """,
+                (now, *categories),
+            )
+            conn.execute("DROP TABLE current_pins")
+        return num_changed
+
+    def iter_unpublished(
+        self,
+        category: str,
+        before_date: str,
+        page_size: int = 256,
+    ) -> Iterator[pd.Series]:
+        # Pins published on or after before_date belong to the plan being rebuilt and are eligible
+        last_rank = ""
+        while True:
+            # Pages continue after the last rank, so a suspended iterator holds no connection
+            with self._connect() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT rank, data FROM pins
+                    WHERE category = ? AND active = 1 AND rank > ? AND NOT EXISTS (
+                        SELECT 1 FROM publish_history
+                        WHERE publish_history.pin_key = pins.pin_key
+                        AND publish_history.publish_date < ?
+                    )
+                    ORDER BY rank
+                    LIMIT ?
+                    """,
+                    (category, last_rank, before_date, page_size),
+                ).fetchall()
+            for last_rank, data in rows:
+                yield pd.Series(json.loads(data))
+            if len(rows) < page_size:
+                return
+
+    def count_unpublished(
+        self,
+        categories: List[str],
+        before_date: str,
+    ) -> Dict[str, int]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT category, COUNT(*) FROM pins
+                WHERE active = 1
+                AND category IN ({", ".join("?" * len(categories))})
+                AND NOT EXISTS (
+                    SELECT 1 FROM publish_history
+                    WHERE publish_history.pin_key = pins.pin_key
+                    AND publish_history.publish_date < ?
+                )
+                GROUP BY category
+                """,
+                (*categories, before_date),
+            ).fetchall()
+        return {category: dict(rows).get(category, 0) for category in categories}
+
+    def get_history_fingerprint(self, before_date: str) -> str:
+        # Changes whenever the pins eligible for a plan starting at before_date change
+        hasher = hashlib.sha256()
+        with self._connect() as conn:
+            for pin_key, updated_at, active in conn.execute(
+                "SELECT pin_key, updated_at, active FROM pins ORDER BY pin_key",
+            ):
+                hasher.update(f"{pin_key}:{updated_at}:{active}\n".encode("utf-8"))
+            for pin_key, publish_date in conn.execute(
+                "SELECT pin_key, publish_date FROM publish_history WHERE publish_date < ? "
+                "ORDER BY pin_key, publish_date",
+                (before_date,),
+            ):
+                hasher.update(f"{pin_key}@{publish_date}\n".encode("utf-8"))
+        return hasher.hexdigest()
+
+    def record_published(self, df_day: pd.DataFrame) -> None:
+        # Saving a day again replaces its previous plan
+        now = int(time.time())
+        publish_day = str(df_day["Publish date"].iloc[0])[:10]
+        records = [
+            (self.get_pin_key(src_path), publish_date, now)
+            for src_path, publish_date in zip(df_day.src_path, df_day["Publish date"])
+        ]
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM publish_history WHERE substr(publish_date, 1, 10) = ?",
+                (publish_day,),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO publish_history VALUES (?, ?, ?)",
+                records,
+            )
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM pins")
+            conn.execute("DELETE FROM publish_history")
+
+
+if __name__ == "__main__":
+    # Test PinIndex class
+    index = PinIndex(db_path="data/cache/pin_index.sqlite")
+    categories = ["canva-instagram-templates", "instagram-highlight-covers"]
+    print("Unpublished pins:", index.count_unpublished(categories, before_date="2024-05-25"))
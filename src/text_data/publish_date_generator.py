@@ -1,7 +1,8 @@
 import datetime
-from typing import List
+import heapq
+from typing import List, Optional, Tuple, Union
 
-import pytz
+import numpy as np
 
 
 class PublishDateGenerator:
@@ -94,6 +95,9 @@ class PublishDateGenerator:
         ],
     }
 
+    SECONDS_PER_DAY = 24 * 60 * 60
+    WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
     def __init__(
         self,
         date: datetime.datetime = None,
@@ -102,29 +106,127 @@ class PublishDateGenerator:
             self.date = datetime.datetime.now()
         else:
             self.date = date
+        self.slot_offsets, self.num_slots = self._compute_slot_offsets()
 
-    def generate_times(
+    @classmethod
+    def _compute_slot_offsets(cls) -> Tuple[np.ndarray, np.ndarray]:
+        # Second-of-day offsets per weekday (Monday = 0), padded to the longest slot list
+        # Default time is 13:00:00 if not specified
+        times_per_day = [cls.DEFAULT_TIMES.get(day, ["13:00:00"]) for day in cls.WEEKDAYS]
+        num_slots = np.array([len(times) for times in times_per_day], dtype=np.int64)
+        slot_offsets = np.zeros((len(cls.WEEKDAYS), num_slots.max()), dtype=np.int64)
+        for day_idx, times in enumerate(times_per_day):
+            for slot_idx, time in enumerate(times):
+                hours, minutes, seconds = (int(value) for value in time.split(":"))
+                slot_offsets[day_idx, slot_idx] = hours * 3600 + minutes * 60 + seconds
+        return slot_offsets, num_slots
+
+    def _compute_overflow_offsets(
         self,
-        num_pins_per_day: int,
+        weekday: int,
+        num_pins: int,
+        overflow_step: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Offsets of the pins beyond the slots of a weekday and the room each of them has before
+        # the next taken time, which bounds its jitter
+        slots = self.slot_offsets[weekday, : self.num_slots[weekday]]
+        taken = set(slots.tolist())
+        offsets: List[int] = []
+        overflow_round = 1
+        while overflow_step > 0 and len(offsets) < num_pins:
+            candidates = slots + overflow_round * overflow_step
+            candidates = candidates[candidates < self.SECONDS_PER_DAY].tolist()
+            if not candidates:
+                break
+            for offset in candidates:
+                if offset not in taken and len(offsets) < num_pins:
+                    taken.add(offset)
+                    offsets.append(offset)
+            overflow_round += 1
+
+        # The remaining pins split the largest free gaps of the day
+        bounds = [-1] + sorted(taken) + [self.SECONDS_PER_DAY]
+        gaps = [(lower - upper, lower, upper) for lower, upper in zip(bounds[:-1], bounds[1:])]
+        heapq.heapify(gaps)
+        while len(offsets) < num_pins:
+            _, lower, upper = heapq.heappop(gaps)
+            if upper - lower < 2:
+                raise ValueError(
+                    f"Cannot schedule {num_pins} extra pins on {self.WEEKDAYS[weekday]}"
+                )
+            offset = (lower + upper) // 2
+            taken.add(offset)
+            offsets.append(offset)
+            heapq.heappush(gaps, (lower - offset, lower, offset))
+            heapq.heappush(gaps, (offset - upper, offset, upper))
+
+        sorted_taken = np.array(sorted(taken) + [self.SECONDS_PER_DAY], dtype=np.int64)
+        offsets_array = np.array(offsets, dtype=np.int64)
+        next_taken = sorted_taken[np.searchsorted(sorted_taken, offsets_array, side="right")]
+        return offsets_array, next_taken - offsets_array - 1
+
+    def generate_schedule(
+        self,
+        pins_per_day: Union[List[int], np.ndarray],
+        overflow_step: int = 0,
+        jitter: int = 0,
+        seed: Optional[int] = None,
     ) -> List[str]:
-        utc = pytz.UTC
-        publish_time_list = []
-        day_of_week = self.date.strftime("%A")
-        # Default time is 13:00:00 if not specified
-        times_for_day = self.DEFAULT_TIMES.get(day_of_week, ["13:00:00"])
+        """Generate publish times for consecutive days starting from the generator date.
+
+        Args:
+            pins_per_day: Number of pins for each day of the planning horizon.
+            overflow_step: Shift in seconds applied to pins beyond the slots of a day, once per
+                pass over the slots, skipping times already taken that day. Once these shifts
+                leave the day, or with 0, the remaining pins split the largest free gaps.
+            jitter: Maximum random shift in seconds added to overflowing pins, it never reaches
+                the next taken time of the day.
+            seed: Seed of the jitter.
+
+        Returns:
+            Publish times formatted as YYYY-MM-DDTHH:MM:SS, ordered by day and pin. The times of
+            a day are unique.
+        """
+        counts = np.asarray(pins_per_day, dtype=np.int64)
+        day_idx = np.repeat(np.arange(len(counts)), counts)
+        pin_idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        start_day = np.datetime64(self.date.date(), "D")
+        weekday = (self.date.weekday() + day_idx) % len(self.WEEKDAYS)
+        num_slots = self.num_slots[weekday]
+        seconds = self.slot_offsets[weekday, np.minimum(pin_idx, num_slots - 1)]
+
+        # Every weekday gets one table of overflow offsets, its days use prefixes of it
+        overflow_idx = pin_idx - num_slots
+        is_overflow = overflow_idx >= 0
+        if is_overflow.any():
+            num_overflow = np.zeros(len(self.WEEKDAYS), dtype=np.int64)
+            np.maximum.at(num_overflow, weekday[is_overflow], overflow_idx[is_overflow] + 1)
+            offsets = np.zeros((len(self.WEEKDAYS), num_overflow.max()), dtype=np.int64)
+            room = np.zeros_like(offsets)
+            for day, num_pins in enumerate(num_overflow.tolist()):
+                offsets[day, :num_pins], room[day, :num_pins] = self._compute_overflow_offsets(
+                    day,
+                    num_pins,
+                    overflow_step,
+                )
+            table_idx = (weekday[is_overflow], overflow_idx[is_overflow])
+            seconds[is_overflow] = offsets[table_idx]
+            if jitter > 0:
+                rng = np.random.default_rng(seed)
+                shifts = rng.integers(0, jitter + 1, len(seconds))[is_overflow]
+                seconds[is_overflow] += np.minimum(shifts, room[table_idx])
 
-        for time_index in range(num_pins_per_day):
-            time = times_for_day[time_index % len(times_for_day)]
-            publish_date_time = utc.localize(
-                self.date.replace(
-                    hour=int(time[:2]),
-                    minute=int(time[3:5]),
-                    second=int(time[6:]),
-                ),
-            )
-            publish_time_list.append(publish_date_time.strftime("%Y-%m-%dT%H:%M:%S"))
+        publish_times = (
+            start_day + day_idx.astype("timedelta64[D]") + seconds.astype("timedelta64[s]")
+        )
+        return publish_times.astype("datetime64[s]").astype(str).tolist()
 
-        return publish_time_list
+    def generate_times(
+        self,
+        num_pins_per_day: int,
+    ) -> List[str]:
+        return self.generate_schedule(pins_per_day=[num_pins_per_day])
 
 
 if __name__ == "__main__":
@@ -140,3 +242,20 @@ if __name__ == "__main__":
     publish_date_generator = PublishDateGenerator(date=current_date)
     time_list = publish_date_generator.generate_times(num_pins_per_day)
     print("Generated Times:", time_list)
+    schedule = publish_date_generator.generate_schedule(
+        pins_per_day=[num_pins_per_day, 12, 15],
+        overflow_step=900,
+        jitter=300,
+        seed=11,
+    )
+    print("Generated Schedule:", schedule)
+    for num_pins in [20, 60, 200]:
+        schedule = publish_date_generator.generate_schedule(
+            pins_per_day=[num_pins] * 7,
+            overflow_step=900,
+            jitter=300,
+            seed=11,
+        )
+        days = [schedule[day * num_pins : (day + 1) * num_pins] for day in range(7)]
+        assert all(len(set(day)) == num_pins for day in days), "Duplicate publish times"
+    print("Publish times of every day are unique")
@@ -1,11 +1,17 @@
+import hashlib
 import os
+import random
 from glob import glob
 from pathlib import Path
-from typing import List
+from typing import Callable, List, Optional
 
 import pandas as pd
+from joblib import Parallel, delayed
+from tqdm import tqdm
 
+from src.metrics import collect_metrics, get_metrics, run_with_metrics
 from src.text_data.description_generator import DescriptionGenerator
+from src.text_data.metadata_cache import MetadataCache
 from src.text_data.title_generator import TitleGenerator
 
 
@@ -14,6 +20,10 @@ class SampleProcessor:
 
     This class provides methods to process sample data stored in a directory
     and generate a DataFrame containing information extracted from the samples.
+    Each sample draws its titles and descriptions from its own random stream derived from
+    (seed, sample_dir), so samples may be processed in any order or in parallel and still
+    produce the same output as a serial run. With a MetadataCache, the generated metadata of
+    unchanged samples is read back from disk instead of being regenerated.
     """
 
     def __init__(
@@ -21,10 +31,26 @@ class SampleProcessor:
         url: str,
         remote_root_dir: str,
         column_names: List[str],
+        seed: Optional[int] = None,
+        cache: Optional[MetadataCache] = None,
     ):
         self.url = url
         self.remote_root_dir = remote_root_dir
         self.column_names = column_names
+        self.seed = seed
+        self.cache = cache
+
+    def _get_sample_rng(
+        self,
+        sample_dir: str,
+    ) -> random.Random:
+        if self.seed is None:
+            return random.Random()
+
+        # Use the category/sample part of the path so that the stream does not depend on data_dir
+        sample_key = "/".join(Path(sample_dir).parts[-2:])
+        digest = hashlib.sha256(f"{self.seed}:{sample_key}".encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
 
     @staticmethod
     def _extract_id(
@@ -61,12 +87,73 @@ class SampleProcessor:
         file_url = os.path.join(url, truncated_path)
         return file_url
 
+    def _generate_metadata(
+        self,
+        df: pd.DataFrame,
+        sample_dir: str,
+    ) -> pd.DataFrame:
+        rng = self._get_sample_rng(sample_dir)
+        num_images = len(df)
+
+        # Titles
+        df_key = pd.read_csv(os.path.join(sample_dir, "keywords.csv"))
+        title_generator = TitleGenerator(df_key, rng=rng)
+        title_list = title_generator.generate_titles(num_titles=num_images)
+        df["Title"] = title_list
+
+        # Pinterest boards
+        try:
+            df_board = pd.read_csv(os.path.join(sample_dir, "board.csv"))
+            board_list = df_board["Board"].tolist() * num_images
+        except Exception:
+            board_list = [category.replace("-", " ").title() for category in df["category"]]
+        df["Pinterest board"] = board_list
+
+        # Descriptions
+        df_desc = pd.read_csv(os.path.join(sample_dir, "descriptions.csv"))
+        desc_generator = DescriptionGenerator(df_desc, rng=rng)
+        desc_list = desc_generator.generate_descriptions(num_descriptions=num_images)
+        df["Description"] = desc_list
+
+        # Links
+        df_links = pd.read_csv(os.path.join(sample_dir, "links.csv"), dtype={"sample_id": str})
+        sample_id_to_link = df_links.set_index("sample_id")["link"].to_dict()
+        df["Link"] = df["sample_id"].map(sample_id_to_link)
+
+        return df
+
+    def _load_metadata(
+        self,
+        df: pd.DataFrame,
+        sample_dir: str,
+    ) -> pd.DataFrame:
+        # Generated metadata is only reproducible, and hence cacheable, with a fixed seed
+        if self.cache is None or self.seed is None:
+            return self._generate_metadata(df, sample_dir)
+
+        img_paths = df["src_path"].tolist()
+        sample_hash = self.cache.compute_sample_hash(sample_dir, img_paths)
+        df_cached = self.cache.get(sample_dir, sample_hash, seed=self.seed)
+        if df_cached is not None:
+            get_metrics().inc("metadata_cache.hits")
+            img_keys = [self.cache.get_img_key(img_path) for img_path in img_paths]
+            columns = self.cache.METADATA_COLUMNS
+            df[columns] = df_cached.loc[img_keys, columns].to_numpy()
+            return df
+
+        get_metrics().inc("metadata_cache.misses")
+        df = self._generate_metadata(df, sample_dir)
+        self.cache.put(sample_dir, sample_hash, seed=self.seed, img_paths=img_paths, df=df)
+        return df
+
     def process_sample(self, sample_dir: str) -> pd.DataFrame:
+        get_metrics().inc("samples.processed")
+
         # Initialize dataframe
         df = pd.DataFrame(columns=self.column_names)
 
         # Supplementary information
-        img_paths = glob(os.path.join(sample_dir, "*/*.[jpPJ][nNpP][gG]"))
+        img_paths = sorted(glob(os.path.join(sample_dir, "*/*.[jpPJ][nNpP][gG]")))
         img_names = [Path(img_path).name for img_path in img_paths]
         category_list = [self._extract_id(img_path, "category") for img_path in img_paths]
         sample_names = [self._extract_id(img_path, "sample_name") for img_path in img_paths]
@@ -84,12 +171,6 @@ class SampleProcessor:
         ]
         df["dst_path"] = remote_img_path_list
 
-        # Titles
-        df_key = pd.read_csv(os.path.join(sample_dir, "keywords.csv"))
-        title_generator = TitleGenerator(df_key)
-        title_list = title_generator.generate_titles(num_titles=len(img_paths))
-        df["Title"] = title_list
-
         # URLs
         url_list = [
             self._get_file_url(remote_img_path, self.url)
@@ -97,31 +178,35 @@ class SampleProcessor:
         ]
         df["Media URL"] = url_list
 
-        # Pinterest boards
-        try:
-            df_board = pd.read_csv(os.path.join(sample_dir, "board.csv"))
-            board_list = df_board["Board"].tolist() * len(img_paths)
-        except Exception:
-            board_list = [category.replace("-", " ").title() for category in category_list]
-        df["Pinterest board"] = board_list
-
         # Thumbnails
         thumbnail_list = [""] * len(img_paths)
         df["Thumbnail"] = thumbnail_list
 
-        # Descriptions
-        df_desc = pd.read_csv(os.path.join(sample_dir, "descriptions.csv"))
-        desc_generator = DescriptionGenerator(df_desc)
-        desc_list = desc_generator.generate_descriptions(num_descriptions=len(img_paths))
-        df["Description"] = desc_list
-
-        # Links
-        df_links = pd.read_csv(os.path.join(sample_dir, "links.csv"), dtype={"sample_id": str})
-        sample_id_to_link = df_links.set_index("sample_id")["link"].to_dict()
-        df["Link"] = df["sample_id"].map(sample_id_to_link)
+        # Titles, boards, descriptions and links
+        df = self._load_metadata(df, sample_dir)
 
         # Keywords
         keyword_list = [""] * len(img_paths)
         df["Keywords"] = keyword_list
 
         return df
+
+    def process_samples(
+        self,
+        sample_dirs: List[str],
+        n_jobs: int = 1,
+        callback: Optional[Callable[[int], None]] = None,
+    ) -> pd.DataFrame:
+        def _iter_tasks():
+            for idx, sample_dir in enumerate(
+                tqdm(sample_dirs, desc="Processing samples", unit="samples"),
+            ):
+                # Samples are dispatched lazily, so a callback that raises, e.g. for a cancelled
+                # job, stops the run before the next sample starts
+                if callback is not None:
+                    callback(idx)
+                yield delayed(run_with_metrics)(self.process_sample, os.getpid(), sample_dir)
+
+        results = Parallel(n_jobs=n_jobs)(_iter_tasks())
+        df_list = [collect_metrics(result) for result in results]
+        return pd.concat(df_list, ignore_index=True)
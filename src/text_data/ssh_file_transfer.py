@@ -1,13 +1,28 @@
 import logging
 import os
+import posixpath
+import queue
+import shlex
+import stat
+import threading
+import time
 from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 import paramiko
 from dotenv import load_dotenv
 
+from src.metrics import get_metrics
+from src.text_data.upload_journal import UploadJournal
+
 
 class SSHFileTransfer:
-    """A class for uploading and downloading files over SSH."""
+    """A class for uploading and downloading files over SSH.
+
+    SFTP channels are opened with configurable window and packet sizes, uploads use pipelined
+    writes that do not wait for the acknowledgement of every request, and downloads prefetch
+    the file with concurrent read requests.
+    """
 
     def __init__(
         self,
@@ -16,12 +31,21 @@ class SSHFileTransfer:
         port: int,
         password: str,
         url: str,
+        window_size: Optional[int] = None,
+        max_packet_size: Optional[int] = None,
+        chunk_size: int = 2**20,
+        compress: bool = False,
     ) -> None:
         self.username = username
         self.hostname = hostname
         self.port = port
         self.password = password
         self.url = url
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.existing_dirs: Set[str] = set()
 
     def connect(self) -> None:
         # Create SSH client
@@ -35,11 +59,19 @@ class SSHFileTransfer:
                 port=self.port,
                 username=self.username,
                 password=self.password,
+                compress=self.compress,
             )
-            self.sftp = self.ssh.open_sftp()
+            self.sftp = self._open_sftp()
         except Exception as e:
             logging.info(f"Error: {e}")
 
+    def _open_sftp(self) -> paramiko.SFTPClient:
+        return paramiko.SFTPClient.from_transport(
+            self.ssh.get_transport(),
+            window_size=self.window_size,
+            max_packet_size=self.max_packet_size,
+        )
+
     def disconnect(self) -> None:
         if self.sftp:
             self.sftp.close()
@@ -52,33 +84,319 @@ class SSHFileTransfer:
         remote_path: str,
     ) -> None:
         try:
-            self.sftp.put(local_path, remote_path)
+            self._put_file(self.sftp, local_path, remote_path)
         except Exception as e:
             logging.info(f"Error: {e}")
             logging.info(f"Local path: {local_path}")
             logging.info(f"Remote path: {remote_path}")
 
+    def _put_file(
+        self,
+        sftp: paramiko.SFTPClient,
+        local_path: str,
+        remote_path: str,
+    ) -> None:
+        file_size = os.path.getsize(local_path)
+        with open(local_path, "rb") as local_file, sftp.open(remote_path, "wb") as remote_file:
+            # Pipelined writes are acknowledged in bulk when the file is closed
+            remote_file.set_pipelined(True)
+            while chunk := local_file.read(self.chunk_size):
+                remote_file.write(chunk)
+
+        remote_size = sftp.stat(remote_path).st_size
+        if remote_size != file_size:
+            raise IOError(f"Uploaded {remote_size} bytes out of {file_size}")
+
+    def _put_with_retries(
+        self,
+        sftp: paramiko.SFTPClient,
+        local_path: str,
+        remote_path: str,
+        max_retries: int,
+        backoff: float,
+    ) -> bool:
+        for attempt in range(max_retries + 1):
+            try:
+                self._put_file(sftp, local_path, remote_path)
+                # Mirror the local mtime so that a later sync can detect unchanged files
+                local_stat = os.stat(local_path)
+                sftp.utime(remote_path, (local_stat.st_atime, local_stat.st_mtime))
+                return True
+            except Exception as e:
+                logging.info(f"Error (attempt {attempt + 1}/{max_retries + 1}): {e}")
+                logging.info(f"Local path: {local_path}")
+                logging.info(f"Remote path: {remote_path}")
+                if attempt < max_retries:
+                    time.sleep(backoff * 2**attempt)
+        return False
+
+    def upload_files(
+        self,
+        jobs: Iterable[Tuple[str, str]],
+        num_workers: int = 4,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+        callback: Optional[Callable[[str, str, bool], None]] = None,
+        journal: Optional[UploadJournal] = None,
+        stop_event: Optional[threading.Event] = None,
+    ) -> List[Tuple[str, str]]:
+        """Upload files concurrently over a pool of SFTP channels sharing the SSH transport.
+
+        Args:
+            jobs: Pairs of (local_path, remote_path) to upload.
+            num_workers: Number of SFTP channels, each drained by its own thread.
+            max_retries: Number of retries per file before it is reported as failed.
+            backoff: Initial delay in seconds between retries, doubled after every attempt.
+            callback: Function called with (local_path, remote_path, success) after each file.
+            journal: Journal where each confirmed upload is recorded.
+            stop_event: Event that stops the upload, files not started yet are skipped.
+
+        Returns:
+            Pairs of (local_path, remote_path) that failed to upload.
+        """
+        # Bounded queue so that a lazily produced job list is not materialized in memory
+        job_queue: queue.Queue = queue.Queue(maxsize=num_workers * 4)
+        lock = threading.Lock()
+        failed_jobs: List[Tuple[str, str]] = []
+        total_bytes = 0
+
+        def _worker(sftp: paramiko.SFTPClient) -> None:
+            nonlocal total_bytes
+            metrics = get_metrics()
+            try:
+                while True:
+                    job = job_queue.get()
+                    if job is None:
+                        break
+                    if stop_event is not None and stop_event.is_set():
+                        continue
+                    local_path, remote_path = job
+                    file_size = 0
+                    try:
+                        with metrics.span("upload.file"):
+                            success = self._put_with_retries(
+                                sftp,
+                                local_path,
+                                remote_path,
+                                max_retries=max_retries,
+                                backoff=backoff,
+                            )
+                        if success:
+                            file_size = os.path.getsize(local_path)
+                            if journal is not None:
+                                journal.record(local_path, remote_path)
+                        if callback is not None:
+                            callback(local_path, remote_path, success)
+                    except Exception as e:
+                        # A failing journal or callback must not kill the worker, the producer
+                        # would block on the full queue once all workers are gone
+                        logging.error(f"Failed to finish the upload of {local_path}: {e}")
+                        success = False
+                    with lock:
+                        if success:
+                            total_bytes += file_size
+                            metrics.inc("upload.files")
+                            metrics.inc("upload.bytes", file_size)
+                        else:
+                            failed_jobs.append(job)
+                            metrics.inc("upload.failures")
+            finally:
+                sftp.close()
+
+        # Open the channels upfront so that a connection error surfaces before any upload
+        channels = [self._open_sftp() for _ in range(max(num_workers, 1))]
+        workers = [threading.Thread(target=_worker, args=(sftp,), daemon=True) for sftp in channels]
+        start_time = time.perf_counter()
+        for worker in workers:
+            worker.start()
+
+        def _put(job: Optional[Tuple[str, str]]) -> bool:
+            # Stop feeding the queue once no worker is left to drain it
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    job_queue.put(job, timeout=1.0)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        for job in jobs:
+            if stop_event is not None and stop_event.is_set():
+                break
+            if not _put(job):
+                logging.error("All upload workers exited, the remaining files are skipped")
+                break
+        for _ in workers:
+            if not _put(None):
+                break
+        for worker in workers:
+            worker.join()
+
+        elapsed_time = time.perf_counter() - start_time
+        throughput = total_bytes / 2**20 / elapsed_time if elapsed_time > 0 else 0.0
+        logging.info(
+            f"Uploaded {total_bytes / 2**20:.1f} MB in {elapsed_time:.1f} s "
+            f"({throughput:.2f} MB/s), failed files: {len(failed_jobs)}",
+        )
+        return failed_jobs
+
+    def list_remote_files(
+        self,
+        remote_root_dir: str,
+    ) -> Dict[str, paramiko.SFTPAttributes]:
+        remote_files: Dict[str, paramiko.SFTPAttributes] = {}
+        pending_dirs = [remote_root_dir]
+        while pending_dirs:
+            remote_dir = pending_dirs.pop()
+            try:
+                entries = self.sftp.listdir_attr(remote_dir)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                remote_path = posixpath.join(remote_dir, entry.filename)
+                if stat.S_ISDIR(entry.st_mode):
+                    pending_dirs.append(remote_path)
+                    self.existing_dirs.add(remote_path)
+                else:
+                    remote_files[remote_path] = entry
+        return remote_files
+
+    def remove_remote_files(
+        self,
+        remote_paths: Iterable[str],
+        batch_size: int = 500,
+    ) -> None:
+        remote_paths = sorted(remote_paths)
+        for batch_start in range(0, len(remote_paths), batch_size):
+            batch = remote_paths[batch_start : batch_start + batch_size]
+            try:
+                logging.debug(f"Remove {len(batch)} files")
+                self._run_command("rm -f " + " ".join(shlex.quote(path) for path in batch))
+            except Exception as e:
+                logging.info(f"Error: {e}")
+
+    @staticmethod
+    def is_up_to_date(
+        local_path: str,
+        remote_path: str,
+        remote_files: Dict[str, paramiko.SFTPAttributes],
+    ) -> bool:
+        remote_attr = remote_files.get(posixpath.normpath(remote_path))
+        if remote_attr is None:
+            return False
+        local_stat = os.stat(local_path)
+        return remote_attr.st_size == local_stat.st_size and remote_attr.st_mtime == int(
+            local_stat.st_mtime
+        )
+
+    def plan_sync(
+        self,
+        jobs: Iterable[Tuple[str, str]],
+        remote_root_dir: str,
+    ) -> Tuple[List[Tuple[str, str]], Set[str]]:
+        """Compare local files against the remote tree listed in one pass.
+
+        A remote file is considered up to date when its size and mtime match the local file.
+        Uploads mirror the local mtime, so files uploaded by a previous run are skipped.
+
+        Args:
+            jobs: Pairs of (local_path, remote_path) that should exist on the server.
+            remote_root_dir: Remote directory that is compared against the jobs.
+
+        Returns:
+            Jobs whose remote copy is missing or outdated, and remote files under
+            remote_root_dir that are not part of the jobs.
+        """
+        jobs = list(jobs)
+        remote_files = self.list_remote_files(remote_root_dir)
+
+        changed_jobs = [
+            (local_path, remote_path)
+            for local_path, remote_path in jobs
+            if not self.is_up_to_date(local_path, remote_path, remote_files)
+        ]
+        stale_paths = set(remote_files) - set(posixpath.normpath(path) for _, path in jobs)
+
+        logging.info(
+            f"Sync: {len(changed_jobs)} files to upload, {len(jobs) - len(changed_jobs)} "
+            f"unchanged, {len(stale_paths)} stale",
+        )
+        return changed_jobs, stale_paths
+
+    def sync_files(
+        self,
+        jobs: Iterable[Tuple[str, str]],
+        remote_root_dir: str,
+        **upload_kwargs,
+    ) -> List[Tuple[str, str]]:
+        changed_jobs, stale_paths = self.plan_sync(jobs, remote_root_dir)
+        self.remove_remote_files(stale_paths)
+        self.create_remote_dirs(posixpath.dirname(path) for _, path in changed_jobs)
+        return self.upload_files(changed_jobs, **upload_kwargs)
+
     def download_file(
         self,
         remote_path: str,
         local_path: str,
+        max_concurrent_prefetch_requests: Optional[int] = None,
     ) -> None:
         try:
-            self.sftp.get(remote_path, local_path)
+            self.sftp.get(
+                remote_path,
+                local_path,
+                prefetch=True,
+                max_concurrent_prefetch_requests=max_concurrent_prefetch_requests,
+            )
         except Exception as e:
             logging.info(f"Error: {e}")
 
+    def _run_command(self, command: str) -> int:
+        # Wait for the command to finish so that later SFTP calls never race with it
+        _, stdout, stderr = self.ssh.exec_command(command)
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            logging.info(f"Command failed with status {exit_status}: {command}")
+            logging.info(f"Error: {stderr.read().decode('utf-8', errors='replace').strip()}")
+        return exit_status
+
     def create_remote_dir(self, remote_dir: str) -> None:
-        try:
-            logging.debug(f"Create directory: {remote_dir}")
-            self.ssh.exec_command(f"mkdir -p {remote_dir}")
-        except Exception as e:
-            logging.info(f"Error: {e}")
+        self.create_remote_dirs([remote_dir])
+
+    @staticmethod
+    def _get_parent_dirs(remote_dir: str) -> List[str]:
+        parent_dirs = []
+        parent_dir = posixpath.dirname(remote_dir)
+        while parent_dir not in ("/", "") and parent_dir != remote_dir:
+            parent_dirs.append(parent_dir)
+            remote_dir, parent_dir = parent_dir, posixpath.dirname(parent_dir)
+        return parent_dirs
+
+    def create_remote_dirs(
+        self,
+        remote_dirs: Iterable[str],
+        batch_size: int = 500,
+    ) -> None:
+        # Keep only the leaf directories since mkdir -p creates their parents anyway
+        dirs = set(posixpath.normpath(d) for d in remote_dirs) - self.existing_dirs
+        parent_dirs = set(p for d in dirs for p in self._get_parent_dirs(d))
+        leaf_dirs = sorted(dirs - parent_dirs)
+
+        for batch_start in range(0, len(leaf_dirs), batch_size):
+            batch = leaf_dirs[batch_start : batch_start + batch_size]
+            try:
+                logging.debug(f"Create {len(batch)} directories")
+                command = "mkdir -p " + " ".join(shlex.quote(d) for d in batch)
+                if self._run_command(command) == 0:
+                    self.existing_dirs.update(batch)
+                    self.existing_dirs.update(p for d in batch for p in self._get_parent_dirs(d))
+            except Exception as e:
+                logging.info(f"Error: {e}")
 
     def remove_remote_dir(self, remote_dir: str) -> None:
         try:
             logging.debug(f"Remove directory: {remote_dir}")
-            self.ssh.exec_command(f"rm -rf {remote_dir} || true")
+            self._run_command(f"rm -rf {remote_dir} || true")
+            self.existing_dirs.clear()
         except Exception as e:
             logging.info(f"Error: {e}")
 
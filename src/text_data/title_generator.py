@@ -1,5 +1,5 @@
 import random
-from typing import List
+from typing import List, Optional
 
 import pandas as pd
 
@@ -15,6 +15,7 @@ class TitleGenerator:
         max_desired_length: int = 100,
         max_limit: int = 150,
         delimiter: str = " - ",
+        rng: Optional[random.Random] = None,
     ):
         self.df = df
         self.keyword_column = keyword_column
@@ -22,6 +23,7 @@ class TitleGenerator:
         self.min_desired_length = min_desired_length
         self.max_desired_length = max_desired_length
         self.delimiter = delimiter
+        self.rng = rng if rng is not None else random.Random()
 
     def generate_titles(
         self,
@@ -33,12 +35,12 @@ class TitleGenerator:
 
         while len(generated_titles) < num_titles:
             attempt_count = 0  # Track the number of attempts to construct a title
-            desired_length = random.randint(self.min_desired_length, self.max_desired_length)
+            desired_length = self.rng.randint(self.min_desired_length, self.max_desired_length)
             used_keywords = set()
             title = ""
 
             while len(title) < self.max_limit:
-                keyword = random.choice(keyword_list).capitalize()
+                keyword = self.rng.choice(keyword_list).capitalize()
                 if keyword in used_keywords:
                     continue  # Skip if keyword is already used
                 used_keywords.add(keyword)
@@ -72,6 +74,7 @@ if __name__ == "__main__":
         min_desired_length=60,
         max_desired_length=100,
         max_limit=150,
+        rng=random.Random(11),
     )
     title_list = title_generator.generate_titles(num_titles=num_images)
     print("Generated Titles:", title_list)
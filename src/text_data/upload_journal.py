@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, Mapping
+
+if TYPE_CHECKING:
+    import paramiko
+
+
+class UploadJournal:
+    """An append-only JSONL journal of completed uploads.
+
+    Every confirmed upload is appended as one line with the remote path, size, mtime and SHA-256
+    of the local file. A rerun skips files whose journal entry still matches the local file, so an
+    interrupted upload resumes with the missing files only.
+    """
+
+    def __init__(
+        self,
+        journal_path: str,
+    ) -> None:
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+        self.entries = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        entries: Dict[str, dict] = {}
+        if not os.path.isfile(self.journal_path):
+            return entries
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be truncated if the previous run was killed mid-write
+                    continue
+                entries[entry["remote_path"]] = entry
+        return entries
+
+    @staticmethod
+    def compute_hash(file_path: str, chunk_size: int = 2**20) -> str:
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def record(
+        self,
+        local_path: str,
+        remote_path: str,
+    ) -> None:
+        local_stat = os.stat(local_path)
+        entry = {
+            "remote_path": posixpath.normpath(remote_path),
+            "local_path": local_path,
+            "size": local_stat.st_size,
+            "mtime": int(local_stat.st_mtime),
+            "sha256": self.compute_hash(local_path),
+            "uploaded_at": int(time.time()),
+        }
+        line = json.dumps(entry)
+        with self.lock:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(f"{line}\n")
+            self.entries[entry["remote_path"]] = entry
+
+    def is_completed(
+        self,
+        local_path: str,
+        remote_path: str,
+    ) -> bool:
+        entry = self.entries.get(posixpath.normpath(remote_path))
+        if entry is None:
+            return False
+        local_stat = os.stat(local_path)
+        if entry["size"] != local_stat.st_size:
+            return False
+        # Hash only when the mtime changed, e.g. after the file was copied or regenerated
+        if entry["mtime"] == int(local_stat.st_mtime):
+            return True
+        return entry["sha256"] == self.compute_hash(local_path)
+
+    def verify(
+        self,
+        remote_files: Mapping[str, "paramiko.SFTPAttributes"],
+    ) -> int:
+        # Drop entries whose remote copy is missing or has a different size
+        with self.lock:
+            invalid_paths = [
+                remote_path
+                for remote_path, entry in self.entries.items()
+                if remote_path not in remote_files
+                or remote_files[remote_path].st_size != entry["size"]
+            ]
+            for remote_path in invalid_paths:
+                del self.entries[remote_path]
+        self.compact()
+        logging.info(f"Journal verified: {len(self.entries)} valid, {len(invalid_paths)} dropped")
+        return len(invalid_paths)
+
+    def discard(
+        self,
+        remote_paths: Iterable[str],
+    ) -> None:
+        with self.lock:
+            for remote_path in remote_paths:
+                self.entries.pop(posixpath.normpath(remote_path), None)
+        self.compact()
+
+    def compact(self) -> None:
+        # Rewrite the journal with one line per remote path
+        with self.lock:
+            tmp_path = f"{self.journal_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in self.entries.values():
+                    f.write(f"{json.dumps(entry)}\n")
+            os.replace(tmp_path, self.journal_path)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries = {}
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+
+if __name__ == "__main__":
+    # Test UploadJournal class
+    local_path = "data/test-img.jpg"
+    journal = UploadJournal(journal_path="data/cache/upload_journal.jsonl")
+    print("Completed:", journal.is_completed(local_path, "/remote/test-dir/test-img.jpg"))
@@ -0,0 +1,85 @@
+import logging
+import os
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+
+from src import PROJECT_DIR
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def warm_sample(
+    sample_dir: str,
+    scaling_factor: float,
+    variant_cache_dir: str,
+) -> None:
+    from src.image_data.image_generator import ImageGenerator
+    from src.image_data.image_matcher import ImageMatcher
+
+    matcher = ImageMatcher()
+    layout_paths = matcher.get_file_list(
+        os.path.join(sample_dir, "layouts"),
+        "layout*.[jpPJ][nNpP][gG]",
+    )
+    bg_paths = matcher.get_file_list(
+        os.path.join(sample_dir, "backgrounds"),
+        "background*.[jpPJ][nNpP][gG]",
+    )
+    generator = ImageGenerator(
+        num_images_per_bg=0,
+        scaling_factor=scaling_factor,
+        seed=0,
+        variant_cache_dir=variant_cache_dir,
+    )
+    generator.warm_variant_cache(matcher.create_dataframe(layout_paths, bg_paths))
+
+
+@hydra.main(
+    config_path=os.path.join(PROJECT_DIR, "configs"),
+    config_name="warm_variant_cache",
+    version_base=None,
+)
+def main(cfg: DictConfig) -> None:
+    log.info(f"Config:\n\n{OmegaConf.to_yaml(cfg)}")
+
+    # Imported here so that config errors and --help do not wait for cv2 and pandas
+    from joblib import Parallel, delayed
+    from tqdm import tqdm
+
+    from src.metrics import collect_metrics, get_metrics, run_with_metrics
+    from src.utils import get_dir_list
+
+    sample_dirs = get_dir_list(
+        data_dir=str(os.path.join(PROJECT_DIR, cfg.data_dir)),
+        include_dirs=cfg.include_samples,
+        exclude_dirs=cfg.exclude_samples,
+    )
+    variant_cache_dir = str(os.path.join(PROJECT_DIR, cfg.variant_cache_dir))
+    tasks = [
+        (sample_dir, scaling_factor)
+        for sample_dir in sample_dirs
+        for scaling_factor in cfg.scaling_factors
+    ]
+    results = Parallel(n_jobs=cfg.num_workers)(
+        delayed(run_with_metrics)(
+            warm_sample,
+            os.getpid(),
+            sample_dir=sample_dir,
+            scaling_factor=scaling_factor,
+            variant_cache_dir=variant_cache_dir,
+        )
+        for sample_dir, scaling_factor in tqdm(tasks, desc="Warming cache", unit="tasks")
+    )
+    for result in results:
+        collect_metrics(result)
+
+    counters = get_metrics().report()["counters"]
+    log.info(f"Variants created: {int(counters.get('variant_cache.misses', 0))}")
+    log.info(f"Variants already cached: {int(counters.get('variant_cache.hits', 0))}")
+    log.info("Complete")
+
+
+if __name__ == "__main__":
+    main()